@@ -14,3 +14,34 @@ def clear_database_auto(clear_database):  # pylint: disable=unused-argument
 def koopmans_code(aiida_local_code_factory):
     """Get a koopmans code."""
     return aiida_local_code_factory(executable="diff", entry_point="koopmans")
+
+
+@pytest.fixture
+def fixture_sandbox():
+    """Return a `SandboxFolder`."""
+    from aiida.common.folders import SandboxFolder
+
+    with SandboxFolder() as folder:
+        yield folder
+
+
+@pytest.fixture
+def generate_calc_job():
+    """Fixture to construct a new `CalcJob` instance and call `prepare_for_submission` for testing `CalcJob` classes.
+
+    The fixture will return the `CalcInfo` returned by `prepare_for_submission`. The raw input files will have been
+    written into the temporary folder that was passed to it.
+    """
+
+    def _generate_calc_job(folder, entry_point_name, inputs=None):
+        """Fixture to generate a mock `CalcInfo` for testing calculation jobs."""
+        from aiida.engine.utils import instantiate_process
+        from aiida.manage import get_manager
+        from aiida.plugins import CalculationFactory
+
+        process_class = CalculationFactory(entry_point_name)
+        process = instantiate_process(get_manager().get_runner(), process_class, **(inputs or {}))
+
+        return process.prepare_for_submission(folder)
+
+    return _generate_calc_job
@@ -0,0 +1,190 @@
+"""Process-wide caches for the builder helpers.
+
+A Koopmans workflow creates dozens of builders against the same handful of codes and computers. The profile is
+therefore loaded only once, code and computer identifiers, as well as the codes of an executable on a computer, are
+resolved to stored nodes once per process (and per profile), and the builders obtained from protocols are generated
+once per template key and then copied. The input nodes created by the builder helpers are interned with
+:func:`intern_node`, so that identical content is stored once. Call :func:`clear_caches` to invalidate everything, e.g.
+after relabelling or deleting a code or a node.
+"""
+
+from collections.abc import Mapping
+
+from aiida import orm
+
+_CODES = {}
+_COMPUTERS = {}
+_COMPUTER_CODES = {}
+_BUILDER_TEMPLATES = {}
+_INTERNED_NODES = {}
+
+
+def load_profile():
+    """Load the default profile, unless a profile is already loaded.
+
+    Contrary to ``aiida.load_profile``, this does not re-read the configuration when a profile is already loaded.
+
+    :return: the loaded :py:class:`aiida.manage.configuration.profile.Profile`.
+    """
+    from aiida import get_profile
+    from aiida import load_profile as _load_profile
+
+    profile = get_profile()
+    if profile is None:
+        profile = _load_profile()
+    return profile
+
+
+def load_code(identifier):
+    """Load a code, querying the database only the first time the identifier is requested.
+
+    :param identifier: the label, full label (``label@computer``), pk or uuid of the code.
+    :return: the stored code node.
+    :raises aiida.common.exceptions.NotExistent: if the code does not exist.
+    """
+    if isinstance(identifier, orm.AbstractCode):
+        return identifier
+
+    key = (load_profile().name, identifier)
+    try:
+        return _CODES[key]
+    except KeyError:
+        code = _CODES[key] = orm.load_code(identifier)
+        return code
+
+
+def load_computer(identifier):
+    """Load a computer, querying the database only the first time the identifier is requested.
+
+    :param identifier: the label, pk or uuid of the computer.
+    :return: the stored :py:class:`aiida.orm.computers.Computer`.
+    :raises aiida.common.exceptions.NotExistent: if the computer does not exist.
+    """
+    if isinstance(identifier, orm.Computer):
+        return identifier
+
+    key = (load_profile().name, identifier)
+    try:
+        return _COMPUTERS[key]
+    except KeyError:
+        computer = _COMPUTERS[key] = orm.load_computer(identifier)
+        return computer
+
+
+def load_computer_code(computer, label, factory):
+    """Return the code with the given label on a computer, querying the database only the first time it is requested.
+
+    If several codes on the computer have the label, the first one returned by the query is used. If there is none, the
+    code is created with the ``factory``.
+
+    :param computer: the stored :py:class:`aiida.orm.computers.Computer`.
+    :param label: the label of the code, e.g. the name of its executable.
+    :param factory: a callable without arguments, returning the stored code to use if none exists yet.
+    :return: the stored code node.
+    """
+    key = (load_profile().name, computer.uuid, label)
+    try:
+        return _COMPUTER_CODES[key]
+    except KeyError:
+        pass
+
+    query = orm.QueryBuilder()
+    query.append(orm.Computer, filters={"uuid": computer.uuid}, tag="computer")
+    query.append(orm.AbstractCode, with_computer="computer", filters={"label": label})
+    code = query.first(flat=True)
+    code = _COMPUTER_CODES[key] = code if code is not None else factory()
+    return code
+
+
+def get_structure_species(structure, composition=False):
+    """Return a hashable description of the kinds of a structure, to be used in template keys.
+
+    :param structure: the ``StructureData``.
+    :param composition: if True, include the number of sites of each kind.
+    :return: sorted tuple of ``(kind name, symbols)``, or ``(kind name, symbols, number of sites)`` tuples.
+    """
+    if not composition:
+        return tuple(sorted((kind.name, kind.symbols) for kind in structure.kinds))
+
+    kind_names = [site.kind_name for site in structure.sites]
+    return tuple(sorted((kind.name, kind.symbols, kind_names.count(kind.name)) for kind in structure.kinds))
+
+
+def _copy_inputs(value):
+    """Copy a (nested) mapping of builder inputs, sharing stored nodes and cloning the unstored ones."""
+    if isinstance(value, orm.Data):
+        return value if value.is_stored else value.clone()
+    if isinstance(value, Mapping):
+        return {key: _copy_inputs(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_copy_inputs(item) for item in value)
+    return value
+
+
+def get_builder_from_template(process_class, key, factory):
+    """Return a copy of the builder template identified by ``key``, generating the template on first use.
+
+    This is meant for builders obtained with ``get_builder_from_protocol``, which re-reads the protocol files and
+    queries the pseudopotential family at every call. The template stores the inputs of the builder returned by the
+    ``factory``, and every call returns a new builder with a copy of these inputs: stored nodes are shared, unstored
+    ones are cloned. The caller is responsible for overriding the fields that are not determined by ``key``.
+
+    :param process_class: the process class of the builder.
+    :param key: a hashable key that identifies all the arguments of the ``factory`` that affect the builder.
+    :param factory: a callable without arguments, returning the builder to use as template.
+    :return: a new ``ProcessBuilder`` instance of ``process_class``.
+    """
+    key = (load_profile().name, process_class.__name__) + tuple(key)
+    try:
+        inputs = _BUILDER_TEMPLATES[key]
+    except KeyError:
+        inputs = _BUILDER_TEMPLATES[key] = factory()._inputs(prune=True)
+
+    builder = process_class.get_builder()
+    builder._update(_copy_inputs(inputs))  # pylint: disable=protected-access
+    return builder
+
+
+def intern_node(node):
+    """Return a stored node with the same content as ``node``, storing ``node`` only if no such node exists yet.
+
+    Nodes are identified by their AiiDA hash: the index maintained by this module is checked first, then the database
+    is queried for a node of the same class with the same ``_aiida_hash`` extra. Reusing the same input nodes keeps the
+    provenance graph small and makes AiiDA caching hits across steps and reruns much more likely.
+
+    :param node: a ``Data`` node; stored nodes are returned as they are.
+    :return: the stored node, either ``node`` itself or an existing node with the same hash.
+    """
+    if node.is_stored:
+        return node
+
+    # Normalise the attributes as ``Node.store`` does, otherwise the hash could differ from the one of stored nodes.
+    node._backend_entity.clean_values()  # pylint: disable=protected-access
+    node_hash = node.base.caching._compute_hash()  # pylint: disable=protected-access
+
+    if node_hash is None:
+        return node.store()
+
+    key = (load_profile().name, node.__class__, node_hash)
+    try:
+        return _INTERNED_NODES[key]
+    except KeyError:
+        pass
+
+    query = orm.QueryBuilder().append(
+        node.__class__,
+        filters={f"extras.{node.base.caching._HASH_EXTRA_KEY}": node_hash},  # pylint: disable=protected-access
+        subclassing=False,
+    )
+    existing = query.first(flat=True)
+    interned = _INTERNED_NODES[key] = existing if existing is not None else node.store()
+    return interned
+
+
+def clear_caches():
+    """Invalidate all the caches of this module."""
+    _CODES.clear()
+    _COMPUTERS.clear()
+    _COMPUTER_CODES.clear()
+    _BUILDER_TEMPLATES.clear()
+    _INTERNED_NODES.clear()
@@ -1,13 +1,129 @@
 # -*- coding: utf-8 -*-
 """`CalcJob` implementation for the kcw.x code of Quantum ESPRESSO."""
-from pathlib import Path
+from glob import has_magic
+from pathlib import Path, PurePosixPath
 
 from aiida import orm
+from aiida.common import exceptions
+from aiida.common.hashing import make_hash
+from aiida.common.links import LinkType
+from aiida.orm.nodes.process.calculation.calcjob import CalcJobNodeCaching
 from aiida.plugins import DataFactory
 from aiida_quantumespresso.calculations.namelists import NamelistsCalculation
 
+from aiida_koopmans.data.wannier90 import WannierUMatrixData
+
 SingleFileData = DataFactory('core.singlefile')
 
+PW_PROCESS_TYPE = 'aiida.calculations:quantumespresso.pw'
+KCW_PROCESS_TYPE = 'aiida.calculations:koopmans'
+KCW_CHAIN_PROCESS_TYPE = 'aiida.calculations:koopmans.chain'
+
+
+def get_parent_pw_calculation(parent_folder):
+    """Return the ``PwCalculation`` that created the ``parent_folder``.
+
+    If the ``parent_folder`` was created by a ``KcwCalculation`` or ``KcwChainCalculation``, its own ``parent_folder``
+    is followed.
+
+    :param parent_folder: the ``parent_folder`` input of a ``KcwCalculation``.
+    :return: the ``CalcJobNode`` of the ``PwCalculation``, or None if it cannot be found in the provenance.
+    """
+    creator = parent_folder.creator
+    while creator is not None and creator.process_type in (KCW_PROCESS_TYPE, KCW_CHAIN_PROCESS_TYPE):
+        parent_folder = getattr(creator.inputs, 'parent_folder', None)
+        creator = parent_folder.creator if parent_folder is not None else None
+
+    if creator is None or creator.process_type != PW_PROCESS_TYPE:
+        return None
+
+    return creator
+
+
+def validate_settings(value, _):
+    """Validate the numerical parser options of the ``settings``.
+
+    These are the ``hamiltonian_cutoff`` of the sparse Hamiltonian, and the ``dos_*`` options with which the parser
+    broadens the band energies.
+    """
+    if value is None:
+        return None
+
+    settings = {key.lower(): option for key, option in value.get_dict().items()}
+    options = settings.get('parser_options', None) or {}
+    for key in ('hamiltonian_cutoff', 'dos_degauss', 'dos_emin', 'dos_emax', 'dos_deltae'):
+        if key in options and (isinstance(options[key], bool) or not isinstance(options[key], (int, float))):
+            return f'the `{key}` parser option should be a number, not `{options[key]!r}`.'
+    if 'hamiltonian_cutoff' in options and options['hamiltonian_cutoff'] < 0:
+        return 'the `hamiltonian_cutoff` parser option should not be negative.'
+    for key in ('dos_degauss', 'dos_deltae'):
+        if key in options and options[key] <= 0:
+            return f'the `{key}` parser option should be positive.'
+    if 'dos_emin' in options and 'dos_emax' in options and options['dos_emin'] >= options['dos_emax']:
+        return 'the `dos_emin` parser option should be lower than `dos_emax`.'
+    return None
+
+
+def get_parent_folder_hash(parent_folder):
+    """Return the hash of a ``parent_folder`` that depends only on the calculation that created it.
+
+    The hash of a ``RemoteData`` depends on its remote path, which is different for every run of the same parent
+    calculation. The hash of the creator of the ``parent_folder`` is used instead, so that the parent folders of two
+    equivalent calculations have the same hash. The content hash of the ``parent_folder`` is used if it has no creator.
+    """
+    creator = parent_folder.creator
+    if creator is None:
+        return parent_folder.base.caching.compute_hash()
+    return creator.base.caching.get_hash() or creator.base.caching.compute_hash()
+
+
+def get_file_content_hash(node):
+    """Return the hash of the files of a Wannier file input, independent of the names of the files.
+
+    The files are written with fixed names in the working directory, so only their content and the attributes other
+    than the ``filename`` matter. The keys of the files in the repository are the hashes of their content.
+    """
+    repository = node.base.repository
+    keys = sorted(
+        repository.get_object(PurePosixPath(dirpath, filename)).key
+        for dirpath, _, filenames in repository.walk()
+        for filename in filenames
+    )
+    attributes = {key: value for key, value in node.base.attributes.items() if key != 'filename'}
+    return make_hash({'class': str(node.__class__), 'attributes': attributes, 'files': keys})
+
+
+class KcwCalculationNodeCaching(CalcJobNodeCaching):
+    """Interface to control the caching of a ``KcwCalculationNode``.
+
+    The ``parent_folder`` inputs are hashed through the hash of the calculation that created them, see
+    ``get_parent_folder_hash``, and the Wannier files inputs through the content of their files, see
+    ``get_file_content_hash``. Two calculations with the same parameters, reading
+    the outputs of equivalent parent calculations, therefore have the same hash, and the cached one is reused.
+    """
+
+    _hash_ignored_inputs = CalcJobNodeCaching._hash_ignored_inputs + ['parent_folder']
+
+    def get_objects_to_hash(self):
+        """Return the objects included in the hash, with the ``parent_folder`` and Wannier files hashed by content."""
+        objects = super().get_objects_to_hash()
+
+        for entry in self._node.base.links.get_incoming(link_type=(LinkType.INPUT_CALC, LinkType.INPUT_WORK)):
+            name = entry.link_label.rsplit('__', 1)[-1]
+            if name == 'parent_folder':
+                objects['inputs'][entry.link_label] = get_parent_folder_hash(entry.node)
+            elif name.startswith('wann_'):
+                objects['inputs'][entry.link_label] = get_file_content_hash(entry.node)
+
+        return objects
+
+
+class KcwCalculationNode(orm.CalcJobNode):
+    """``CalcJobNode`` of the ``KcwCalculation``, with the hashing policy of the ``KcwCalculationNodeCaching``."""
+
+    _CLS_NODE_CACHING = KcwCalculationNodeCaching
+
+
 class KcwCalculation(NamelistsCalculation):
     """`CalcJob` implementation for the kcw.x code of Quantum ESPRESSO.
 
@@ -23,17 +139,47 @@ class KcwCalculation(NamelistsCalculation):
     ]
 
     _default_parser = 'koopmans'
+    _node_class = KcwCalculationNode
 
     xml_path = Path(NamelistsCalculation._default_parent_output_folder
                     ).joinpath(f'{NamelistsCalculation._PREFIX}.save', 'data-file-schema.xml')
+    _alpha_files = {
+        'occ': 'file_alpharef.txt',
+        'emp': 'file_alpharef_empty.txt',
+    }
+    # The inputs with the screening parameters of each manifold, copied in the files read by a `ham` calculation.
+    _alpha_file_inputs = {
+        'alpha_file': 'occ',
+        'alpha_emp_file': 'emp',
+    }
     _internal_retrieve_list = [
         NamelistsCalculation._PREFIX + '.pdos*',
-    ]
+    ] + list(_alpha_files.values())
+    # The real-space Koopmans Hamiltonian written by the `ham` calculation, stored as arrays by the parser.
+    hr_filename = f'{NamelistsCalculation._PREFIX}.kcw_hr.dat'
     # The XML file is added to the temporary retrieve list since it is required for parsing, but already in the
-    # repository of a an ancestor calculation.
+    # repository of a an ancestor calculation. The Hamiltonian is only needed in the repository in its parsed form.
     _retrieve_temporary_list = [
         xml_path.as_posix(),
+        hr_filename,
     ]
+    # The subfolders of the output folder that are only read by kcw.x (the pw.x save folder, with the wavefunctions,
+    # charge density and pseudopotentials) and written by kcw.x (the Wannier orbitals and response of the `kcw` folder).
+    _read_only_subfolders = [f'{NamelistsCalculation._PREFIX}.save']
+    _written_subfolders = ['kcw']
+    # The files of the parent output folder read by each `calculation` of kcw.x, as paths or globs relative to the
+    # output folder, copied instead of the whole folder with the `selective_parent_copy` option. The `ham` step only
+    # needs the Wannier orbitals of the `kcw` folder, and not the Kohn-Sham wavefunctions of the save folder.
+    _parent_folder_manifests = {
+        'wann2kcw': [f'{NamelistsCalculation._PREFIX}.save/*'],
+        'screen': [f'{NamelistsCalculation._PREFIX}.save/*', 'kcw'],
+        'ham': [
+            f'{NamelistsCalculation._PREFIX}.save/data-file-schema.xml',
+            f'{NamelistsCalculation._PREFIX}.save/charge-density*',
+            f'{NamelistsCalculation._PREFIX}.save/*.[uU][pP][fF]',
+            'kcw',
+        ],
+    }
 
     @classmethod
     def define(cls, spec):
@@ -42,25 +188,60 @@ class KcwCalculation(NamelistsCalculation):
         from aiida.orm import BandsData, ProjectionData
         super().define(spec)
         spec.input('parent_folder', valid_type=(orm.RemoteData, orm.FolderData), help='The output folder of a pw.x calculation')
+        spec.input('kpoints', valid_type=orm.KpointsData, required=False,
+            help='The k-points (in crystal coordinates) along which the bands are interpolated by a ham calculation '
+                 'with `do_bands`, written in the `K_POINTS` card. The labels are kept in the `bands` output.')
         #spec.input('wann_occ_hr', valid_type=SingleFileData, help='wann_occ_hr', required=False)
         #spec.input('wann_emp_hr', valid_type=SingleFileData, help='wann_emp_hr', required=False)
-        spec.input('wann_u_mat', valid_type=SingleFileData, help='wann_occ_u', required=False)
-        spec.input('wann_emp_u_mat', valid_type=SingleFileData, help='wann_emp_u', required=False)
-        spec.input('wann_emp_u_dis_mat', valid_type=SingleFileData, help='wann_dis_u', required=False)
+        spec.input('wann_u_mat', valid_type=(SingleFileData, WannierUMatrixData), help='wann_occ_u', required=False)
+        spec.input('wann_emp_u_mat', valid_type=(SingleFileData, WannierUMatrixData), help='wann_emp_u', required=False)
+        spec.input('wann_emp_u_dis_mat', valid_type=(SingleFileData, WannierUMatrixData), help='wann_dis_u',
+                   required=False)
         spec.input('wann_centres_xyz', valid_type=SingleFileData, help='wann_occ_centres', required=False)
         spec.input('wann_emp_centres_xyz', valid_type=SingleFileData, help='wann_emp_centres', required=False)
+        spec.input('alpha_file', valid_type=SingleFileData, required=False,
+            help='The screening parameters of the occupied orbitals, i.e. the `file_alpharef.txt` written by a screen '
+                 'calculation, read by a ham calculation.')
+        spec.input('alpha_emp_file', valid_type=SingleFileData, required=False,
+            help='The screening parameters of the empty orbitals, i.e. the `file_alpharef_empty.txt` written by a '
+                 'screen calculation, read by a ham calculation.')
         spec.input('settings', valid_type=orm.Dict, required=True, default=lambda: orm.Dict({
             'CMDLINE': ["-in", cls._DEFAULT_INPUT_FILE],
-            }), help='Use an additional node for special settings',) #validator=validate_parameters,)
+            }), help='Use an additional node for special settings', validator=validate_settings)
+        spec.input('metadata.options.without_xml', valid_type=bool, required=False,
+            help='If set to `True` the XML of the parent calculation is not retrieved, and the parser takes the '
+                 'structure, k-points and spin settings from the outputs of the `PwCalculation` that created the '
+                 '`parent_folder`.')
+        spec.input('metadata.options.selective_parent_copy', valid_type=bool, required=False,
+            help='If set to `True` only the files of the parent output folder that are read by the `calculation` of '
+                 'kcw.x are copied, instead of the whole folder.')
 
         spec.output('output_parameters', valid_type=orm.Dict, required=False)
         spec.output('bands', valid_type=BandsData, required=False)
+        spec.output('alphas', valid_type=orm.ArrayData, required=False,
+            help='The screening parameters `alphas` of the orbitals with indices `orbital_indices`, and the `occupied` '
+                 'flag of each orbital.')
+        spec.output('hamiltonian', valid_type=orm.ArrayData, required=False,
+            help='The real-space Koopmans Hamiltonian: the complex `hamiltonian` with shape (nR, nw, nw), the '
+                 '`r_vectors` and their `degeneracies`. With the `hamiltonian_cutoff` parser option, only the elements '
+                 'larger than the cutoff are stored, as `values` at the (iR, m, n) `indices`.')
+        spec.output('pdos', valid_type=orm.ArrayData, required=False,
+            help='The content of the `pdos_tot` file: the `energy` grid (eV), and the total `dos` and the sum of the '
+                 'projected `pdos` with shape (nE, nspin).')
+        spec.output('dos', valid_type=orm.ArrayData, required=False,
+            help='The DOS `dos_ks` and `dos_ki` of the band energies of a ham calculation on the `energy` grid (eV), '
+                 'broadened with the Gaussian of width `dos_degauss` of the parser options.')
+        spec.output('performance', valid_type=orm.Dict, required=False,
+            help='The timing and memory report of kcw.x: the `calculation` type, the total wall and CPU times, the '
+                 '`clocks` of the routines, the parallelisation and the estimated dynamical memory.')
         spec.default_output_node = 'output_parameters'
 
         spec.exit_code(301, 'ERROR_NO_RETRIEVED_TEMPORARY_FOLDER',
             message='The retrieved temporary folder could not be accessed.')
         spec.exit_code(303, 'ERROR_OUTPUT_XML_MISSING',
             message='The retrieved folder did not contain the required XML file.')
+        spec.exit_code(304, 'ERROR_PARENT_CALCULATION_OUTPUTS',
+            message='The structure, k-points and spin settings could not be obtained from the parent calculation.')
         spec.exit_code(320, 'ERROR_OUTPUT_XML_READ',
             message='The XML output file could not be read.')
         spec.exit_code(321, 'ERROR_OUTPUT_XML_PARSE',
@@ -71,15 +252,150 @@ class KcwCalculation(NamelistsCalculation):
             message='The pdos_tot file could not be read from the retrieved folder.')
         spec.exit_code(340, 'ERROR_PARSING_PROJECTIONS',
             message='An exception was raised parsing bands and projections.')
+        spec.exit_code(350, 'ERROR_READING_ALPHA_FILE',
+            message='The file with the screening parameters could not be read: {exception}')
+        spec.exit_code(360, 'ERROR_READING_HAMILTONIAN_FILE',
+            message='The file with the real-space Hamiltonian could not be read: {exception}')
+        spec.exit_code(370, 'ERROR_COMPUTING_DOS',
+            message='The broadened DOS could not be computed from the band energies: {exception}')
+        spec.exit_code(400, 'ERROR_OUT_OF_WALLTIME',
+            message='The calculation stopped prematurely because it ran out of walltime.')
         # yapf: enable
 
+    def _split_parent_folder_symlink(self, folder, calcinfo):
+        """Replace the symlink to the whole parent output folder by symlinks and copies of its subfolders.
+
+        :param folder: the sandbox folder, in which the output folder is created.
+        :param calcinfo: the ``CalcInfo`` returned by ``NamelistsCalculation.prepare_for_submission``, updated in place.
+        """
+        remote_symlink_list = []
+        for computer_uuid, remote_path, target in calcinfo.remote_symlink_list:
+            if Path(target) != Path(self._OUTPUT_SUBFOLDER):
+                remote_symlink_list.append((computer_uuid, remote_path, target))
+                continue
+            for subfolder in self._read_only_subfolders:
+                remote_symlink_list.append(
+                    (computer_uuid, str(Path(remote_path) / subfolder), str(Path(target) / subfolder))
+                )
+            for subfolder in self._written_subfolders:
+                calcinfo.remote_copy_list.append(
+                    (computer_uuid, str(Path(remote_path) / subfolder), str(Path(target) / subfolder))
+                )
+            folder.get_subfolder(self._OUTPUT_SUBFOLDER, create=True)
+
+        calcinfo.remote_symlink_list = remote_symlink_list
+
+    @staticmethod
+    def get_calculation(parameters):
+        """Return the ``calculation`` of the ``CONTROL`` namelist of a ``Dict`` of parameters, or None."""
+        namelists = {key.upper(): value for key, value in parameters.get_dict().items()}
+        control = {key.lower(): value for key, value in namelists.get('CONTROL', {}).items()}
+        return control.get('calculation', None)
+
+    @staticmethod
+    def validate_kpoints(parameters, calculation=None):
+        """Return an error message if the ``kpoints`` input would not be read by kcw.x, or None.
+
+        The ``K_POINTS`` card is only read by a ``ham`` calculation with the ``do_bands`` of the ``HAM`` namelist.
+
+        :param parameters: the dictionary of namelists of the calculation, whatever the case of the keys.
+        :param calculation: the ``calculation`` if not specified in the ``CONTROL`` namelist.
+        """
+        namelists = {key.upper(): {name.lower(): value for name, value in namelist.items()}
+                     for key, namelist in parameters.items()}
+        calculation = namelists.get('CONTROL', {}).get('calculation', calculation)
+        if calculation != 'ham' or not namelists.get('HAM', {}).get('do_bands', False):
+            return 'the `kpoints` are only read by a `ham` calculation with `do_bands` in the `HAM` namelist.'
+        return None
+
+    def _get_parent_folder_manifest(self):
+        """Return the paths and globs of the parent output folder read by the step, or None if it has no manifest."""
+        if 'parameters' not in self.inputs:
+            return None
+        return self._parent_folder_manifests.get(self.get_calculation(self.inputs.parameters), None)
+
+    def _filter_parent_folder_copy(self, folder, calcinfo):
+        """Replace the copy of the whole parent output folder by copies of the files in the manifest of the step.
+
+        The copy is left unchanged if the ``calculation`` of the ``parameters`` has no manifest.
+
+        :param folder: the sandbox folder, in which the target folders of the copies are created.
+        :param calcinfo: the ``CalcInfo`` returned by ``NamelistsCalculation.prepare_for_submission``, updated in place.
+        """
+        manifest = self._get_parent_folder_manifest()
+        if manifest is None:
+            return
+
+        remote_copy_list = []
+        for computer_uuid, remote_path, target in calcinfo.remote_copy_list:
+            if Path(target) != Path(self._OUTPUT_SUBFOLDER):
+                remote_copy_list.append((computer_uuid, remote_path, target))
+                continue
+            for pattern in manifest:
+                # The matches of a glob are copied in the target folder, that must already exist
+                if has_magic(pattern):
+                    destination = Path(target) / Path(pattern).parent
+                    folder.get_subfolder(str(destination), create=True)
+                else:
+                    destination = Path(target) / pattern
+                    folder.get_subfolder(str(destination.parent), create=True)
+                remote_copy_list.append((computer_uuid, str(Path(remote_path) / pattern), str(destination)))
+
+        calcinfo.remote_copy_list = remote_copy_list
+
+    @staticmethod
+    def generate_kpoints_card(kpoints):
+        """Return the ``K_POINTS`` card with the explicit list of k-points in crystal coordinates."""
+        kpoints_list = kpoints.get_kpoints()
+        lines = ['K_POINTS crystal', f'{len(kpoints_list)}']
+        lines += [f'  {kx:.10f} {ky:.10f} {kz:.10f} 1.0' for kx, ky, kz in kpoints_list]
+        return '\n'.join(lines) + '\n'
+
     def prepare_for_submission(self, folder):
+        """Prepare the calculation job for submission, see ``NamelistsCalculation.prepare_for_submission``.
+
+        With the ``PARENT_FOLDER_SYMLINK`` key of the ``settings`` and a ``RemoteData`` as ``parent_folder``, only the
+        read-only subfolders of the parent output folder are symlinked, and the subfolders written by kcw.x are copied,
+        so that the files of the parent calculation are never modified.
+        """
         calcinfo = super().prepare_for_submission(folder)
 
+        if calcinfo.remote_symlink_list:
+            self._split_parent_folder_symlink(folder, calcinfo)
+
+        if self.inputs.metadata.options.get('selective_parent_copy', False):
+            self._filter_parent_folder_copy(folder, calcinfo)
+
+        if 'kpoints' in self.inputs and 'parameters' in self.inputs:
+            error = self.validate_kpoints(self.inputs.parameters.get_dict())
+            if error is not None:
+                raise exceptions.InputValidationError(error)
+            with folder.open(self.inputs.metadata.options.input_filename, 'a') as handle:
+                handle.write(self.generate_kpoints_card(self.inputs.kpoints))
+
+        if self.inputs.metadata.options.get('without_xml', False):
+            if get_parent_pw_calculation(self.inputs.parent_folder) is None:
+                raise exceptions.InputValidationError(
+                    'the `without_xml` option requires a `parent_folder` created by a `PwCalculation`.'
+                )
+            calcinfo.retrieve_temporary_list = [
+                item for item in calcinfo.retrieve_temporary_list if item != self.xml_path.as_posix()
+            ]
+
         for wann_file in ['wann_u_mat','wann_emp_u_mat','wann_emp_u_dis_mat','wann_centres_xyz','wann_emp_centres_xyz']:
             if hasattr(self.inputs,wann_file):
                 wannier_singelfiledata = getattr(self.inputs, wann_file)
-                calcinfo.local_copy_list.append((wannier_singelfiledata.uuid, wannier_singelfiledata.filename, wann_file.replace("_mat",".mat").replace("_xyz",".xyz").replace("wann","aiida")))
+                target = wann_file.replace("_mat",".mat").replace("_xyz",".xyz").replace("wann","aiida")
+                if isinstance(wannier_singelfiledata, WannierUMatrixData):
+                    # The matrices are stored as arrays: write them in the Wannier90 text format read by kcw.x
+                    with folder.open(target, 'w') as handle:
+                        wannier_singelfiledata.write_wannier90(handle)
+                else:
+                    calcinfo.local_copy_list.append((wannier_singelfiledata.uuid, wannier_singelfiledata.filename, target))
 
+        for name, manifold in self._alpha_file_inputs.items():
+            if name in self.inputs:
+                node = self.inputs[name]
+                calcinfo.local_copy_list.append((node.uuid, node.filename, self._alpha_files[manifold]))
 
         return calcinfo
\ No newline at end of file
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""`CalcJob` implementation running several steps of kcw.x one after the other, within a single job."""
+import copy
+from fnmatch import fnmatch
+
+from aiida import orm
+from aiida.common import exceptions
+from aiida.common.datastructures import CodeRunMode
+from aiida.engine.processes.calcjobs.calcjob import validate_calc_job
+from aiida_quantumespresso.calculations import _lowercase_dict, _uppercase_dict
+
+from aiida_koopmans.calculations.kcw import KcwCalculation
+
+
+def validate_steps(value, ctx):
+    """Validate the inputs of the ``CalcJob``, see ``validate_calc_job``, and that at least one step is specified."""
+    error = validate_calc_job(value, ctx)
+    if error is not None:
+        return error
+
+    if not KcwChainCalculation.get_steps(value):
+        return f'at least one of the steps {", ".join(KcwChainCalculation._step_outputs)} should be specified.'
+
+
+class KcwChainCalculation(KcwCalculation):
+    """`CalcJob` implementation running the wann2kcw, screen and ham steps of kcw.x in the same working directory.
+
+    The input files of the steps are written in the same sandbox and run in sequence by the same job, so that the job
+    waits only once in the queue and the parent folder and Wannier files are staged only once. Each step reads the
+    files written by the previous ones in the output folder. The outputs of each step are attached in the namespace of
+    the step, and the ``output_parameters`` summarise the whole job.
+    """
+
+    _default_parser = 'koopmans.chain'
+
+    # The outputs of the `KcwCalculation` that are produced by each step, in the order in which the steps are run
+    _step_outputs = {
+        'wann2kcw': ('output_parameters', 'performance'),
+        'screen': ('output_parameters', 'performance', 'alphas'),
+        'ham': ('output_parameters', 'performance', 'bands', 'hamiltonian', 'dos', 'pdos'),
+    }
+
+    @classmethod
+    def define(cls, spec):
+        """Define the process specification."""
+        # yapf: disable
+        super().define(spec)
+        spec.inputs.pop('parameters')
+        step_outputs = {name: spec.outputs.pop(name) for name in set().union(*cls._step_outputs.values())}
+
+        for step, names in cls._step_outputs.items():
+            spec.input_namespace(step, required=False, help=f'The inputs of the {step} step.')
+            spec.input(f'{step}.parameters', valid_type=orm.Dict,
+                help=f'The namelists of the {step} step, with `{step}` as `calculation` of the `CONTROL` namelist.')
+            spec.output_namespace(step, required=False, help=f'The outputs of the {step} step.')
+            for name in names:
+                spec.output(f'{step}.{name}', valid_type=step_outputs[name].valid_type, required=False,
+                    help=step_outputs[name].help)
+        spec.inputs.validator = validate_steps
+
+        spec.output('output_parameters', valid_type=orm.Dict, required=False,
+            help='The summary of the job: the `steps` that were run, the `code_version` and the total '
+                 '`wall_time_seconds`.')
+        spec.default_output_node = 'output_parameters'
+        # yapf: enable
+
+    @classmethod
+    def get_step_filenames(cls, step):
+        """Return the names of the input and output files of a step."""
+        return f'{cls._PREFIX}.{step}.in', f'{cls._PREFIX}.{step}.out'
+
+    @classmethod
+    def get_steps(cls, inputs):
+        """Return the steps with ``parameters`` in the ``inputs``, in the order in which they are run."""
+        return [step for step in cls._step_outputs if step in inputs and 'parameters' in inputs[step]]
+
+    def _get_parent_folder_manifest(self):
+        """Return the paths and globs of the parent output folder read by the chain.
+
+        The steps after the first one read the folders written by kcw.x from the previous steps, so only the read-only
+        files of their manifests are needed from the parent. Paths matched by a glob of the manifest are dropped.
+        """
+        steps = self.get_steps(self.inputs)
+        patterns = list(self._parent_folder_manifests[steps[0]])
+        for step in steps[1:]:
+            patterns += [
+                pattern for pattern in self._parent_folder_manifests[step]
+                if pattern not in self._written_subfolders and pattern not in patterns
+            ]
+        return [
+            pattern for pattern in patterns
+            if not any(other != pattern and fnmatch(pattern, other) for other in patterns)
+        ]
+
+    def prepare_for_submission(self, folder):
+        """Prepare the calculation job for submission, writing the input file and the ``CodeInfo`` of each step.
+
+        The parent folder and the Wannier files are staged as by the ``KcwCalculation``, and the ``K_POINTS`` card of
+        the ``kpoints`` input is written in the input file of the ``ham`` step.
+        """
+        steps = self.get_steps(self.inputs)
+        if 'kpoints' in self.inputs:
+            error = 'the `kpoints` require a ham step.'
+            if 'ham' in steps:
+                error = self.validate_kpoints(self.inputs.ham.parameters.get_dict(), 'ham')
+            if error is not None:
+                raise exceptions.InputValidationError(error)
+
+        calcinfo = super().prepare_for_submission(folder)
+
+        input_filename = self.inputs.metadata.options.input_filename
+        output_filename = self.inputs.metadata.options.output_filename
+        folder.remove_path(input_filename)
+        codeinfo = calcinfo.codes_info[0]
+
+        calcinfo.codes_info = []
+        calcinfo.retrieve_list = [item for item in calcinfo.retrieve_list if item != output_filename]
+
+        for step in steps:
+            step_input_filename, step_output_filename = self.get_step_filenames(step)
+
+            parameters = _uppercase_dict(self.inputs[step].parameters.get_dict(), dict_name='parameters')
+            parameters = {key: _lowercase_dict(value, dict_name=key) for key, value in parameters.items()}
+            control = parameters.setdefault('CONTROL', {})
+            if control.setdefault('calculation', step) != step:
+                raise exceptions.InputValidationError(
+                    f"The `calculation` of the {step} step should be '{step}', not '{control['calculation']}'."
+                )
+            parameters = self.set_blocked_keywords(parameters)
+            parameters = self.filter_namelists(parameters, self._default_namelists)
+
+            with folder.open(step_input_filename, 'w') as handle:
+                handle.write(self.generate_input_file(parameters))
+                if step == 'ham' and 'kpoints' in self.inputs:
+                    handle.write(self.generate_kpoints_card(self.inputs.kpoints))
+
+            step_codeinfo = copy.deepcopy(codeinfo)
+            step_codeinfo.cmdline_params = [
+                step_input_filename if param == input_filename else param for param in codeinfo.cmdline_params
+            ]
+            step_codeinfo.stdin_name = step_input_filename
+            step_codeinfo.stdout_name = step_output_filename
+            calcinfo.codes_info.append(step_codeinfo)
+            calcinfo.retrieve_list.append(step_output_filename)
+
+        calcinfo.codes_run_mode = CodeRunMode.SERIAL
+
+        return calcinfo
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""`CalcJob` implementation packing several independent kcw.x calculations in a single job."""
+from pathlib import PurePosixPath
+
+from aiida import orm
+from aiida.common import datastructures, exceptions
+from aiida.common.escaping import escape_for_bash
+from aiida.engine.processes.calcjobs.calcjob import validate_calc_job
+from aiida_quantumespresso.calculations import _lowercase_dict, _pop_parser_options, _uppercase_dict
+
+from aiida_koopmans.calculations.kcw import KcwCalculation, SingleFileData
+from aiida_koopmans.data.wannier90 import WannierUMatrixData
+
+# The inputs of each packed calculation, with the same meaning as the corresponding inputs of the `KcwCalculation`
+_CALCULATION_INPUTS = {
+    'parameters': (orm.Dict,),
+    'parent_folder': (orm.RemoteData, orm.FolderData),
+    'kpoints': (orm.KpointsData,),
+    'wann_u_mat': (SingleFileData, WannierUMatrixData),
+    'wann_emp_u_mat': (SingleFileData, WannierUMatrixData),
+    'wann_emp_u_dis_mat': (SingleFileData, WannierUMatrixData),
+    'wann_centres_xyz': (SingleFileData,),
+    'wann_emp_centres_xyz': (SingleFileData,),
+    'alpha_file': (SingleFileData,),
+    'alpha_emp_file': (SingleFileData,),
+}
+
+
+def validate_calculations(value, _):
+    """Validate the inputs of the packed calculations."""
+    if not value:
+        return 'at least one calculation should be specified.'
+
+    for label, inputs in value.items():
+        if not isinstance(inputs, dict):
+            return f'the inputs of the calculation `{label}` should be a namespace.'
+        for key in ('parameters', 'parent_folder'):
+            if key not in inputs:
+                return f'the calculation `{label}` does not specify the required `{key}` input.'
+        for key, node in inputs.items():
+            if key not in _CALCULATION_INPUTS:
+                return f'the calculation `{label}` has the unsupported input `{key}`.'
+            if not isinstance(node, _CALCULATION_INPUTS[key]):
+                return f'the `{key}` input of the calculation `{label}` has the wrong type `{type(node).__name__}`.'
+        if 'kpoints' in inputs:
+            error = KcwCalculation.validate_kpoints(inputs['parameters'].get_dict())
+            if error is not None:
+                return f'calculation `{label}`: {error}'
+
+
+def validate_inputs(value, ctx):
+    """Validate the inputs of the ``CalcJob``, see ``validate_calc_job``, and the options supported by the packing.
+
+    The packed calculations are launched by the ``append_text`` of the ``CalcInfo``, which the engine writes after the
+    ``append_text`` of the ``metadata.options`` in the job script, so the latter would run before the calculations.
+    The calculations are launched without host placement, so they would all run on the first machine of the job.
+    """
+    error = validate_calc_job(value, ctx)
+    if error is not None:
+        return error
+
+    options = value.get('metadata', {}).get('options', {})
+    if options.get('append_text'):
+        return 'the `metadata.options.append_text` is not supported, since it would run before the packed calculations.'
+    if options.get('resources', {}).get('num_machines', 1) > 1:
+        return 'the packed calculations run on a single machine, the `num_machines` of the resources should be 1.'
+
+
+class KcwPackedCalculation(KcwCalculation):
+    """`CalcJob` implementation running several independent kcw.x calculations concurrently within a single job.
+
+    Each calculation of the ``calculations`` namespace is written in its own subfolder of the working directory, named
+    after its label, and run there in the background with ``num_mpiprocs_per_calculation`` MPI processes, so that many
+    small calculations share a single scheduler allocation, on a single machine. The outputs of each calculation are
+    attached in the namespace of its label.
+    """
+
+    _default_parser = 'koopmans.packed'
+
+    # The outputs of the `KcwCalculation` attached for each packed calculation
+    _calculation_outputs = ('output_parameters', 'performance', 'bands', 'alphas', 'hamiltonian', 'dos', 'pdos')
+
+    @classmethod
+    def define(cls, spec):
+        """Define the process specification."""
+        # yapf: disable
+        super().define(spec)
+        for name in _CALCULATION_INPUTS:
+            spec.inputs.pop(name)
+        spec.input_namespace('calculations', dynamic=True,
+            valid_type=tuple(dict.fromkeys(sum(_CALCULATION_INPUTS.values(), ()))), validator=validate_calculations,
+            help='The inputs of the packed calculations, in a namespace for each calculation: the `parameters` and '
+                 '`parent_folder`, and optionally the `kpoints`, the Wannier files `wann_*` and the screening '
+                 'parameters `alpha_*` of the `KcwCalculation`.')
+        spec.input('metadata.options.num_mpiprocs_per_calculation', valid_type=int, required=False,
+            help='The number of MPI processes of each calculation, by default the total number of MPI processes of '
+                 'the job divided by the number of calculations.')
+        spec.inputs.validator = validate_inputs
+
+        outputs = {name: spec.outputs.pop(name) for name in cls._calculation_outputs}
+        spec.output_namespace('calculations', dynamic=True, valid_type=(orm.Dict, orm.ArrayData),
+            help='The outputs of the packed calculations, in a namespace for each calculation: '
+                 f'{", ".join(f"`{name}`" for name in outputs)}.')
+        spec.output('output_parameters', valid_type=orm.Dict, required=False,
+            help='The summary of the job: the `calculations` that completed and the ones that `failed`, with their '
+                 'exit status.')
+        spec.default_output_node = 'output_parameters'
+
+        spec.exit_code(410, 'ERROR_PACKED_CALCULATIONS_FAILED',
+            message='The packed calculations {labels} failed, see the `failed` of the `output_parameters`.')
+        # yapf: enable
+
+    @classmethod
+    def get_labels(cls, inputs):
+        """Return the labels of the packed calculations, in the order in which they are launched."""
+        return sorted(inputs['calculations'])
+
+    def _get_mpi_args(self, num_mpiprocs):
+        """Return the MPI command of the computer for a calculation with the given number of MPI processes."""
+        subst_dict = dict(self.inputs.metadata.options.resources)
+        subst_dict.update(tot_num_mpiprocs=num_mpiprocs, num_machines=1, num_mpiprocs_per_machine=num_mpiprocs)
+        return [arg.format(**subst_dict) for arg in self.node.computer.get_mpirun_command()]
+
+    def _get_num_mpiprocs(self, num_calculations):
+        """Return the number of MPI processes of each calculation."""
+        options = self.inputs.metadata.options
+        if 'num_mpiprocs_per_calculation' in options:
+            return options.num_mpiprocs_per_calculation
+
+        resources = options.resources
+        total = resources.get('tot_num_mpiprocs', None)
+        if total is None:
+            total = resources.get('num_machines', 1) * resources.get(
+                'num_mpiprocs_per_machine', self.node.computer.get_default_mpiprocs_per_machine() or 1
+            )
+        return max(1, total // num_calculations)
+
+    def _write_calculation(self, folder, label, inputs, calcinfo):
+        """Write the input files of a packed calculation in its subfolder, and add its files to stage and retrieve."""
+        subfolder = folder.get_subfolder(label, create=True)
+
+        parameters = _uppercase_dict(inputs['parameters'].get_dict(), dict_name='parameters')
+        parameters = {key: _lowercase_dict(value, dict_name=key) for key, value in parameters.items()}
+        parameters = self.set_blocked_keywords(parameters)
+        parameters = self.filter_namelists(parameters, self._default_namelists)
+
+        with subfolder.open(self._DEFAULT_INPUT_FILE, 'w') as handle:
+            handle.write(self.generate_input_file(parameters))
+            if 'kpoints' in inputs:
+                handle.write(self.generate_kpoints_card(inputs['kpoints']))
+
+        parent_folder = inputs['parent_folder']
+        output_subfolder = str(PurePosixPath(label, self._OUTPUT_SUBFOLDER))
+        if isinstance(parent_folder, orm.RemoteData):
+            remote_path = str(PurePosixPath(parent_folder.get_remote_path(), self._default_parent_output_folder))
+            calcinfo.remote_copy_list.append((parent_folder.computer.uuid, remote_path, output_subfolder))
+        else:
+            calcinfo.local_copy_list.append((parent_folder.uuid, self._OUTPUT_SUBFOLDER, output_subfolder))
+
+        for wann_file in [key for key in _CALCULATION_INPUTS if key.startswith('wann')]:
+            if wann_file not in inputs:
+                continue
+            node = inputs[wann_file]
+            target = wann_file.replace('_mat', '.mat').replace('_xyz', '.xyz').replace('wann', 'aiida')
+            if isinstance(node, WannierUMatrixData):
+                with subfolder.open(target, 'w') as handle:
+                    node.write_wannier90(handle)
+            else:
+                calcinfo.local_copy_list.append((node.uuid, node.filename, str(PurePosixPath(label, target))))
+
+        for name, manifold in self._alpha_file_inputs.items():
+            if name in inputs:
+                target = str(PurePosixPath(label, self._alpha_files[manifold]))
+                calcinfo.local_copy_list.append((inputs[name].uuid, inputs[name].filename, target))
+
+        for pattern in [self.inputs.metadata.options.output_filename, *self._internal_retrieve_list]:
+            calcinfo.retrieve_list.append((str(PurePosixPath(label, pattern)), '.', 2))
+        calcinfo.retrieve_temporary_list.append((str(PurePosixPath(label, self.hr_filename)), '.', 2))
+
+    def prepare_for_submission(self, folder):
+        """Prepare the calculation job for submission, writing each packed calculation in its own subfolder.
+
+        The calculations are launched by the lines of the job script added as ``append_text`` of the ``CalcInfo``: each
+        one runs in the background in its subfolder, and the script waits for all of them to finish. The ``CalcInfo``
+        has therefore no ``CodeInfo``, and the ``append_text`` of the ``metadata.options`` is refused by the validator
+        of the inputs. The MPI command is the one of the computer of the job, which is also set for a ``PortableCode``.
+        """
+        if 'settings' in self.inputs:
+            settings = _uppercase_dict(self.inputs.settings.get_dict(), dict_name='settings')
+        else:
+            settings = {}
+        _pop_parser_options(self, settings)
+        cmdline_params = settings.pop('CMDLINE', [])
+        if settings:
+            raise exceptions.InputValidationError(f'`settings` contained unexpected keys: {", ".join(settings)}')
+
+        calcinfo = datastructures.CalcInfo()
+        calcinfo.codes_info = []
+        calcinfo.local_copy_list = []
+        calcinfo.remote_copy_list = []
+        calcinfo.retrieve_list = []
+        calcinfo.retrieve_temporary_list = []
+
+        labels = self.get_labels(self.inputs)
+        for label in labels:
+            self._write_calculation(folder, label, self.inputs.calculations[label], calcinfo)
+
+        code = self.inputs.code
+        options = self.inputs.metadata.options
+        if options.get('withmpi', True):
+            prepend_cmdline_params = code.get_prepend_cmdline_params(
+                self._get_mpi_args(self._get_num_mpiprocs(len(labels))), options.get('mpirun_extra_params', [])
+            )
+        else:
+            prepend_cmdline_params = code.get_prepend_cmdline_params()
+        cmdline_params = prepend_cmdline_params + code.get_executable_cmdline_params(cmdline_params)
+        command = ' '.join(escape_for_bash(param) for param in cmdline_params)
+
+        output_filename = escape_for_bash(options.output_filename)
+        run_lines = [
+            f'(cd {escape_for_bash(label)} && {command} < {self._DEFAULT_INPUT_FILE} > {output_filename} 2>&1) &'
+            for label in labels
+        ]
+        calcinfo.append_text = '\n'.join(run_lines + ['wait'])
+
+        return calcinfo
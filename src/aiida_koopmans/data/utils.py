@@ -1,42 +1,284 @@
-import pathlib
-import tempfile
+import hashlib
+import io
+
+import numpy as np
+
+from aiida.engine import calcfunction
+from aiida.orm import QueryBuilder
 from aiida.plugins import DataFactory
+
+from aiida_koopmans.data import wannier90
 SingleFileData = DataFactory('core.singlefile')
 
+# Extra storing the sha256 of the filename and content of the SingleFileData, used as content-addressed index.
+SHA256_EXTRA_KEY = 'koopmans_sha256'
+_CHUNK_SIZE = 2**20
+
 def generate_singlefiledata(filename, flines):
-    with tempfile.TemporaryDirectory() as dirpath:
-        # Open the output file from the AiiDA storage and copy content to the temporary file
-        temp_file = pathlib.Path(dirpath) / filename
-        with open(temp_file, 'w') as fd:
-            fd.write(''.join(flines))
-        
-        file = SingleFileData(temp_file)
+    """Create a ``SingleFileData`` directly from in-memory content, without going through a temporary file.
+
+    Args:
+        filename (str): name of the file in the repository of the node.
+        flines (bytes, str or list of str): content of the file, as bytes, as a string or as a list of lines.
+
+    Returns:
+        SingleFileData: the (unstored) node.
+    """
+    if isinstance(flines, str):
+        flines = flines.encode('utf-8')
+    elif not isinstance(flines, bytes):
+        flines = ''.join(flines).encode('utf-8')
+
+    return SingleFileData(io.BytesIO(flines), filename=filename)
+
+def generate_singlefiledata_from_retrieved(retrieved, filename):
+    """Create a ``SingleFileData`` streaming the content of a file in the repository of a retrieved folder.
+
+    The file is copied in chunks from the repository object to the node, so its content is never held in memory as a
+    whole and no temporary file is written.
+
+    Args:
+        retrieved (FolderData): the retrieved folder of a calculation.
+        filename (str): name of the file in the retrieved folder, also used as name of the file in the new node.
+
+    Returns:
+        SingleFileData: the (unstored) node.
+    """
+    with retrieved.base.repository.open(filename, 'rb') as handle:
+        return SingleFileData(handle, filename=filename)
+
+def get_sha256(handle, filename):
+    """Return the sha256 hexdigest of a filename and of the content of a binary handle, reading it in chunks.
+
+    Args:
+        handle (filelike): binary handle, read until the end.
+        filename (str): the filename, that is hashed together with the content.
+
+    Returns:
+        str: the hexdigest.
+    """
+    sha256 = hashlib.sha256(filename.encode('utf-8') + b'\0')
+    for chunk in iter(lambda: handle.read(_CHUNK_SIZE), b''):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+def get_or_create_singlefiledata_from_retrieved(retrieved, filename):
+    """Return a stored ``SingleFileData`` with the content of a file of a retrieved folder, creating it only if needed.
+
+    The sha256 of the filename and content is used as index: if a ``SingleFileData`` with the same hash was already
+    produced, e.g. by a previous wann2kcw, screen or ham step or by a previous workflow, that node is returned and the
+    content is stored in the repository only once.
+
+    Args:
+        retrieved (FolderData): the retrieved folder of a calculation.
+        filename (str): name of the file in the retrieved folder, also used as name of the file in the node.
+
+    Returns:
+        SingleFileData: the stored node.
+    """
+    with retrieved.base.repository.open(filename, 'rb') as handle:
+        sha256 = get_sha256(handle, filename)
+
+    query = QueryBuilder().append(SingleFileData, filters={f'extras.{SHA256_EXTRA_KEY}': sha256}, subclassing=False)
+    existing = query.first(flat=True)
+    if existing is not None:
+        return existing
+
+    node = generate_singlefiledata_from_retrieved(retrieved, filename)
+    node.base.extras.set(SHA256_EXTRA_KEY, sha256)
+    return node.store()
+
+def _get_blocks(files, label):
+    """Return the ``SingleFileData`` of the blocks with link labels ``{label}_{index}``, sorted by index."""
+    prefix = f'{label}_'
+    blocks = {int(key[len(prefix):]): node for key, node in files.items() if key.startswith(prefix)}
+    return [blocks[index] for index in sorted(blocks)]
+
+def merge_u_matrices(u_matrices):
+    """Merge the U matrix files of the blocks in the block-diagonal U matrix file of all the blocks.
+
+    Args:
+        u_matrices (list of SingleFileData): the ``_u.mat`` (or ``_u_dis.mat``) files of the blocks.
+
+    Returns:
+        str: the content of the merged file.
+    """
+    blocks = []
+    for u_matrix in u_matrices:
+        with u_matrix.open(mode='rb') as handle:
+            blocks.append(wannier90.read_u_matrix(handle))
+
+    header_lines, separator, kpoints, _ = blocks[0]
+    for _, _, block_kpoints, _ in blocks[1:]:
+        if block_kpoints.shape != kpoints.shape or not np.allclose(block_kpoints, kpoints):
+            raise ValueError('the U matrices of the blocks are not defined on the same k-points.')
+
+    merged = wannier90.block_diagonal([matrices for _, _, _, matrices in blocks])
+    num_kpoints, num_rows, num_wann = merged.shape
+    header_lines = [header_lines[0], wannier90.format_integers(num_kpoints, num_wann, num_rows)]
+
+    handle = io.StringIO()
+    wannier90.write_u_matrix(handle, header_lines, separator, kpoints, merged)
+    return handle.getvalue()
+
+def merge_hr(hrs):
+    """Merge the ``_hr.dat`` files of the blocks in the block-diagonal ``_hr.dat`` file of all the blocks.
+
+    Args:
+        hrs (list of SingleFileData): the ``_hr.dat`` files of the blocks.
+
+    Returns:
+        str: the content of the merged file.
+    """
+    blocks = []
+    for hr in hrs:
+        with hr.open(mode='rb') as handle:
+            blocks.append(wannier90.read_hr(handle))
+
+    header, r_vectors, degeneracies, _ = blocks[0]
+    for _, block_r_vectors, block_degeneracies, _ in blocks[1:]:
+        if not (np.array_equal(block_r_vectors, r_vectors) and np.array_equal(block_degeneracies, degeneracies)):
+            raise ValueError('the Hamiltonians of the blocks are not defined on the same lattice vectors.')
+
+    merged = wannier90.block_diagonal([hamiltonian for _, _, _, hamiltonian in blocks])
+
+    handle = io.StringIO()
+    wannier90.write_hr(handle, header, r_vectors, degeneracies, merged)
+    return handle.getvalue()
+
+def merge_centres(centres):
+    """Merge the ``_centres.xyz`` files of the blocks, concatenating the Wannier centres and keeping the atoms once.
+
+    Args:
+        centres (list of SingleFileData): the ``_centres.xyz`` files of the blocks.
+
+    Returns:
+        str: the content of the merged file.
+    """
+    merged = []
+    for index, node in enumerate(centres):
+        with node.open(mode='rb') as handle:
+            comment, block_centres, block_atoms = wannier90.read_centres(handle)
+        if index == 0:
+            first_comment, atoms = comment, block_atoms
+        merged.extend(block_centres)
+
+    handle = io.StringIO()
+    wannier90.write_centres(handle, first_comment, merged, atoms)
+    return handle.getvalue()
+
+@calcfunction
+def merge_wannier90_files(**files):
+    """Merge the Wannier90 files of the blocks of the occupied or empty manifold in the files read by kcw.x.
+
+    The U matrices and Hamiltonians of the blocks are assembled as block-diagonal matrices, the centres are
+    concatenated, in the order of the block index.
+
+    Args:
+        files: the ``SingleFileData`` of the blocks, with link labels ``hr_dat_{index}``, ``u_mat_{index}``,
+            ``centres_xyz_{index}`` and optionally ``u_dis_mat_{index}``. The blocks without ``_u_dis.mat`` file
+            (i.e. without disentanglement) contribute with an identity matrix to the merged one.
+
+    Returns:
+        dict: the merged ``SingleFileData``, with keys ``hr_dat``, ``u_mat``, ``centres_xyz`` and ``u_dis_mat`` if any
+            block has a ``_u_dis.mat`` file.
+    """
+    u_matrices = _get_blocks(files, 'u_mat')
+    merged = {
+        'hr_dat': generate_singlefiledata('aiida_hr.dat', merge_hr(_get_blocks(files, 'hr_dat'))),
+        'u_mat': generate_singlefiledata('aiida_u.mat', merge_u_matrices(u_matrices)),
+        'centres_xyz': generate_singlefiledata('aiida_centres.xyz', merge_centres(_get_blocks(files, 'centres_xyz'))),
+    }
+
+    if any(key.startswith('u_dis_mat_') for key in files):
+        u_dis_matrices = []
+        for index, u_matrix in enumerate(u_matrices):
+            u_dis_matrix = files.get(f'u_dis_mat_{index}')
+            if u_dis_matrix is None:
+                with u_matrix.open(mode='rb') as handle:
+                    header_lines, separator, kpoints, matrices = wannier90.read_u_matrix(handle)
+                identity = np.broadcast_to(np.eye(matrices.shape[-1]), matrices.shape)
+                content = io.StringIO()
+                wannier90.write_u_matrix(content, header_lines, separator, kpoints, identity)
+                u_dis_matrix = generate_singlefiledata('aiida_u_dis.mat', content.getvalue())
+            u_dis_matrices.append(u_dis_matrix)
+        merged['u_dis_mat'] = generate_singlefiledata('aiida_u_dis.mat', merge_u_matrices(u_dis_matrices))
+
+    return merged
+
+@calcfunction
+def extract_wannier90_files(retrieved):
+    """Extract the Wannier90 files read by kcw.x from the retrieved folder of a Wannier90 calculation.
+
+    Contrary to ``get_wannier90_files``, new nodes are always created, linked to the ``retrieved`` folder, so that the
+    provenance of the files is kept when they are extracted within a workchain.
 
-        return file
+    Args:
+        retrieved (FolderData): the retrieved folder of the Wannier90 calculation.
+
+    Returns:
+        dict: the ``SingleFileData`` of the files, with keys ``hr_dat``, ``u_mat``, ``centres_xyz`` and ``u_dis_mat``
+            if the ``_u_dis.mat`` file was retrieved, i.e. if the manifold was disentangled.
+    """
+    files = {'hr_dat': '_hr.dat', 'u_mat': '_u.mat', 'centres_xyz': '_centres.xyz'}
+    if 'aiida_u_dis.mat' in retrieved.base.repository.list_object_names():
+        files['u_dis_mat'] = '_u_dis.mat'
+    return {
+        label: generate_singlefiledata_from_retrieved(retrieved, 'aiida' + suffix) for label, suffix in files.items()
+    }
+
+def get_wannier90_files(w90_wchains, u_dis_mat=False):
+    """Return the Wannier90 files of a manifold wannierized in one or more blocks.
+
+    If the manifold was wannierized in more than one block, the files of the blocks are merged with the
+    ``merge_wannier90_files`` calcfunction.
+
+    Args:
+        w90_wchains (list of WorkflowNode): the finished ``Wannier90BandsWorkChain`` of the blocks.
+        u_dis_mat (bool): whether to also return the ``_u_dis.mat`` file, i.e. for the empty manifold with DFPT.
+
+    Returns:
+        dict: dictionary containing SingleFileData of the files: hr, u and centres, then u_dis if requested.
+            Nodes with the same content as previously produced ones are reused, see
+            ``get_or_create_singlefiledata_from_retrieved``.
+    """
+    if len(w90_wchains) > 1:
+        files = {}
+        for index, w90_wchain in enumerate(w90_wchains):
+            retrieved = w90_wchain.outputs.wannier90.retrieved
+            for label, filename in [('hr_dat', '_hr.dat'), ('u_mat', '_u.mat'), ('centres_xyz', '_centres.xyz')]:
+                files[f'{label}_{index}'] = get_or_create_singlefiledata_from_retrieved(retrieved, 'aiida' + filename)
+            if u_dis_mat and 'aiida_u_dis.mat' in retrieved.base.repository.list_object_names():
+                files[f'u_dis_mat_{index}'] = get_or_create_singlefiledata_from_retrieved(retrieved, 'aiida_u_dis.mat')
+        return merge_wannier90_files(**files)
+
+    retrieved = w90_wchains[0].outputs.wannier90.retrieved
+
+    hr_singlefile = get_or_create_singlefiledata_from_retrieved(retrieved, 'aiida' + '_hr.dat')
+    u_singlefile = get_or_create_singlefiledata_from_retrieved(retrieved, 'aiida' + '_u.mat')
+    centres_singlefile = get_or_create_singlefiledata_from_retrieved(retrieved, 'aiida' + '_centres.xyz')
+
+    standard_dictionary =  {'hr_dat':hr_singlefile, "u_mat": u_singlefile, "centres_xyz": centres_singlefile}
+
+    if u_dis_mat:
+        u_dis_singlefile = get_or_create_singlefiledata_from_retrieved(retrieved, 'aiida' + '_u_dis.mat')
+        standard_dictionary["u_dis_mat"] = u_dis_singlefile
+
+    return standard_dictionary
 
 def produce_wannier90_files(wannierize_workflow,merge_directory_name):
-    """producing the wannier90 files in the case of just one occ and/or one emp blocks.
+    """producing the wannier90 files of the occ and/or emp blocks.
+
+    See ``get_wannier90_files``.
 
     Args:
-        wannierize_workflow (WannierizeWorkflow): WannierizeWorkflow which is doing the splitted wannierization. 
+        wannierize_workflow (WannierizeWorkflow): WannierizeWorkflow which is doing the splitted wannierization.
         merge_directory_name (str): "occ" or "emp", as obtained in the WannierizeWorkflow
-    
+
     Returns:
         dict: dictionary containing SingleFileData of the files: hr, u and centres for occ and emp, then u_dis if dfpt.
     """
-    hr_file = wannierize_workflow.w90_wchains[merge_directory_name][0].outputs.wannier90.retrieved.get_object_content('aiida' + '_hr.dat')
-    u_file = wannierize_workflow.w90_wchains[merge_directory_name][0].outputs.wannier90.retrieved.get_object_content('aiida' + '_u.mat')
-    centres_file = wannierize_workflow.w90_wchains[merge_directory_name][0].outputs.wannier90.retrieved.get_object_content('aiida' + '_centres.xyz')
-    
-    hr_singlefile = generate_singlefiledata('aiida' + '_hr.dat', hr_file)
-    u_singlefile = generate_singlefiledata('aiida' + '_u.mat', u_file)
-    centres_singlefile = generate_singlefiledata('aiida' + '_centres.xyz', centres_file)
-    
-    standard_dictionary =  {'hr_dat':hr_singlefile, "u_mat": u_singlefile, "centres_xyz": centres_singlefile}
-    
-    if wannierize_workflow.parameters.method == 'dfpt' and merge_directory_name == "emp":
-        u_dis_file = wannierize_workflow.w90_wchains[merge_directory_name][0].outputs.wannier90.retrieved.get_object_content('aiida' + '_u_dis.mat')
-        u_dis_singlefile = generate_singlefiledata('aiida' + '_u_dis.mat', u_dis_file)
-        standard_dictionary["u_dis_mat"] = u_dis_singlefile
-        
-    return standard_dictionary
\ No newline at end of file
+    w90_wchains = wannierize_workflow.w90_wchains[merge_directory_name]
+    dfpt_emp = wannierize_workflow.parameters.method == 'dfpt' and merge_directory_name == "emp"
+
+    return get_wannier90_files(w90_wchains, u_dis_mat=dfpt_emp)
@@ -0,0 +1,251 @@
+"""Data types and readers/writers for the files produced by Wannier90 and consumed by kcw.x."""
+import contextlib
+
+import numpy as np
+
+from aiida.orm import ArrayData
+
+# Fortran formats used by Wannier90 to write the k-points, `(f15.10,sp,f15.10,sp,f15.10)`, and the complex matrix
+# elements, `(f15.10,sp,f15.10)`, of the `_u.mat` and `_u_dis.mat` files.
+_KPOINT_FORMAT = '%15.10f%+15.10f%+15.10f'
+_ELEMENT_FORMAT = '%15.10f%+15.10f'
+# Fortran formats used by Wannier90 to write the degeneracies, `(15I5)`, and the matrix elements, `(5I5,2F12.6)`, of
+# the `_hr.dat` file.
+_DEGENERACIES_PER_LINE = 15
+_HR_FORMAT = '%5d%5d%5d%5d%5d%12.6f%12.6f'
+
+
+def format_integers(*values):
+    """Return a line with the integers formatted as by a Fortran list-directed ``write``."""
+    return ''.join(f'{value:12d}' for value in values)
+
+
+def read_u_matrix(handle):
+    """Read a Wannier90 ``_u.mat`` or ``_u_dis.mat`` file.
+
+    The whole table is parsed in one go with NumPy. The matrix elements are written by Wannier90 in column-major order,
+    ``((U(i, j, k), i=1, nrows), j=1, ncols)``, with ``nrows = ncols = num_wann`` for the ``_u.mat`` file and
+    ``nrows = num_bands``, ``ncols = num_wann`` for the ``_u_dis.mat`` file.
+
+    Args:
+        handle (filelike): text or binary handle of the file.
+
+    Returns:
+        tuple: the list of the first two (header and dimensions) lines, the line separating the k-point blocks, the
+            k-points in crystal coordinates with shape ``(nkpts, 3)`` and the complex matrices with shape
+            ``(nkpts, nrows, ncols)``.
+    """
+    content = handle.read()
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+
+    header, dimensions, separator, body = content.split('\n', 3)
+    num_kpoints, num_wann, num_rows = (int(value) for value in dimensions.split())
+
+    values = np.array(body.split(), dtype=float).reshape(num_kpoints, 3 + 2 * num_rows * num_wann)
+    kpoints = values[:, :3]
+    elements = values[:, 3:].reshape(num_kpoints, num_wann, num_rows, 2)
+    matrices = (elements[..., 0] + 1j * elements[..., 1]).transpose(0, 2, 1)
+
+    return [header, dimensions], separator, kpoints, np.ascontiguousarray(matrices)
+
+
+def write_u_matrix(handle, header_lines, separator, kpoints, matrices):
+    """Write a Wannier90 ``_u.mat`` or ``_u_dis.mat`` file, in the format of Wannier90.
+
+    Args:
+        handle (filelike): text handle to write to.
+        header_lines (list of str): the header and dimensions lines, as returned by ``read_u_matrix``.
+        separator (str): the line separating the k-point blocks, as returned by ``read_u_matrix``.
+        kpoints (np.ndarray): the k-points in crystal coordinates, with shape ``(nkpts, 3)``.
+        matrices (np.ndarray): the complex matrices, with shape ``(nkpts, nrows, ncols)``.
+    """
+    handle.write('\n'.join(header_lines) + '\n')
+
+    for kpoint, matrix in zip(kpoints, matrices):
+        handle.write(separator + '\n')
+        handle.write(_KPOINT_FORMAT % tuple(kpoint) + '\n')
+        elements = matrix.ravel(order='F')
+        np.savetxt(handle, np.column_stack((elements.real, elements.imag)), fmt=_ELEMENT_FORMAT)
+
+
+def read_hr(handle):
+    """Read a Wannier90 ``_hr.dat`` file.
+
+    Args:
+        handle (filelike): text or binary handle of the file.
+
+    Returns:
+        tuple: the header line, the lattice vectors with shape ``(nrpts, 3)``, their degeneracies with shape
+            ``(nrpts,)`` and the complex Hamiltonian with shape ``(nrpts, num_wann, num_wann)``.
+    """
+    content = handle.read()
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+
+    header, num_wann, num_rpts, body = content.split('\n', 3)
+    num_wann, num_rpts = int(num_wann), int(num_rpts)
+
+    values = body.split()
+    degeneracies = np.array(values[:num_rpts], dtype=int)
+    elements = np.array(values[num_rpts:], dtype=float).reshape(num_rpts, num_wann * num_wann, 7)
+
+    # The elements are written with the row index running fastest
+    r_vectors = elements[:, 0, :3].astype(int)
+    hamiltonian = (elements[..., 5] + 1j * elements[..., 6]).reshape(num_rpts, num_wann, num_wann).transpose(0, 2, 1)
+
+    return header, r_vectors, degeneracies, np.ascontiguousarray(hamiltonian)
+
+
+def write_hr(handle, header, r_vectors, degeneracies, hamiltonian):
+    """Write a Wannier90 ``_hr.dat`` file, in the format of Wannier90.
+
+    Args:
+        handle (filelike): text handle to write to.
+        header (str): the header line.
+        r_vectors (np.ndarray): the lattice vectors, with shape ``(nrpts, 3)``.
+        degeneracies (np.ndarray): the degeneracies of the lattice vectors, with shape ``(nrpts,)``.
+        hamiltonian (np.ndarray): the complex Hamiltonian, with shape ``(nrpts, num_wann, num_wann)``.
+    """
+    num_rpts, num_wann, _ = hamiltonian.shape
+    handle.write(f'{header}\n{format_integers(num_wann)}\n{format_integers(num_rpts)}\n')
+
+    for start in range(0, num_rpts, _DEGENERACIES_PER_LINE):
+        handle.write(''.join(f'{value:5d}' for value in degeneracies[start:start + _DEGENERACIES_PER_LINE]) + '\n')
+
+    # Columns: R vector, row and column indices (1-based, row index running fastest), real and imaginary parts
+    columns, rows = np.meshgrid(np.arange(1, num_wann + 1), np.arange(1, num_wann + 1), indexing='ij')
+    elements = hamiltonian.transpose(0, 2, 1).reshape(num_rpts, -1)
+    table = np.column_stack((
+        np.repeat(r_vectors, num_wann * num_wann, axis=0),
+        np.tile(rows.ravel(), num_rpts),
+        np.tile(columns.ravel(), num_rpts),
+        elements.real.ravel(),
+        elements.imag.ravel(),
+    ))
+    np.savetxt(handle, table, fmt=_HR_FORMAT)
+
+
+def read_centres(handle):
+    """Read a Wannier90 ``_centres.xyz`` file.
+
+    Args:
+        handle (filelike): text or binary handle of the file.
+
+    Returns:
+        tuple: the comment line, the lines of the Wannier centres (``X`` lines) and the lines of the atoms.
+    """
+    content = handle.read()
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+
+    lines = content.splitlines()
+    comment, positions = lines[1], lines[2:2 + int(lines[0])]
+    centres = [line for line in positions if line.split()[0] == 'X']
+    atoms = [line for line in positions if line.split()[0] != 'X']
+
+    return comment, centres, atoms
+
+
+def write_centres(handle, comment, centres, atoms):
+    """Write a Wannier90 ``_centres.xyz`` file, with the lines returned by ``read_centres``."""
+    handle.write(f'{len(centres) + len(atoms):6d}\n{comment}\n')
+    handle.write(''.join(f'{line}\n' for line in centres + atoms))
+
+
+def block_diagonal(blocks):
+    """Return the block-diagonal stack of a sequence of (stacks of) matrices.
+
+    Args:
+        blocks (list of np.ndarray): the blocks, with shapes ``(..., nrows_i, ncols_i)`` and the same leading shape.
+
+    Returns:
+        np.ndarray: the matrices with shape ``(..., sum(nrows_i), sum(ncols_i))``.
+    """
+    num_rows = sum(block.shape[-2] for block in blocks)
+    num_cols = sum(block.shape[-1] for block in blocks)
+    merged = np.zeros(blocks[0].shape[:-2] + (num_rows, num_cols), dtype=np.result_type(*blocks))
+
+    row, col = 0, 0
+    for block in blocks:
+        merged[..., row:row + block.shape[-2], col:col + block.shape[-1]] = block
+        row, col = row + block.shape[-2], col + block.shape[-1]
+
+    return merged
+
+
+class WannierUMatrixData(ArrayData):
+    """Unitary (``_u.mat``) or disentanglement (``_u_dis.mat``) matrices of a Wannier90 calculation.
+
+    The matrices are stored as a complex array ``u_matrix`` with shape ``(nkpts, nrows, ncols)`` and the k-points in
+    crystal coordinates as ``kpoints``, so that they can be analysed without parsing the text file. The text header is
+    kept in the attributes, and the file in the exact Wannier90 format is produced with ``write_wannier90``.
+    """
+
+    def set_u_matrix(self, kpoints, matrices, header_lines=None, separator=''):
+        """Set the k-points and the matrices.
+
+        Args:
+            kpoints (np.ndarray): the k-points in crystal coordinates, with shape ``(nkpts, 3)``.
+            matrices (np.ndarray): the complex matrices, with shape ``(nkpts, nrows, ncols)``.
+            header_lines (list of str): the header and dimensions lines of the file, by default generated from the
+                shape of the matrices.
+            separator (str): the line separating the k-point blocks.
+        """
+        kpoints = np.asarray(kpoints, dtype=float)
+        matrices = np.asarray(matrices, dtype=complex)
+
+        if matrices.ndim != 3 or kpoints.shape != (matrices.shape[0], 3):
+            raise ValueError(
+                f'incompatible shapes of the k-points {kpoints.shape} and of the matrices {matrices.shape}'
+            )
+
+        if header_lines is None:
+            num_kpoints, num_rows, num_wann = matrices.shape
+            header_lines = ['', format_integers(num_kpoints, num_wann, num_rows)]
+
+        self.set_array('kpoints', kpoints)
+        self.set_array('u_matrix', matrices)
+        self.base.attributes.set('header_lines', list(header_lines))
+        self.base.attributes.set('separator', separator)
+
+    def set_from_file(self, handle):
+        """Set the k-points and matrices from a handle of a Wannier90 ``_u.mat`` or ``_u_dis.mat`` file."""
+        header_lines, separator, kpoints, matrices = read_u_matrix(handle)
+        self.set_u_matrix(kpoints, matrices, header_lines, separator)
+
+    @classmethod
+    def from_singlefiledata(cls, singlefiledata):
+        """Return a new (unstored) node from a ``SingleFileData`` with the content of a Wannier90 U matrix file."""
+        node = cls()
+        with singlefiledata.open(mode='rb') as handle:
+            node.set_from_file(handle)
+        return node
+
+    def get_kpoints(self):
+        """Return the k-points in crystal coordinates, with shape ``(nkpts, 3)``."""
+        return self.get_array('kpoints')
+
+    def get_u_matrix(self):
+        """Return the complex matrices, with shape ``(nkpts, nrows, ncols)``."""
+        return self.get_array('u_matrix')
+
+    @contextlib.contextmanager
+    def open_u_matrix(self):
+        """Context manager yielding the matrices as a read-only memory-mapped array.
+
+        Contrary to ``get_u_matrix``, the array is never loaded in memory as a whole, which is convenient to inspect
+        a few k-points of very large matrices.
+        """
+        with self.base.repository.as_path('u_matrix.npy') as filepath:
+            yield np.load(filepath, mmap_mode='r', allow_pickle=False)
+
+    def write_wannier90(self, handle):
+        """Write the matrices to a text handle, in the format of the Wannier90 ``_u.mat`` and ``_u_dis.mat`` files."""
+        write_u_matrix(
+            handle,
+            self.base.attributes.get('header_lines'),
+            self.base.attributes.get('separator'),
+            self.get_kpoints(),
+            self.get_u_matrix(),
+        )
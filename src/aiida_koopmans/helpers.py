@@ -8,22 +8,78 @@ Note: Point 2 is made possible by the fact that the ``diff`` executable is
 available in the PATH on almost any UNIX system.
 """
 
+import functools
 import shutil
 import tempfile
 
 from aiida.common.exceptions import NotExistent
 from aiida.orm import Code, Computer
-from aiida_quantumespresso.calculations.pw import PwCalculation
-from aiida_wannier90.calculations.wannier90 import Wannier90Calculation
-from ase.io.espresso import kch_keys, kcp_keys, kcs_keys, pw_keys, w2kcw_keys
 
-from aiida_koopmans.calculations.kcw import KcwCalculation
+from aiida_koopmans import cache
 
 LOCALHOST_NAME = "localhost-test"
-KCW_BLOCKED_KEYWORDS = [t[1] for t in KcwCalculation._blocked_keywords]
-PW_BLOCKED_KEYWORDS = [t[1] for t in PwCalculation._blocked_keywords]
-WANNIER90_BLOCKED_KEYWORDS = [t[1] for t in Wannier90Calculation._BLOCKED_PARAMETER_KEYS]
-ALL_BLOCKED_KEYWORDS = KCW_BLOCKED_KEYWORDS + PW_BLOCKED_KEYWORDS + WANNIER90_BLOCKED_KEYWORDS + [f'celldm({i})' for i in range (1,7)]
+
+# The blocked keywords and the kcw.x namelist tables require importing `aiida_quantumespresso`, `aiida_wannier90` and
+# `ase.io.espresso`, which are slow to import. They are therefore only built on first access, see `__getattr__`.
+_KEYWORD_TABLES = (
+    "KCW_BLOCKED_KEYWORDS",
+    "PW_BLOCKED_KEYWORDS",
+    "WANNIER90_BLOCKED_KEYWORDS",
+    "ALL_BLOCKED_KEYWORDS",
+    "KCW_NAMELISTS",
+    "KCW_NAMELIST_INDEX",
+)
+
+
+def _build_namelist_index(keys, namelists):
+    """Map every key of the given ase namelists to the tuple of (uppercase) namelists it belongs to."""
+    index = {}
+    for namelist in namelists:
+        for key in keys[namelist]:
+            index[key] = index.get(key, ()) + (namelist.upper(),)
+    return index
+
+
+@functools.lru_cache(maxsize=None)
+def _load_keyword_tables():
+    """Import the heavy dependencies and build the blocked keywords and kcw.x namelist tables, once per process."""
+    from aiida_quantumespresso.calculations.pw import PwCalculation
+    from aiida_wannier90.calculations.wannier90 import Wannier90Calculation
+    from ase.io.espresso import kch_keys, kcs_keys, w2kcw_keys
+
+    from aiida_koopmans.calculations.kcw import KcwCalculation
+
+    tables = {}
+    tables["KCW_BLOCKED_KEYWORDS"] = [t[1] for t in KcwCalculation._blocked_keywords]
+    tables["PW_BLOCKED_KEYWORDS"] = [t[1] for t in PwCalculation._blocked_keywords]
+    tables["WANNIER90_BLOCKED_KEYWORDS"] = [t[1] for t in Wannier90Calculation._BLOCKED_PARAMETER_KEYS]
+    tables["ALL_BLOCKED_KEYWORDS"] = frozenset(
+        tables["KCW_BLOCKED_KEYWORDS"]
+        + tables["PW_BLOCKED_KEYWORDS"]
+        + tables["WANNIER90_BLOCKED_KEYWORDS"]
+        + [f'celldm({i})' for i in range (1,7)]
+    )
+
+    # kcw.x calculation type -> (ase keys, namelists written in the input file, in order)
+    tables["KCW_NAMELISTS"] = {
+        "wann2kcw": (w2kcw_keys, ("control", "wannier")),
+        "screen": (kcs_keys, ("control", "wannier", "screen")),
+        "ham": (kch_keys, ("control", "wannier", "ham")),
+    }
+    # kcw.x calculation type -> {key: (NAMELIST, ...)}, so that each calculator parameter is routed with a single lookup
+    tables["KCW_NAMELIST_INDEX"] = {
+        calculation: _build_namelist_index(keys, namelists)
+        for calculation, (keys, namelists) in tables["KCW_NAMELISTS"].items()
+    }
+
+    return tables
+
+
+def __getattr__(name):
+    """Lazily provide the keyword tables as module attributes, e.g. ``helpers.ALL_BLOCKED_KEYWORDS``."""
+    if name in _KEYWORD_TABLES:
+        return _load_keyword_tables()[name]
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
 
 
 executables = {
@@ -57,7 +113,7 @@ def get_computer(name=LOCALHOST_NAME, workdir=None):
     """
 
     try:
-        computer = Computer.objects.get(label=name)
+        computer = cache.load_computer(name)
     except NotExistent:
         if workdir is None:
             workdir = tempfile.mkdtemp()
@@ -79,6 +135,7 @@ def get_computer(name=LOCALHOST_NAME, workdir=None):
 def get_code(entry_point, computer):
     """Get local code.
     Sets up code for given entry point on given computer.
+    The code is looked up on the given computer only, and only once per process, see ``cache.load_computer_code``.
 
     :param entry_point: Entry point of calculation plugin
     :param computer: (local) AiiDA computer
@@ -93,26 +150,31 @@ def get_code(entry_point, computer):
             f"Entry point '{entry_point}' not recognized. Allowed values: {list(executables.keys())}"
         ) from exc
 
-    codes = Code.objects.find(  # pylint: disable=no-member
-        filters={"label": executable}
-    )
-    if codes:
-        return codes[0]
+    def create_code():
+        code = Code(
+            input_plugin_name=entry_point,
+            remote_computer_exec=[computer, get_path_to_executable(executable)],
+        )
+        code.label = executable
+        return code.store()
 
-    path = get_path_to_executable(executable)
-    code = Code(
-        input_plugin_name=entry_point,
-        remote_computer_exec=[computer, path],
-    )
-    code.label = executable
-    return code.store()
+    return cache.load_computer_code(computer, executable, create_code)
+
+@functools.lru_cache(maxsize=None)
+def _get_pw_meta_parameters(protocol=None):
+    """Return the ``meta_parameters`` of a ``PwBaseWorkChain`` protocol, reading the protocol file only once."""
+    from aiida_quantumespresso.workflows.pw.base import PwBaseWorkChain
+
+    return PwBaseWorkChain.get_protocol_inputs(protocol)["meta_parameters"]
 
 def get_builder_from_ase(pw_calculator):
-    from aiida import load_profile, orm
+    from aiida import orm
     from aiida_quantumespresso.common.types import ElectronicType
-    from aiida_quantumespresso.workflows.pw.base import PwBaseWorkChain, PwCalculation
+    from aiida_quantumespresso.workflows.protocols.utils import recursive_merge
+    from aiida_quantumespresso.workflows.pw.base import PwBaseWorkChain
+    from ase.io.espresso import pw_keys
 
-    load_profile()
+    cache.load_profile()
 
     """
     We should check automatically on the accepted keywords in PwCalculation and where are. Should be possible.
@@ -135,7 +197,8 @@ def get_builder_from_ase(pw_calculator):
     """
     aiida_inputs = pw_calculator.mode
     calc_params = pw_calculator._parameters
-    structure = orm.StructureData(ase=pw_calculator.atoms)
+    blocked_keywords = _load_keyword_tables()["ALL_BLOCKED_KEYWORDS"]
+    structure = cache.intern_node(orm.StructureData(ase=pw_calculator.atoms))
 
     pw_overrides = {
         "CONTROL": {},
@@ -144,265 +207,220 @@ def get_builder_from_ase(pw_calculator):
     }
 
     for k in pw_keys['control']:
-        if k in calc_params.keys() and k not in ALL_BLOCKED_KEYWORDS:
+        if k in calc_params.keys() and k not in blocked_keywords:
             pw_overrides["CONTROL"][k] = calc_params[k]
 
     for k in pw_keys['system']:
-        if k in calc_params.keys() and k not in ALL_BLOCKED_KEYWORDS:
+        if k in calc_params.keys() and k not in blocked_keywords:
             pw_overrides["SYSTEM"][k] = calc_params[k]
 
     for k in pw_keys['electrons']:
-        if k in calc_params.keys() and k not in ALL_BLOCKED_KEYWORDS:
+        if k in calc_params.keys() and k not in blocked_keywords:
             pw_overrides["ELECTRONS"][k] = calc_params[k]
 
-    builder = PwBaseWorkChain.get_builder_from_protocol(
-        code=aiida_inputs["pw_code"],
-        structure=structure,
-        overrides={
-            "pseudo_family": "PseudoDojo/0.4/PBE/SR/standard/upf",
-            "pw": {"parameters": pw_overrides},
-        },
-        electronic_type=ElectronicType.INSULATOR,
+    code = cache.load_code(aiida_inputs["pw_code"])
+    pseudo_family = "PseudoDojo/0.4/PBE/SR/standard/upf"
+    protocol = None
+    electronic_type = ElectronicType.INSULATOR
+
+    # The protocol builder only depends on the structure through its kinds (pseudos and cutoffs), its periodicity
+    # (``assume_isolated``) and its number of atoms (convergence thresholds, set below): reuse it across structures.
+    builder = cache.get_builder_from_template(
+        PwBaseWorkChain,
+        (
+            code.uuid,
+            pseudo_family,
+            protocol,
+            electronic_type.value,
+            structure.pbc,
+            cache.get_structure_species(structure),
+        ),
+        lambda: PwBaseWorkChain.get_builder_from_protocol(
+            code=code,
+            structure=structure,
+            protocol=protocol,
+            overrides={"pseudo_family": pseudo_family},
+            electronic_type=electronic_type,
+        ),
     )
+    builder.pw.structure = structure
+
+    meta_parameters = _get_pw_meta_parameters(protocol)
+    natoms = len(structure.sites)
+    parameters = builder.pw.parameters.get_dict()
+    parameters["CONTROL"]["etot_conv_thr"] = natoms * meta_parameters["etot_conv_thr_per_atom"]
+    parameters["ELECTRONS"]["conv_thr"] = natoms * meta_parameters["conv_thr_per_atom"]
+    parameters = recursive_merge(parameters, pw_overrides)
+    if parameters["SYSTEM"].get("tot_magnetization") is not None:
+        parameters["SYSTEM"].pop("starting_magnetization", None)
+    builder.pw.parameters = cache.intern_node(orm.Dict(parameters))
+
     builder.pw.metadata = aiida_inputs["metadata"]
 
-    builder.kpoints = orm.KpointsData()
-    builder.kpoints.set_kpoints_mesh(calc_params["kpts"])
+    kpoints = orm.KpointsData()
+    kpoints.set_kpoints_mesh(calc_params["kpts"])
+    builder.kpoints = cache.intern_node(kpoints)
 
     if hasattr(pw_calculator, "parent_folder"):
         builder.pw.parent_folder = pw_calculator.parent_folder
 
     return builder
 
-def from_wann2kc_to_KcwCalculation(wann2kc_calculator):
-    """
-    The input parent folder is meant to be set later, at least for now.
-    """
-
-    from aiida import load_profile, orm
-
-    load_profile()
+def get_kpoints_from_bandpath(path):
+    """Get the ``KpointsData`` with the explicit k-points of an ASE ``BandPath``, in crystal coordinates.
 
-    builder = KcwCalculation.get_builder()
-    wann2kc_control_namelist = w2kcw_keys['control']
-    wann2kc_wannier_namelist = w2kcw_keys['wannier']
-
-
-    control_dict = {
-        k: v if k in wann2kc_control_namelist else None
-        for k, v in wann2kc_calculator.parameters.items()
-        if k not in ALL_BLOCKED_KEYWORDS
-    }
-
-    control_dict["calculation"] = "wann2kcw"
-
-    if not any(wann2kc_calculator.atoms.pbc):
-        control_dict["assume_isolated"] = "m-t"
+    The k-points at the special points of the path are labelled with their name, as the ``kpoint_path`` of the
+    Wannier90 builder.
 
-    for k in list(control_dict):
-        if control_dict[k] is None:
-            control_dict.pop(k)
-
-    wannier_dict = {
-        k: v if k in wann2kc_wannier_namelist else None
-        for k, v in wann2kc_calculator.parameters.items()
-        # ? Using all here, as blocked Wannier90 keywords doesn't contain 'seedname', but kcw does
-        if k not in ALL_BLOCKED_KEYWORDS
-    }
-
-    for k in list(wannier_dict):
-        if wannier_dict[k] is None:
-            wannier_dict.pop(k)
+    :param path: the ``ase.dft.kpoints.BandPath``.
+    :return: the (unstored) ``KpointsData``.
+    """
+    import numpy as np
+    from aiida import orm
 
-    wann2kcw_params = {
-        "CONTROL": control_dict,
-        "WANNIER": wannier_dict,
-    }
+    labels = []
+    for index, kpoint in enumerate(path.kpts):
+        for label, point in path.special_points.items():
+            if np.allclose(kpoint, point):
+                labels.append((index, label))
+                break
 
-    builder.parameters = orm.Dict(wann2kcw_params)
-    builder.code = orm.load_code(wann2kc_calculator.mode["kcw_code"])
-    builder.metadata = wann2kc_calculator.mode["metadata"]
-    if "metadata_kcw" in wann2kc_calculator.mode:
-        builder.metadata = wann2kc_calculator.mode["metadata_kcw"]
-    builder.parent_folder = wann2kc_calculator.parent_folder
-
-    if hasattr(wann2kc_calculator, "wannier90_files"):
-        builder.wann_u_mat = wann2kc_calculator.wannier90_files["occ"]["u_mat"]
-        builder.wann_emp_u_mat = wann2kc_calculator.wannier90_files["emp"]["u_mat"]
-        builder.wann_emp_u_dis_mat = wann2kc_calculator.wannier90_files["emp"][
-            "u_dis_mat"
-        ]
-        builder.wann_centres_xyz = wann2kc_calculator.wannier90_files["occ"][
-            "centres_xyz"
-        ]
-        builder.wann_emp_centres_xyz = wann2kc_calculator.wannier90_files["emp"][
-            "centres_xyz"
-        ]
+    kpoints = orm.KpointsData()
+    kpoints.set_cell(np.array(path.cell))
+    kpoints.set_kpoints(path.kpts, labels=labels or None)
+    return kpoints
 
-    return builder
+def get_kcw_band_kpoints(kcw_calculator):
+    """Get the k-points along which a ham calculation interpolates the bands, from the ``kpts`` of the calculator.
 
-def from_kcwham_to_KcwCalculation(kcw_calculator):
+    :param kcw_calculator: the ASE calculator of the ham step.
+    :return: the stored ``KpointsData`` of the band path, or None if the ``kpts`` are not a ``BandPath`` or a
+        ``KpointsData``, e.g. a Monkhorst-Pack mesh.
     """
-    The input parent folder is meant to be set later, at least for now.
+    from aiida import orm
+    from ase.dft.kpoints import BandPath
+
+    kpts = kcw_calculator.parameters.get("kpts", None)
+    if isinstance(kpts, BandPath):
+        return cache.intern_node(get_kpoints_from_bandpath(kpts))
+    if isinstance(kpts, orm.KpointsData):
+        return cache.intern_node(kpts)
+    return None
+
+def get_kcwcalculation_builder_from_ase(kcw_calculator, calculation):
+    """Get the builder of a ``KcwCalculation`` from an ASE kcw calculator.
+
+    The calculator parameters are routed to the kcw.x namelists in a single pass, using the key -> namelist index
+    precomputed in ``KCW_NAMELIST_INDEX``. The input parent folder is meant to be set later, at least for now. A ham
+    calculation interpolates the bands along the ``kpts`` parameter of the calculator, if it is an ASE ``BandPath``
+    (or a ``KpointsData``), see ``get_kpoints_from_bandpath``.
+
+    :param kcw_calculator: the ASE calculator of the kcw.x step.
+    :param calculation: the kcw.x ``calculation`` type, i.e. one of ``wann2kcw``, ``screen`` or ``ham``.
+    :return: the ``ProcessBuilder`` of the ``KcwCalculation``.
     """
-
-    from aiida import load_profile, orm
+    from aiida import orm
 
     from aiida_koopmans.calculations.kcw import KcwCalculation
 
-    load_profile()
+    cache.load_profile()
+
+    tables = _load_keyword_tables()
+    blocked_keywords = tables["ALL_BLOCKED_KEYWORDS"]
+
+    try:
+        index = tables["KCW_NAMELIST_INDEX"][calculation]
+    except KeyError as exc:
+        raise ValueError(
+            f"Calculation '{calculation}' not recognized. Allowed values: {list(tables['KCW_NAMELIST_INDEX'].keys())}"
+        ) from exc
 
     builder = KcwCalculation.get_builder()
 
-    kch_control_namelist = kch_keys['control']
-    kch_wannier_namelist = kch_keys['wannier']
-    kch_ham_namelist = kch_keys['ham']
+    kcw_params = {namelist.upper(): {} for namelist in tables["KCW_NAMELISTS"][calculation][1]}
+    for k, v in kcw_calculator.parameters.items():
+        if v is None or k in blocked_keywords:
+            continue
+        for namelist in index.get(k, ()):
+            kcw_params[namelist][k] = v
 
-    control_dict = {
-        k: v if k in kch_control_namelist else None
-        for k, v in kcw_calculator.parameters.items()
-        if k not in ALL_BLOCKED_KEYWORDS
-    }
-    control_dict["calculation"] = "ham"
+    control_dict = kcw_params["CONTROL"]
+    control_dict["calculation"] = calculation
 
     if not any(kcw_calculator.atoms.pbc):
         control_dict["assume_isolated"] = "m-t"
 
-    for k in list(control_dict):
-        if control_dict[k] is None:
-            control_dict.pop(k)
-
-
-    wannier_dict = {
-        k: v if k in kch_wannier_namelist else None
-        for k, v in kcw_calculator.parameters.items()
-        if k not in ALL_BLOCKED_KEYWORDS
-    }
-
-    for k in list(wannier_dict):
-        if wannier_dict[k] is None:
-            wannier_dict.pop(k)
-
-    ham_dict = {
-        k: v if k in kch_ham_namelist else None
-        for k, v in kcw_calculator.parameters.items()
-        if k not in ALL_BLOCKED_KEYWORDS
-    }
-
-    for k in list(ham_dict):
-        if ham_dict[k] is None:
-            ham_dict.pop(k)
-        if k == "do_bands":
-            ham_dict["do_bands"] = False
+    # The bands are only interpolated along the band path of the calculator, if set, written in the K_POINTS card.
+    kpoints = get_kcw_band_kpoints(kcw_calculator) if calculation == "ham" else None
+    if kpoints is not None:
+        kcw_params["HAM"]["do_bands"] = True
+        builder.kpoints = kpoints
+    elif calculation == "ham" and "do_bands" in kcw_calculator.parameters:
+        kcw_params["HAM"]["do_bands"] = False
 
-    kcw_ham_params = {
-        "CONTROL": control_dict,
-        "WANNIER": wannier_dict,
-        "HAM": ham_dict,
-    }
-
-    builder.parameters = orm.Dict(kcw_ham_params)
-    builder.code = orm.load_code(kcw_calculator.mode["kcw_code"])
+    builder.parameters = cache.intern_node(orm.Dict(kcw_params))
+    builder.code = cache.load_code(kcw_calculator.mode["kcw_code"])
     builder.metadata = kcw_calculator.mode["metadata"]
     if "metadata_kcw" in kcw_calculator.mode:
         builder.metadata = kcw_calculator.mode["metadata_kcw"]
     builder.parent_folder = kcw_calculator.parent_folder
 
-    if hasattr(kcw_calculator, "wannier90_files") and control_dict.get(
-        "read_unitary_matrix", False
-    ):
-        builder.wann_u_mat = kcw_calculator.wannier90_files["occ"]["u_mat"]
-        builder.wann_emp_u_mat = kcw_calculator.wannier90_files["emp"]["u_mat"]
-        builder.wann_emp_u_dis_mat = kcw_calculator.wannier90_files["emp"]["u_dis_mat"]
-        builder.wann_centres_xyz = kcw_calculator.wannier90_files["occ"]["centres_xyz"]
-        builder.wann_emp_centres_xyz = kcw_calculator.wannier90_files["emp"][
-            "centres_xyz"
-        ]
+    if hasattr(kcw_calculator, "wannier90_files"):
+        builder._update(get_kcw_wannier90_inputs(kcw_calculator.wannier90_files, calculation, control_dict))
 
     return builder
 
-def from_kcwscreen_to_KcwCalculation(kcw_calculator):
-    """
-    The input parent folder is meant to be set later, at least for now.
-    """
-
-    from aiida import load_profile, orm
-
-    from aiida_koopmans.calculations.kcw import KcwCalculation
-
-    load_profile()
-
-    builder = KcwCalculation.get_builder()
-
-    kcs_control_namelist = kcs_keys['control']
-    kcs_wannier_namelist = kcs_keys['wannier']
-    kcs_screening_namelist = kcs_keys['screen']
-
-    control_dict = {
-        k: v if k in kcs_control_namelist else None
-        for k, v in kcw_calculator.parameters.items()
-        if k not in ALL_BLOCKED_KEYWORDS
-    }
-    control_dict["calculation"] = "screen"
-
-    for k in list(control_dict):
-        if control_dict[k] is None:
-            control_dict.pop(k)
-
-    if not any(kcw_calculator.atoms.pbc):
-        control_dict["assume_isolated"] = "m-t"
-
-    wannier_dict = {
-        k: v if k in kcs_wannier_namelist else None
-        for k, v in kcw_calculator.parameters.items()
-        if k not in ALL_BLOCKED_KEYWORDS
-    }
+# The inputs of the ``KcwCalculation`` with the Wannier90 files, and the (manifold, file) they are taken from.
+KCW_WANNIER90_INPUTS = {
+    "wann_u_mat": ("occ", "u_mat"),
+    "wann_centres_xyz": ("occ", "centres_xyz"),
+    "wann_emp_u_mat": ("emp", "u_mat"),
+    "wann_emp_u_dis_mat": ("emp", "u_dis_mat"),
+    "wann_emp_centres_xyz": ("emp", "centres_xyz"),
+}
 
-    for k in list(wannier_dict):
-        if wannier_dict[k] is None:
-            wannier_dict.pop(k)
+def get_kcw_wannier90_inputs(wannier90_files, calculation, control):
+    """Get the Wannier90 files inputs of a ``KcwCalculation``.
 
-    screening_dict = {
-        k: v if k in kcs_screening_namelist else None
-        for k, v in kcw_calculator.parameters.items()
-        if k not in ALL_BLOCKED_KEYWORDS
-    }
+    wann2kcw always needs the Wannier90 files, screen and ham only if they read the unitary matrices.
 
-    for k in list(screening_dict):
-        if screening_dict[k] is None:
-            screening_dict.pop(k)
+    :param wannier90_files: the files of the ``occ`` and ``emp`` manifolds, see ``produce_wannier90_files``.
+    :param calculation: the kcw.x ``calculation`` type, i.e. one of ``wann2kcw``, ``screen`` or ``ham``.
+    :param control: the ``CONTROL`` namelist of the kcw.x parameters, with lowercase keys.
+    :return: dictionary of the ``wann_*`` inputs, for the files available in ``wannier90_files``.
+    """
+    if calculation != "wann2kcw" and not control.get("read_unitary_matrix", False):
+        return {}
 
-    kcw_screen_params = {
-        "CONTROL": control_dict,
-        "WANNIER": wannier_dict,
-        "SCREEN": screening_dict,
+    return {
+        name: wannier90_files[manifold][key]
+        for name, (manifold, key) in KCW_WANNIER90_INPUTS.items()
+        if key in wannier90_files.get(manifold, {})
     }
 
-    builder.parameters = orm.Dict(kcw_screen_params)
-    builder.code = orm.load_code(kcw_calculator.mode["kcw_code"])
-    builder.metadata = kcw_calculator.mode["metadata"]
-    if "metadata_kcw" in kcw_calculator.mode:
-        builder.metadata = kcw_calculator.mode["metadata_kcw"]
-    builder.parent_folder = kcw_calculator.parent_folder
+def from_wann2kc_to_KcwCalculation(wann2kc_calculator):
+    """
+    The input parent folder is meant to be set later, at least for now.
+    """
+    return get_kcwcalculation_builder_from_ase(wann2kc_calculator, "wann2kcw")
 
-    if hasattr(kcw_calculator, "wannier90_files") and control_dict.get(
-        "read_unitary_matrix", False
-    ):
-        builder.wann_u_mat = kcw_calculator.wannier90_files["occ"]["u_mat"]
-        builder.wann_emp_u_mat = kcw_calculator.wannier90_files["emp"]["u_mat"]
-        builder.wann_emp_u_dis_mat = kcw_calculator.wannier90_files["emp"]["u_dis_mat"]
-        builder.wann_centres_xyz = kcw_calculator.wannier90_files["occ"]["centres_xyz"]
-        builder.wann_emp_centres_xyz = kcw_calculator.wannier90_files["emp"][
-            "centres_xyz"
-        ]
+def from_kcwham_to_KcwCalculation(kcw_calculator):
+    """
+    The input parent folder is meant to be set later, at least for now.
+    """
+    return get_kcwcalculation_builder_from_ase(kcw_calculator, "ham")
 
-    return builder
+def from_kcwscreen_to_KcwCalculation(kcw_calculator):
+    """
+    The input parent folder is meant to be set later, at least for now.
+    """
+    return get_kcwcalculation_builder_from_ase(kcw_calculator, "screen")
 
 def get_wannier90bandsworkchain_builder_from_ase(wannierize_workflow, w90_calculator):
     # get the builder from WannierizeWorkflow, but after we already initialized a Wannier90Calculator.
     # in this way we have everything we need for each different block of the wannierization step.
 
-    from aiida import load_profile, orm
+    from aiida import orm
     from aiida_wannier90_workflows.common.types import WannierProjectionType
     from aiida_wannier90_workflows.utils.kpoints import get_explicit_kpoints_from_mesh
     from aiida_wannier90_workflows.utils.workflows.builder.serializer import (
@@ -417,31 +435,42 @@ def get_wannier90bandsworkchain_builder_from_ase(wannierize_workflow, w90_calcul
         submit_and_add_group,
     )
     from aiida_wannier90_workflows.workflows import Wannier90BandsWorkChain
-    load_profile()
+    cache.load_profile()
 
     nscf = wannierize_workflow.dft_wchains["nscf"]
     aiida_inputs = wannierize_workflow.parameters.mode
 
     codes = {
-        "pw": aiida_inputs["pw_code"],
-        "pw2wannier90": aiida_inputs["pw2wannier90_code"],
-        "projwfc": aiida_inputs["projwfc_code"],
-        "wannier90": aiida_inputs["wannier90_code"],
+        "pw": cache.load_code(aiida_inputs["pw_code"]),
+        "pw2wannier90": cache.load_code(aiida_inputs["pw2wannier90_code"]),
+        "projwfc": cache.load_code(aiida_inputs["projwfc_code"]),
+        "wannier90": cache.load_code(aiida_inputs["wannier90_code"]),
     }
-
-    builder = Wannier90BandsWorkChain.get_builder_from_protocol(
+    structure = nscf.inputs.pw.structure
+    pseudo_family = "PseudoDojo/0.4/PBE/FR/standard/upf"
+    protocol = "fast"
+    projection_type = WannierProjectionType.ANALYTIC
+
+    # The number of bands and Wannier functions of the protocol depend on the composition, while the k-points, the
+    # projections and the Wannier90 parameters are overridden below with those of the nscf and of the calculator.
+    builder = cache.get_builder_from_template(
+        Wannier90BandsWorkChain,
+        (
+            tuple(sorted((name, code.uuid) for name, code in codes.items())),
+            pseudo_family,
+            protocol,
+            projection_type.value,
+            cache.get_structure_species(structure, composition=True),
+        ),
+        lambda: Wannier90BandsWorkChain.get_builder_from_protocol(
             codes=codes,
-            structure=nscf.inputs.pw.structure,
-            pseudo_family="PseudoDojo/0.4/PBE/FR/standard/upf",
-            protocol="fast",
-            projection_type=WannierProjectionType.ANALYTIC,
-        )
-
-    # Use nscf explicit kpoints
-    kpoints = orm.KpointsData()
-    kpoints.set_cell_from_structure(builder.structure)
-    kpoints.set_kpoints(nscf.outputs.output_band.get_array('kpoints'),cartesian=False)
-    builder.wannier90.wannier90.kpoints = kpoints
+            structure=structure,
+            pseudo_family=pseudo_family,
+            protocol=protocol,
+            projection_type=projection_type,
+        ),
+    )
+    builder.structure = structure
 
     # set kpath using the WannierizeWFL data.
     k_coords = []
@@ -454,7 +483,7 @@ def get_wannier90bandsworkchain_builder_from_ase(wannierize_workflow, w90_calcul
         t=+1
     kpoints_path = orm.KpointsData()
     kpoints_path.set_kpoints(k_coords,labels=k_labels)
-    builder.kpoint_path  =  kpoints_path
+    builder.kpoint_path  =  cache.intern_node(kpoints_path)
 
 
     # Start parameters and projections setting using the Wannier90Calculator data.
@@ -478,20 +507,12 @@ def get_wannier90bandsworkchain_builder_from_ase(wannierize_workflow, w90_calcul
         converted_proj = "f="+position+":"+orbital
         converted_projs.append(converted_proj)
 
-    builder.wannier90.wannier90.projections = orm.List(list=converted_projs)
+    builder.wannier90.wannier90.projections = cache.intern_node(orm.List(list=converted_projs))
     params.pop('auto_projections', None) # Uncomment this if you want analytic atomic projections
 
     ## END explicit atomic projections:
 
-    # putting the fermi energy to make it work.
-    try:
-        fermi_energy = nscf.outputs.output_parameters.get_dict()["fermi_energy_up"]
-    except:
-        fermi_energy = nscf.outputs.output_parameters.get_dict()["fermi_energy"]
-    params["fermi_energy"] = fermi_energy
-
-    params = orm.Dict(dict=params)
-    builder.wannier90.wannier90.parameters = params
+    set_wannier90_inputs_from_nscf(builder, nscf, params)
 
     #resources
     builder.pw2wannier90.pw2wannier90.metadata = aiida_inputs["metadata"]
@@ -509,8 +530,6 @@ def get_wannier90bandsworkchain_builder_from_ase(wannierize_workflow, w90_calcul
       }
     builder.wannier90.wannier90.metadata = aiida_inputs.get('metadata_w90', default_w90_metadata)
 
-    builder.pw2wannier90.pw2wannier90.parent_folder = nscf.outputs.remote_folder
-
     # for now try this, as the get_fermi_energy_from_nscf + get_homo_lumo does not work for fixed occ.
     # maybe add some parsing (for fixed occ) in the aiida-wannier90-workflows/src/aiida_wannier90_workflows/utils/workflows/pw.py
     builder.wannier90.shift_energy_windows = False
@@ -519,7 +538,33 @@ def get_wannier90bandsworkchain_builder_from_ase(wannierize_workflow, w90_calcul
     params_pw2wannier90 = builder.pw2wannier90.pw2wannier90.parameters.get_dict()
     params_pw2wannier90['inputpp']["wan_mode"] =  "standalone"
     params_pw2wannier90['inputpp']["spin_component"] = "up"
-    builder.pw2wannier90.pw2wannier90.parameters = orm.Dict(dict=params_pw2wannier90)
+    builder.pw2wannier90.pw2wannier90.parameters = cache.intern_node(orm.Dict(dict=params_pw2wannier90))
 
 
     return builder
+
+def set_wannier90_inputs_from_nscf(builder, nscf, parameters):
+    """Set the inputs of a ``Wannier90BandsWorkChain`` builder that are taken from the nscf calculation.
+
+    These are the explicit k-points of the nscf, the Fermi energy in the Wannier90 parameters, and the parent folder of
+    pw2wannier90. The ``structure`` of the builder should already be set. The ``KoopmansDFPTWorkChain`` takes these
+    inputs from the nscf with the ``get_wannier90_inputs_from_nscf`` calcfunction instead.
+
+    :param builder: the ``ProcessBuilder`` of the ``Wannier90BandsWorkChain``, updated in place.
+    :param nscf: the finished nscf ``PwBaseWorkChain``.
+    :param parameters: the dictionary of Wannier90 parameters to which the Fermi energy is added.
+    """
+    from aiida import orm
+
+    # Use nscf explicit kpoints
+    kpoints = orm.KpointsData()
+    kpoints.set_cell_from_structure(builder.structure)
+    kpoints.set_kpoints(nscf.outputs.output_band.get_array('kpoints'),cartesian=False)
+    builder.wannier90.wannier90.kpoints = cache.intern_node(kpoints)
+
+    # putting the fermi energy to make it work.
+    output_parameters = nscf.outputs.output_parameters.get_dict()
+    parameters["fermi_energy"] = output_parameters.get("fermi_energy_up", output_parameters.get("fermi_energy"))
+    builder.wannier90.wannier90.parameters = cache.intern_node(orm.Dict(parameters))
+
+    builder.pw2wannier90.pw2wannier90.parent_folder = nscf.outputs.remote_folder
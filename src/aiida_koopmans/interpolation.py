@@ -0,0 +1,116 @@
+"""Wannier interpolation of the Koopmans bands from the real-space Hamiltonian of a ``ham`` calculation.
+
+The Hamiltonian ``H(k) = sum_R exp(2 pi i k.R) H(R) / deg(R)`` is built for all the k-points at once, as a single matrix
+product of the phase factors with the real-space Hamiltonian, and diagonalised with a batched ``eigvalsh``. The phase
+factors only depend on the R-vectors and on the k-points, so they are cached and reused when the same k-path is
+interpolated again, e.g. for the KI and the DFT Hamiltonians or for successive ham calculations of a workflow.
+"""
+import hashlib
+
+import numpy as np
+
+from aiida import orm
+from aiida.engine import calcfunction
+
+# Maximum number of (R-vectors, k-points) sets for which the phase factors are kept in memory.
+PHASES_CACHE_SIZE = 16
+
+_PHASES = {}
+
+
+def get_hamiltonian_arrays(hamiltonian):
+    """Return the R-vectors, the degeneracies and the dense Hamiltonian of the ``hamiltonian`` output of a ham step.
+
+    :param hamiltonian: the ``ArrayData`` with the real-space Hamiltonian, in the dense or sparse layout.
+    :return: tuple of the R-vectors with shape ``(nR, 3)``, the degeneracies with shape ``(nR,)`` and the complex
+        Hamiltonian with shape ``(nR, nw, nw)``.
+    """
+    r_vectors = hamiltonian.get_array('r_vectors')
+    degeneracies = hamiltonian.get_array('degeneracies')
+
+    if 'hamiltonian' in hamiltonian.get_arraynames():
+        return r_vectors, degeneracies, hamiltonian.get_array('hamiltonian')
+
+    dense = np.zeros(hamiltonian.base.attributes.get('shape'), dtype=complex)
+    dense[tuple(hamiltonian.get_array('indices').T)] = hamiltonian.get_array('values')
+    return r_vectors, degeneracies, dense
+
+
+def _digest(array):
+    array = np.ascontiguousarray(array)
+    return hashlib.sha1(array.tobytes() + str((array.dtype, array.shape)).encode()).hexdigest()
+
+
+def get_phases(r_vectors, degeneracies, kpoints):
+    """Return the phase factors ``exp(2 pi i k.R) / deg(R)``, with shape ``(nk, nR)``.
+
+    The phase factors are cached for the last ``PHASES_CACHE_SIZE`` sets of R-vectors, degeneracies and k-points.
+
+    :param r_vectors: the R-vectors in crystal coordinates, with shape ``(nR, 3)``.
+    :param degeneracies: the degeneracies of the R-vectors, with shape ``(nR,)``.
+    :param kpoints: the k-points in crystal coordinates, with shape ``(nk, 3)``.
+    """
+    key = (_digest(r_vectors), _digest(degeneracies), _digest(kpoints))
+    try:
+        return _PHASES[key]
+    except KeyError:
+        pass
+
+    phases = np.exp(2j * np.pi * (np.asarray(kpoints) @ np.asarray(r_vectors).T)) / np.asarray(degeneracies)
+    phases.setflags(write=False)
+
+    if len(_PHASES) >= PHASES_CACHE_SIZE:
+        _PHASES.pop(next(iter(_PHASES)))
+    _PHASES[key] = phases
+    return phases
+
+
+def clear_phases_cache():
+    """Clear the cache of the phase factors."""
+    _PHASES.clear()
+
+
+def interpolate_hamiltonian(r_vectors, degeneracies, hamiltonian, kpoints):
+    """Return the Hamiltonian ``H(k)`` at the given k-points, with shape ``(nk, nw, nw)``.
+
+    :param r_vectors: the R-vectors in crystal coordinates, with shape ``(nR, 3)``.
+    :param degeneracies: the degeneracies of the R-vectors, with shape ``(nR,)``.
+    :param hamiltonian: the real-space Hamiltonian, with shape ``(nR, nw, nw)``.
+    :param kpoints: the k-points in crystal coordinates, with shape ``(nk, 3)``.
+    """
+    num_rpts, num_wann, _ = hamiltonian.shape
+    phases = get_phases(r_vectors, degeneracies, kpoints)
+    hamiltonian_k = phases @ hamiltonian.reshape(num_rpts, num_wann * num_wann)
+    return hamiltonian_k.reshape(-1, num_wann, num_wann)
+
+
+def interpolate_eigenvalues(r_vectors, degeneracies, hamiltonian, kpoints):
+    """Return the eigenvalues of the Hamiltonian at the given k-points, with shape ``(nk, nw)``.
+
+    The interpolated Hamiltonian is symmetrised before the diagonalisation, to remove the non-hermitian noise
+    introduced by the finite precision of the real-space Hamiltonian.
+    """
+    hamiltonian_k = interpolate_hamiltonian(r_vectors, degeneracies, hamiltonian, kpoints)
+    hamiltonian_k = 0.5 * (hamiltonian_k + hamiltonian_k.conj().transpose(0, 2, 1))
+    return np.linalg.eigvalsh(hamiltonian_k)
+
+
+def get_interpolated_bands(hamiltonian, kpoints):
+    """Return the bands interpolated from the ``hamiltonian`` output of a ham calculation along the given k-points.
+
+    :param hamiltonian: the ``ArrayData`` with the real-space Hamiltonian (eV).
+    :param kpoints: a ``KpointsData`` with an explicit list of k-points, e.g. a k-path with labels.
+    :return: an unstored ``BandsData`` with the interpolated bands (eV).
+    """
+    eigenvalues = interpolate_eigenvalues(*get_hamiltonian_arrays(hamiltonian), kpoints.get_kpoints())
+
+    bands = orm.BandsData()
+    bands.set_kpointsdata(kpoints)
+    bands.set_bands(eigenvalues, units='eV')
+    return bands
+
+
+@calcfunction
+def interpolate_bands(hamiltonian, kpoints):
+    """Calcfunction version of ``get_interpolated_bands``, to keep the provenance of the interpolated bands."""
+    return get_interpolated_bands(hamiltonian, kpoints)
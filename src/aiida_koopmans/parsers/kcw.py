@@ -1,79 +1,413 @@
 # -*- coding: utf-8 -*-
-from pathlib import Path
+import fnmatch
+from pathlib import Path, PurePosixPath
 
-from aiida.orm import Dict
+import numpy as np
+from aiida.orm import ArrayData, BandsData, Dict
 
 from aiida_quantumespresso.parsers.parse_raw.base import convert_qe_to_aiida_structure, convert_qe_to_kpoints
 from aiida_quantumespresso.utils.mapping import get_logging_container
 
 from aiida_quantumespresso.parsers.base import BaseParser
 
+from aiida_koopmans.calculations.kcw import get_parent_pw_calculation
+from aiida_koopmans.data.wannier90 import read_hr
+from aiida_koopmans.parsers.parse_raw import gaussian_dos, parse_alpha_file, parse_pdos_tot_file, parse_stdout
+from aiida_koopmans.parsers.parse_xml import UnexpectedXMLError, parse_xml_fast
+
 class KcwParser(BaseParser):
     """``Parser`` implementation for the ``KcwCalculation`` calculation job class.
 
-    For now it just checks if there is the `JOB DONE` string at the end, and some other common functionalities (BaseParser).
+    The `stdout` is parsed line by line, checking for the `JOB DONE` string at the end and the common errors and warnings
+    (BaseParser), and collecting the screening parameters and the eigenvalues printed by kcw.x.
     """
+
+    # The folder with the files of the calculation being parsed, relative to the retrieved (temporary) folder
+    _subfolder = ''
     
     def parse(self, **kwargs):
-        """Parse the retrieved files from a ``KcwCalculation`` into output nodes."""
-        # we create a dictionary the progressively accumulates more info
-        out_info_dict = {}
+        """Parse the retrieved files from a ``KcwCalculation`` into output nodes.
+
+        The following parser options are supported, in the ``parser_options`` of the ``settings``:
 
+        * ``hamiltonian_cutoff``: store only the elements of the real-space Hamiltonian with a magnitude larger than
+          the cutoff (eV), in a sparse layout.
+        * ``dos_degauss``: broaden the band energies of a ham calculation with a Gaussian of this width (eV) into the
+          ``dos`` output, on the grid from ``dos_emin`` to ``dos_emax`` with spacing ``dos_deltae`` (eV). By default
+          the grid spans the band energies, extended by five times the broadening, with a spacing of 0.01 eV.
+        """
         logs = get_logging_container()
 
-        stdout, parsed_data, logs = self.parse_stdout_from_retrieved(logs)
-        out_info_dict['out_file'] = stdout.split('\n')
+        if 'parameters' in self.node.inputs:
+            calculation = self.node.process_class.get_calculation(self.node.inputs.parameters)
+        else:
+            calculation = None
+
+        exit_code = self._parse_stdout_outputs(self.node.get_option('output_filename'), calculation, logs)
+        if exit_code:
+            return self.exit(exit_code, logs)
+
+        _, exit_code = self._parse_parent_info(kwargs.get('retrieved_temporary_folder'))
+        if exit_code:
+            return self.exit(exit_code, logs)
+
+        exit_code = self._parse_alphas()
+        if exit_code:
+            return self.exit(exit_code, logs)
+
+        exit_code = self._parse_hamiltonian(kwargs.get('retrieved_temporary_folder'))
+        if exit_code:
+            return self.exit(exit_code, logs)
+
+        exit_code = self._parse_pdos()
+        if exit_code:
+            return self.exit(exit_code, logs)
+
+        return self.exit(logs=logs)
+
+    def _parse_stdout_outputs(self, filename_stdout, calculation, logs):
+        """Parse a ``stdout`` of kcw.x into the ``output_parameters``, ``performance``, ``bands`` and ``dos`` outputs.
+
+        :param filename_stdout: the name of the ``stdout`` in the retrieved folder.
+        :param calculation: the ``calculation`` of kcw.x, added to the ``performance`` output.
+        :param logs: logging container, updated during parsing.
+        :return: an ``ExitCode`` if the ``stdout`` is missing, reports an error or is incomplete, None otherwise. The
+            out-of-walltime and out-of-memory exit codes set by the scheduler take precedence, so that they can be
+            handled by the ``KcwBaseWorkChain``.
+        """
+        parsed_data, logs = self.parse_stdout_from_retrieved(logs, filename_stdout)
+        scheduler_exit_code = self._get_scheduler_exit_code()
 
         base_exit_code = self.check_base_errors(logs)
         if base_exit_code:
-            return self.exit(base_exit_code, logs)
+            return scheduler_exit_code or base_exit_code
+
+        exit_code = self._parse_dos(parsed_data)
+        if exit_code:
+            return exit_code
+
+        exit_code = self._parse_bands(parsed_data)
+        if exit_code:
+            return exit_code
 
+        performance = parsed_data.pop('performance', None)
         self.out('output_parameters', Dict(parsed_data))
+        if performance:
+            performance['calculation'] = calculation
+            self.out('performance', Dict(performance))
 
-        if 'ERROR_OUTPUT_STDOUT_INCOMPLETE'in logs.error:
-            return self.exit(self.exit_codes.ERROR_OUTPUT_STDOUT_INCOMPLETE, logs)
+        if scheduler_exit_code:
+            return scheduler_exit_code
+
+        if 'ERROR_OUT_OF_WALLTIME' in logs.error:
+            return self.exit_codes.ERROR_OUT_OF_WALLTIME
+
+        if 'ERROR_OUTPUT_STDOUT_INCOMPLETE' in logs.error:
+            return self.exit_codes.ERROR_OUTPUT_STDOUT_INCOMPLETE
+
+        return None
+
+    def _get_scheduler_exit_code(self):
+        """Return the out-of-walltime or out-of-memory exit code set by the scheduler, if any."""
+        for name in ('ERROR_SCHEDULER_OUT_OF_WALLTIME', 'ERROR_SCHEDULER_OUT_OF_MEMORY'):
+            if self.node.exit_status == self.exit_codes[name].status:
+                return self.exit_codes[name]
+        return None
+
+    def _parse_parent_info(self, retrieved_temporary_folder):
+        """Return the structure, k-points and spin settings of the parent calculation.
+
+        They are parsed from the XML in the retrieved temporary folder, or taken from the outputs of the parent
+        ``PwCalculation`` with the ``without_xml`` option.
+
+        :param retrieved_temporary_folder: the path of the retrieved temporary folder, or None.
+        :return: tuple of the dictionary with the keys ``structure``, ``kpoints``, ``nspin``, ``collinear``,
+            ``spinorbit`` and ``spin``, and of an ``ExitCode`` if they cannot be obtained (None otherwise).
+        """
+        # we create a dictionary the progressively accumulates more info
+        out_info_dict = {}
+
+        if self.node.get_option('without_xml'):
+            # Take the `structure`, `kpoints` and spin-related settings from the outputs of the parent calculation
+            parent_info = self._get_parent_info()
+            if parent_info is None:
+                return out_info_dict, self.exit_codes.ERROR_PARENT_CALCULATION_OUTPUTS
+            out_info_dict.update(parent_info)
+        else:
+            if retrieved_temporary_folder is None:
+                return out_info_dict, self.exit_codes.ERROR_NO_RETRIEVED_TEMPORARY_FOLDER
+
+            # Parse the XML to obtain the `structure`, `kpoints` and spin-related settings from the parent calculation
+            self.exit_code_xml = None
+            parsed_xml, logs_xml = self._parse_xml(retrieved_temporary_folder)
+            self.emit_logs(logs_xml)
+
+            if self.exit_code_xml:
+                return out_info_dict, self.exit_code_xml
+
+            out_info_dict['structure'] = convert_qe_to_aiida_structure(parsed_xml['structure'])
+            out_info_dict['kpoints'] = convert_qe_to_kpoints(parsed_xml, out_info_dict['structure'])
+            out_info_dict['nspin'] = parsed_xml.get('number_of_spin_components')
+            out_info_dict['collinear'] = not parsed_xml.get('non_colinear_calculation')
+            out_info_dict['spinorbit'] = parsed_xml.get('spin_orbit_calculation')
 
-        try:
-            retrieved_temporary_folder = kwargs['retrieved_temporary_folder']
-        except KeyError:
-            return self.exit(self.exit_codes.ERROR_NO_RETRIEVED_TEMPORARY_FOLDER, logs)
-
-        # Parse the XML to obtain the `structure`, `kpoints` and spin-related settings from the parent calculation
-        self.exit_code_xml = None
-        parsed_xml, logs_xml = self._parse_xml(retrieved_temporary_folder)
-        self.emit_logs(logs_xml)
-
-        if self.exit_code_xml:
-            return self.exit(self.exit_code_xml)
-
-        out_info_dict['structure'] = convert_qe_to_aiida_structure(parsed_xml['structure'])
-        out_info_dict['kpoints'] = convert_qe_to_kpoints(parsed_xml, out_info_dict['structure'])
-        out_info_dict['nspin'] = parsed_xml.get('number_of_spin_components')
-        out_info_dict['collinear'] = not parsed_xml.get('non_colinear_calculation')
-        out_info_dict['spinorbit'] = parsed_xml.get('spin_orbit_calculation')
         out_info_dict['spin'] = out_info_dict['nspin'] == 2
 
-        # check and read alpha file: use the `koopmans` package capabilities.
+        return out_info_dict, None
+
+    def parse_stdout_from_retrieved(self, logs, filename_stdout=None):
+        """Parse the ``stdout`` of kcw.x, streaming it line by line from the retrieved folder.
+
+        Contrary to the method of the ``BaseParser``, the content of the ``stdout`` is never held in memory as a whole,
+        see ``aiida_koopmans.parsers.parse_raw.parse_stdout``.
+
+        :param logs: Logging container that will be updated during parsing.
+        :param filename_stdout: the name of the ``stdout`` in the retrieved folder, by default the ``output_filename``.
+        :returns: size 2 tuple: (parsed data, updated logs).
+        """
+        if filename_stdout is None:
+            filename_stdout = self.node.get_option('output_filename')
+
+        if filename_stdout not in self._list_retrieved():
+            logs.error.append('ERROR_OUTPUT_STDOUT_MISSING')
+            return {}, logs
+
+        try:
+            with self.retrieved.base.repository.open(self._get_retrieved_path(filename_stdout), 'r') as handle:
+                parsed_data, logs = parse_stdout(
+                    handle, logs, self.get_error_map(), self.get_warning_map(), self.success_string
+                )
+        except OSError as exception:
+            logs.error.append('ERROR_OUTPUT_STDOUT_READ')
+            logs.error.append(exception)
+            return {}, logs
+        except Exception as exception:
+            logs.error.append('ERROR_OUTPUT_STDOUT_PARSE')
+            logs.error.append(exception)
+            return {}, logs
+
+        return parsed_data, logs
+
+    def _get_retrieved_path(self, filename):
+        """Return the path in the retrieved folder of a file of the calculation being parsed."""
+        return str(PurePosixPath(self._subfolder, filename))
+
+    def _get_calculation_inputs(self):
+        """Return the inputs of the calculation being parsed."""
+        return self.node.inputs
+
+    def _list_retrieved(self):
+        """Return the names of the retrieved files of the calculation being parsed."""
+        try:
+            return self.retrieved.base.repository.list_object_names(self._subfolder or None)
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+
+    def _parse_alphas(self):
+        """Parse the screening parameters written by a ``screen`` calculation into the ``alphas`` output.
+
+        :return: an ``ExitCode`` if the files are present but cannot be read, None otherwise.
+        """
+        out_filenames = self._list_retrieved()
+        indices, alphas, occupied = [], [], []
+
+        for manifold, filename in self.node.process_class._alpha_files.items():
+            if filename not in out_filenames:
+                continue
+            try:
+                with self.retrieved.base.repository.open(self._get_retrieved_path(filename), 'r') as handle:
+                    manifold_indices, manifold_alphas = parse_alpha_file(handle)
+            except (OSError, ValueError, IndexError) as exception:
+                return self.exit_codes.ERROR_READING_ALPHA_FILE.format(exception=exception)
+            indices.append(manifold_indices)
+            alphas.append(manifold_alphas)
+            occupied.append(np.full(len(manifold_alphas), manifold == 'occ'))
+
+        if alphas:
+            output = ArrayData()
+            output.set_array('alphas', np.concatenate(alphas))
+            output.set_array('orbital_indices', np.concatenate(indices))
+            output.set_array('occupied', np.concatenate(occupied))
+            self.out('alphas', output)
+
+        return None
+
+    def _parse_pdos(self):
+        """Parse the ``pdos_tot`` file into the ``pdos`` output, if it was retrieved.
+
+        :return: an ``ExitCode`` if the file is present but cannot be read, None otherwise.
         """
-        out_filenames = self.retrieved.base.repository.list_object_names()
+        out_filenames = self._list_retrieved()
+        pdostot_filenames = fnmatch.filter(out_filenames, '*pdos_tot*')
+        if not pdostot_filenames:
+            return None
+
         try:
-            pdostot_filename = fnmatch.filter(out_filenames, '*pdos_tot*')[0]
-            with self.retrieved.base.repository.open(pdostot_filename, 'r') as pdostot_file:
-                # Columns: Energy(eV), Ldos, Pdos
-                pdostot_array = np.atleast_2d(np.genfromtxt(pdostot_file))
-                energy = pdostot_array[:, 0]
-                dos = pdostot_array[:, 1]
-        except (OSError, KeyError):
-            return self.exit(self.exit_codes.ERROR_READING_PDOSTOT_FILE, logs)
+            with self.retrieved.base.repository.open(self._get_retrieved_path(pdostot_filenames[0]), 'r') as handle:
+                energy, dos, pdos = parse_pdos_tot_file(handle)
+        except (OSError, ValueError) as exception:
+            self.logger.error(f'Could not read the `{pdostot_filenames[0]}` file: {exception}')
+            return self.exit_codes.ERROR_READING_PDOSTOT_FILE
+
+        output = ArrayData()
+        output.set_array('energy', energy)
+        output.set_array('dos', dos)
+        output.set_array('pdos', pdos)
+        self.out('pdos', output)
+        return None
+
+    def _parse_dos(self, parsed_data):
+        """Broaden the band energies of a ham calculation into the ``dos`` output, with the ``dos_degauss`` option.
+
+        :param parsed_data: the data parsed from the ``stdout``.
+        :return: an ``ExitCode`` if the DOS cannot be computed from the band energies, None otherwise. The options are
+            validated at submission, see ``validate_settings``.
         """
+        options = self.get_parser_options()
+        degauss = options.get('dos_degauss', None)
+        labels = [label for label in ('ks', 'ki') if f'eigenvalues_{label}' in parsed_data]
+        if degauss is None or not labels:
+            return None
 
+        try:
+            eigenvalues = {label: np.array(parsed_data[f'eigenvalues_{label}'], dtype=float) for label in labels}
+            if degauss <= 0 or any(values.ndim != 2 for values in eigenvalues.values()):
+                raise ValueError(f'invalid broadening {degauss} or ragged band energies')
+            emin = options.get('dos_emin', min(values.min() for values in eigenvalues.values()) - 5 * degauss)
+            emax = options.get('dos_emax', max(values.max() for values in eigenvalues.values()) + 5 * degauss)
+            energy = np.arange(emin, emax, options.get('dos_deltae', 0.01))
+            if energy.size == 0:
+                raise ValueError(f'empty energy grid from {emin} to {emax}')
+        except (ValueError, TypeError) as exception:
+            return self.exit_codes.ERROR_COMPUTING_DOS.format(exception=exception)
 
-        return self.exit(logs=logs)
+        output = ArrayData()
+        output.set_array('energy', energy)
+        for label, values in eigenvalues.items():
+            output.set_array(f'dos_{label}', gaussian_dos(energy, values, degauss))
+        output.base.attributes.set('degauss', degauss)
+        self.out('dos', output)
+        return None
+
+    def _parse_bands(self, parsed_data):
+        """Output the KI bands interpolated by a ham calculation along the ``kpoints`` input, as the ``bands`` output.
+
+        The eigenvalues are moved from the ``parsed_data`` to the ``bands`` output, which keeps the labels of the
+        ``kpoints`` input.
+
+        :param parsed_data: the data parsed from the ``stdout``, updated in place.
+        :return: an ``ExitCode`` if the eigenvalues are not consistent with the ``kpoints``, None otherwise.
+        """
+        inputs = self._get_calculation_inputs()
+        if 'kpoints' not in inputs or 'eigenvalues_ki' not in parsed_data:
+            return None
+
+        kpoints = inputs['kpoints']
+        try:
+            eigenvalues = np.array(parsed_data['eigenvalues_ki'], dtype=float)
+            num_kpoints = len(kpoints.get_kpoints())
+            if eigenvalues.ndim != 2 or eigenvalues.shape[0] != num_kpoints:
+                raise ValueError(f'eigenvalues with shape {eigenvalues.shape} for {num_kpoints} k-points')
+            bands = BandsData()
+            bands.set_kpointsdata(kpoints)
+            bands.set_bands(eigenvalues, units='eV')
+        except (ValueError, AttributeError) as exception:
+            self.logger.error(f'Could not build the bands: {exception}')
+            return self.exit_codes.ERROR_PARSING_PROJECTIONS
+
+        parsed_data.pop('eigenvalues_ki')
+        parsed_data.pop('kpoints_eigenvalues', None)
+        self.out('bands', bands)
+        return None
+
+    @staticmethod
+    def get_parser_settings_key():
+        """Return the key that contains the optional parser options in the `settings` input node."""
+        return 'parser_options'
+
+    def get_parser_options(self):
+        """Return the parser options from the `settings` input node."""
+        if 'settings' not in self.node.inputs:
+            return {}
+        return self.node.inputs.settings.get_dict().get(self.get_parser_settings_key(), None) or {}
+
+    def _parse_hamiltonian(self, retrieved_temporary_folder):
+        """Parse the real-space Hamiltonian written by a ``ham`` calculation into the ``hamiltonian`` output.
+
+        :param retrieved_temporary_folder: the path of the retrieved temporary folder, or None.
+        :return: an ``ExitCode`` if the file is present but cannot be read, None otherwise.
+        """
+        if retrieved_temporary_folder is None:
+            return None
+
+        hr_filepath = Path(retrieved_temporary_folder) / self._subfolder / self.node.process_class.hr_filename
+        if not hr_filepath.exists():
+            return None
+
+        try:
+            with hr_filepath.open('rb') as handle:
+                _, r_vectors, degeneracies, hamiltonian = read_hr(handle)
+        except (OSError, ValueError, IndexError) as exception:
+            return self.exit_codes.ERROR_READING_HAMILTONIAN_FILE.format(exception=exception)
+
+        output = ArrayData()
+        output.set_array('r_vectors', r_vectors)
+        output.set_array('degeneracies', degeneracies)
+
+        cutoff = self.get_parser_options().get('hamiltonian_cutoff', None)
+        if cutoff is None:
+            output.set_array('hamiltonian', hamiltonian)
+        else:
+            indices = np.argwhere(np.abs(hamiltonian) > cutoff)
+            output.set_array('indices', indices)
+            output.set_array('values', hamiltonian[tuple(indices.T)])
+            output.base.attributes.set('shape', list(hamiltonian.shape))
+            output.base.attributes.set('cutoff', cutoff)
+
+        self.out('hamiltonian', output)
+        return None
+
+    def _get_parent_info(self):
+        """Return the structure, k-points and spin settings from the outputs of the parent ``PwCalculation``.
+
+        Used instead of parsing the XML with the ``without_xml`` option: nothing is read from the remote.
+
+        :return: dictionary with the keys ``structure``, ``kpoints``, ``nspin``, ``collinear`` and ``spinorbit``, or
+            None if the parent calculation or its outputs cannot be found.
+        """
+        parent = get_parent_pw_calculation(self.node.inputs.parent_folder)
+        if parent is None or 'output_parameters' not in parent.outputs:
+            return None
+
+        outputs = parent.outputs
+        parameters = outputs.output_parameters.get_dict()
+
+        if 'output_structure' in outputs:
+            structure = outputs.output_structure
+        else:
+            structure = parent.inputs.structure
+
+        if 'output_band' in outputs:
+            kpoints = outputs.output_band
+        elif 'output_kpoints' in outputs:
+            kpoints = outputs.output_kpoints
+        else:
+            kpoints = parent.inputs.kpoints
+
+        return {
+            'structure': structure,
+            'kpoints': kpoints,
+            'nspin': parameters.get('number_of_spin_components'),
+            'collinear': not parameters.get('non_colinear_calculation'),
+            'spinorbit': parameters.get('spin_orbit_calculation'),
+        }
 
     def _parse_xml(self, retrieved_temporary_folder):
         """Parse the XML file.
 
-        The XML must be parsed in order to obtain the required information for the orbital parsing.
+        The XML must be parsed in order to obtain the required information for the orbital parsing. Only the required
+        fields are extracted with ``parse_xml_fast``, falling back to the full ``parse_xml`` of ``aiida-quantumespresso``
+        if the document has an unexpected format.
         """
         from aiida_quantumespresso.parsers.parse_xml.exceptions import XMLParseError, XMLUnsupportedFormatError
         from aiida_quantumespresso.parsers.parse_xml.pw.parse import parse_xml
@@ -87,9 +421,20 @@ class KcwParser(BaseParser):
             self.exit_code_xml = self.exit_codes.ERROR_OUTPUT_XML_MISSING
             return parsed_xml, logs
 
+        try:
+            with xml_filepath.open('rb') as handle:
+                return parse_xml_fast(handle), logs
+        except UnexpectedXMLError as exception:
+            logs.warning.append(f'Fast extraction from the XML failed, falling back to the full parser: {exception}')
+        except IOError:
+            self.exit_code_xml = self.exit_codes.ERROR_OUTPUT_XML_READ
+            return parsed_xml, logs
+
         try:
             with xml_filepath.open('r') as handle:
-                parsed_xml, logs = parse_xml(handle, None)
+                parsed_xml, logs_xml = parse_xml(handle, None)
+                logs.warning.extend(logs_xml.warning)
+                logs.error.extend(logs_xml.error)
         except IOError:
             self.exit_code_xml = self.exit_codes.ERROR_OUTPUT_XML_READ
         except XMLParseError:
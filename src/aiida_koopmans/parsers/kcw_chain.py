@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from aiida.orm import Dict
+from aiida_quantumespresso.utils.mapping import get_logging_container
+
+from aiida_koopmans.parsers.kcw import KcwParser
+
+
+class KcwChainParser(KcwParser):
+    """``Parser`` implementation for the ``KcwChainCalculation`` calculation job class.
+
+    The ``stdout`` of each step is parsed as by the ``KcwParser``, and the outputs of the step are attached in its
+    namespace. The parsing stops at the first step that failed, since the following ones depend on its files.
+    """
+
+    _step = None
+
+    def out(self, link_label, node):
+        """Attach an output, in the namespace of the step being parsed."""
+        if self._step is not None:
+            link_label = f'{self._step}.{link_label}'
+        super().out(link_label, node)
+
+    def parse(self, **kwargs):
+        """Parse the retrieved files from a ``KcwChainCalculation`` into output nodes.
+
+        The parser options of the ``KcwParser`` are supported, and apply to all the steps.
+        """
+        logs = get_logging_container()
+        process_class = self.node.process_class
+        steps = process_class.get_steps(self.node.inputs)
+        summary = {'steps': steps, 'wall_time_seconds': 0.0}
+
+        for step in steps:
+            self._step = step
+            exit_code = self._parse_stdout_outputs(process_class.get_step_filenames(step)[1], step, logs)
+            if exit_code:
+                self.logger.error(f'The {step} step of the chain failed.')
+                return self.exit(exit_code, logs)
+
+            output_parameters = self.outputs[f'{step}.output_parameters']
+            summary['wall_time_seconds'] += output_parameters.get('wall_time_seconds', 0.0)
+            summary.setdefault('code_version', output_parameters.get('code_version', None))
+
+            if step == 'screen':
+                exit_code = self._parse_alphas()
+            elif step == 'ham':
+                exit_code = self._parse_hamiltonian(kwargs.get('retrieved_temporary_folder'))
+                exit_code = exit_code or self._parse_pdos()
+            if exit_code:
+                return self.exit(exit_code, logs)
+
+        self._step = None
+        self.out('output_parameters', Dict(summary))
+
+        _, exit_code = self._parse_parent_info(kwargs.get('retrieved_temporary_folder'))
+        if exit_code:
+            return self.exit(exit_code, logs)
+
+        return self.exit(logs=logs)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from aiida.orm import Dict
+from aiida_quantumespresso.utils.mapping import get_logging_container
+
+from aiida_koopmans.parsers.kcw import KcwParser
+
+
+class KcwPackedParser(KcwParser):
+    """``Parser`` implementation for the ``KcwPackedCalculation`` calculation job class.
+
+    The files of each packed calculation are parsed from its subfolder as by the ``KcwParser``, and its outputs are
+    attached in the namespace of its label. A failed calculation does not prevent the parsing of the other ones.
+    """
+
+    _label = None
+
+    def out(self, link_label, node):
+        """Attach an output, in the namespace of the packed calculation being parsed."""
+        if self._label is not None:
+            link_label = f'calculations.{self._label}.{link_label}'
+        super().out(link_label, node)
+
+    def _get_calculation_inputs(self):
+        """Return the inputs of the packed calculation being parsed."""
+        return self.node.inputs.calculations[self._label]
+
+    def parse(self, **kwargs):
+        """Parse the retrieved files from a ``KcwPackedCalculation`` into output nodes.
+
+        The parser options of the ``KcwParser`` are supported, and apply to all the packed calculations. The structure
+        and k-points of the parent calculations are not parsed, since the XML files are not retrieved.
+        """
+        retrieved_temporary_folder = kwargs.get('retrieved_temporary_folder')
+        process_class = self.node.process_class
+        output_filename = self.node.get_option('output_filename')
+        summary = {'calculations': [], 'failed': {}}
+
+        for label in process_class.get_labels(self.node.inputs):
+            logs = get_logging_container()
+            self._label = label
+            self._subfolder = label
+
+            calculation = process_class.get_calculation(self.node.inputs.calculations[label]['parameters'])
+            exit_code = self._parse_stdout_outputs(output_filename, calculation, logs)
+            exit_code = exit_code or self._parse_alphas()
+            exit_code = exit_code or self._parse_hamiltonian(retrieved_temporary_folder)
+            exit_code = exit_code or self._parse_pdos()
+            self.emit_logs(logs)
+
+            if exit_code:
+                self.logger.error(f'The packed calculation `{label}` failed: {exit_code.message}')
+                summary['failed'][label] = {'exit_status': exit_code.status, 'exit_message': exit_code.message}
+            else:
+                summary['calculations'].append(label)
+
+        self._label = None
+        self._subfolder = ''
+        self.out('output_parameters', Dict(summary))
+
+        if summary['failed']:
+            return self.exit_codes.ERROR_PACKED_CALCULATIONS_FAILED.format(labels=', '.join(summary['failed']))
+
+        return None
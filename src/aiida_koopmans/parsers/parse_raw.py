@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""Parsers of the raw output files of kcw.x.
+
+The ``stdout`` is read once, line by line, and only the parsed quantities are kept in memory. Lines longer than
+``MAX_LINE_LENGTH`` are truncated, and the number of messages and parsed values is capped, so that the memory used to
+parse an output file is bounded whatever its size.
+"""
+import re
+
+import numpy as np
+from aiida_quantumespresso.parsers.parse_raw.base import convert_qe_time_to_sec
+
+MAX_LINE_LENGTH = 4096
+MAX_MESSAGES = 100
+MAX_VALUES = 1_000_000
+
+_FLOAT = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[EeDd][-+]?\d+)?'
+_FLOAT_PATTERN = re.compile(_FLOAT)
+_CODE_PATTERN = re.compile(r'Program\s(?P<code_name>[A-Z|a-z|\_|\d]+)\sv\.(?P<code_version>[\d\.|a-z|A-Z]+)\s')
+_ALPHA_PATTERN = re.compile(rf'iwann\s*\*?\s*=\s*(?P<index>\d+).*?\balpha\s*=\s*(?P<alpha>{_FLOAT})')
+_KPOINT_PATTERN = re.compile(rf'^\s*k\s*=\s*(?P<kpoint>(?:{_FLOAT}\s*){{3}})')
+_EIGENVALUES_PATTERN = re.compile(r'^\s*(?P<label>KS|KI)\s+(?P<values>[-+\d.\sEeDd]+)$')
+_FRONTIER_PATTERN = re.compile(r'^\s*(?P<label>KS|KI)\s+highest occupied(?P<lumo>, lowest unoccupied)? level')
+_CLOCK_PATTERN = re.compile(r'^\s*(?P<name>\S+)\s*:\s*(?P<cpu>[\d.smhd ]+?)\s*CPU\s+(?P<wall>[\d.smhd ]+?)\s*WALL'
+                            r'(?:\s*\(\s*(?P<calls>\d+)\s*calls\))?')
+_LAYOUT_PATTERNS = {
+    'mpi_processes': re.compile(r'Number of MPI processes:\s*(\d+)'),
+    'threads_per_mpi_process': re.compile(r'Threads/MPI process:\s*(\d+)'),
+    'nodes': re.compile(r'MPI processes distributed on\s*(\d+)\s*nodes'),
+    'npool': re.compile(r'npool\s*=\s*(\d+)'),
+}
+_RAM_PATTERN = re.compile(r'Estimated (?P<kind>max dynamical RAM per process|total dynamical RAM)\s*>\s*'
+                          rf'(?P<value>{_FLOAT})\s*(?P<unit>[KMG]B)')
+_RAM_KEYS = {'max dynamical RAM per process': 'ram_per_process_mb', 'total dynamical RAM': 'ram_total_mb'}
+_RAM_UNITS = {'KB': 1 / 1024, 'MB': 1, 'GB': 1024}
+
+
+def iter_lines(handle, max_line_length=MAX_LINE_LENGTH):
+    """Yield the lines of a text handle, truncated to ``max_line_length`` characters.
+
+    The remainder of a truncated line is read in chunks and discarded, so a single huge line is never held in memory.
+    """
+    while True:
+        line = handle.readline(max_line_length)
+        if not line:
+            return
+        if len(line) == max_line_length and not line.endswith('\n'):
+            while True:
+                remainder = handle.readline(max_line_length)
+                if not remainder or remainder.endswith('\n'):
+                    break
+        yield line.rstrip('\n')
+
+
+def _to_floats(string):
+    """Return the list of floats in a string, also accepting Fortran ``D`` exponents."""
+    return [float(value.replace('D', 'E').replace('d', 'e')) for value in _FLOAT_PATTERN.findall(string)]
+
+
+class _Collector:
+    """Accumulate values up to a total of ``MAX_VALUES``, recording whether values were dropped."""
+
+    def __init__(self, max_values=MAX_VALUES):
+        self.remaining = max_values
+        self.truncated = False
+
+    def extend(self, target, values):
+        """Append the ``values`` to the ``target`` list, within the remaining budget."""
+        if len(values) > self.remaining:
+            values = values[:self.remaining]
+            self.truncated = True
+        target.extend(values)
+        self.remaining -= len(values)
+
+
+def parse_stdout(handle, logs, error_map, warning_map, success_string='JOB DONE'):
+    """Parse the ``stdout`` of kcw.x from a text handle, reading it line by line.
+
+    Besides the quantities parsed by the ``BaseParser`` of ``aiida-quantumespresso`` (code version, wall time, known
+    errors and warnings, messages between ``%%%%%`` lines and the check for the success string), this parses:
+
+    * ``warnings``: the (at most ``MAX_MESSAGES``) unique lines with a warning marker;
+    * ``alphas`` and ``orbital_indices``: the screening parameters printed by the ``screen`` calculation, sorted by
+      orbital index, and the indices of the orbitals;
+    * ``eigenvalues_ks``, ``eigenvalues_ki`` and ``kpoints_eigenvalues``: the eigenvalues (eV) for each k-point printed
+      by the ``ham`` calculation;
+    * ``homo_ks``, ``lumo_ks``, ``homo_ki`` and ``lumo_ki``: the frontier levels (eV) of the ``ham`` calculation;
+    * ``performance``: the report of the run, i.e. the total ``wall_time_seconds`` and ``cpu_time_seconds``, the
+      (at most ``MAX_MESSAGES``) ``clocks`` of the routines with their CPU and wall times (s) and number of calls, the
+      parallelisation (``mpi_processes``, ``threads_per_mpi_process``, ``nodes`` and ``npool``) and the estimated
+      dynamical memory (``ram_per_process_mb`` and ``ram_total_mb``).
+
+    :param handle: text handle of the ``stdout``.
+    :param logs: logging container, updated during parsing.
+    :param error_map: mapping of error markers (regular expressions) to the error appended to ``logs.error``.
+    :param warning_map: mapping of warning markers (regular expressions) to the warning appended to ``logs.warning``,
+        or ``None`` to only collect the line in the ``warnings``.
+    :param success_string: the string marking a successful completion.
+    :returns: tuple of the parsed data and of the updated logs.
+    """
+    parsed_data = {}
+    collector = _Collector()
+
+    error_patterns = [(re.compile(marker), error) for marker, error in error_map.items()]
+    warning_patterns = [(re.compile(marker), warning) for marker, warning in warning_map.items()]
+    errors_found, warnings_found, warning_lines = set(), set(), []
+    error_messages, message_lines, in_message = [], [], False
+
+    success, wall_pattern = False, None
+    alphas = {}
+    eigenvalues = {'KS': [], 'KI': []}
+    kpoints, current = [], None
+    performance, clocks = {}, {}
+
+    for line in iter_lines(handle):
+
+        if success_string in line:
+            success = True
+
+        if '%%%%%' in line:
+            if in_message:
+                message = '\n'.join(message_lines)
+                if message not in error_messages and len(error_messages) < MAX_MESSAGES:
+                    error_messages.append(message)
+                message_lines = []
+            in_message = not in_message
+            continue
+
+        for pattern, error in error_patterns:
+            if error not in errors_found and pattern.search(line):
+                errors_found.add(error)
+
+        if in_message:
+            if len(message_lines) < MAX_MESSAGES:
+                message_lines.append(line)
+            continue
+
+        for pattern, warning in warning_patterns:
+            if pattern.search(line):
+                if warning is not None:
+                    warnings_found.add(warning)
+                if line.strip() not in warning_lines and len(warning_lines) < MAX_MESSAGES:
+                    warning_lines.append(line.strip())
+
+        if wall_pattern is None:
+            match = _CODE_PATTERN.search(line)
+            if match:
+                parsed_data['code_version'] = match.group('code_version')
+                code_name = re.escape(match.group('code_name'))
+                wall_pattern = re.compile(rf'{code_name}\s+:.*CPU\s+(?P<wall_time>[\s.\d|s|m|d|h]+)\sWALL')
+            continue
+
+        if 'WALL' in line:
+            match = wall_pattern.search(line)
+            if match:
+                try:
+                    parsed_data['wall_time_seconds'] = convert_qe_time_to_sec(match.group('wall_time'))
+                except ValueError:
+                    logs.warning.append('Unable to convert wall time from `stdout` to seconds.')
+
+            match = _CLOCK_PATTERN.match(line)
+            if match and (match.group('name') in clocks or len(clocks) < MAX_MESSAGES):
+                try:
+                    cpu, wall = convert_qe_time_to_sec(match.group('cpu')), convert_qe_time_to_sec(match.group('wall'))
+                except ValueError:
+                    continue
+                if match.group('calls') is None:
+                    performance.update({'cpu_time_seconds': cpu, 'wall_time_seconds': wall})
+                else:
+                    clocks[match.group('name')] = {
+                        'cpu_seconds': cpu, 'wall_seconds': wall, 'calls': int(match.group('calls'))
+                    }
+            continue
+
+        if 'RAM' in line:
+            match = _RAM_PATTERN.search(line)
+            if match:
+                value = float(match.group('value')) * _RAM_UNITS[match.group('unit')]
+                performance[_RAM_KEYS[match.group('kind')]] = value
+                continue
+
+        if 'MPI' in line or 'npool' in line:
+            for key, pattern in _LAYOUT_PATTERNS.items():
+                match = pattern.search(line)
+                if match:
+                    performance[key] = int(match.group(1))
+
+        if 'iwann' in line:
+            match = _ALPHA_PATTERN.search(line)
+            if match and (match.group('index') in alphas or collector.remaining > 0):
+                if match.group('index') not in alphas:
+                    collector.remaining -= 1
+                alphas[match.group('index')] = _to_floats(match.group('alpha'))[0]
+            continue
+
+        match = _KPOINT_PATTERN.match(line)
+        if match:
+            kpoints.append(_to_floats(match.group('kpoint')))
+            eigenvalues['KS'].append([])
+            eigenvalues['KI'].append([])
+            current = None
+            continue
+
+        match = _FRONTIER_PATTERN.match(line)
+        if match:
+            label = match.group('label').lower()
+            values = _to_floats(line[match.end():])
+            if values:
+                parsed_data[f'homo_{label}'] = values[0]
+            if match.group('lumo') and len(values) > 1:
+                parsed_data[f'lumo_{label}'] = values[1]
+            current = None
+            continue
+
+        if kpoints:
+            match = _EIGENVALUES_PATTERN.match(line)
+            if match:
+                current = match.group('label')
+                collector.extend(eigenvalues[current][-1], _to_floats(match.group('values')))
+                continue
+            if current is not None:
+                values = _to_floats(line) if line.strip() else []
+                if values and len(values) == len(line.split()):
+                    collector.extend(eigenvalues[current][-1], values)
+                else:
+                    current = None
+
+    if not success:
+        logs.error.append('ERROR_OUTPUT_STDOUT_INCOMPLETE')
+
+    # The messages with an error marker are replaced by the mapped error, found when searching the lines of the message
+    for message in error_messages:
+        if not any(pattern.search(message) for pattern, _ in error_patterns):
+            logs.error.append(message)
+
+    logs.error.extend(sorted(errors_found))
+    logs.warning.extend(sorted(warnings_found))
+
+    if collector.truncated:
+        logs.warning.append(f'More than {MAX_VALUES} values in the `stdout`: the remaining ones were not parsed.')
+
+    if warning_lines:
+        parsed_data['warnings'] = warning_lines
+
+    if alphas:
+        parsed_data['orbital_indices'] = sorted(int(index) for index in alphas)
+        parsed_data['alphas'] = [alphas[str(index)] for index in parsed_data['orbital_indices']]
+
+    if clocks:
+        performance['clocks'] = clocks
+
+    if performance:
+        parsed_data['performance'] = performance
+
+    if kpoints:
+        parsed_data['kpoints_eigenvalues'] = kpoints
+        for label, values in eigenvalues.items():
+            if any(values):
+                parsed_data[f'eigenvalues_{label.lower()}'] = values
+
+    return parsed_data, logs
+
+
+def parse_alpha_file(handle):
+    """Parse a ``file_alpharef.txt`` or ``file_alpharef_empty.txt`` file written by the kcw.x screening.
+
+    The first line contains the number of orbitals, and each of the following lines the orbital index, its screening
+    parameter and its self-Hartree.
+
+    :param handle: text handle of the file.
+    :returns: tuple of the orbital indices (int) and the screening parameters (float) as NumPy arrays.
+    """
+    num_orbitals = int(handle.readline().split()[0])
+    if num_orbitals == 0:
+        return np.zeros(0, dtype=int), np.zeros(0)
+
+    table = np.loadtxt(handle, max_rows=num_orbitals, usecols=(0, 1), ndmin=2)
+    if table.shape[0] != num_orbitals:
+        raise ValueError(f'expected {num_orbitals} orbitals, found {table.shape[0]}')
+
+    return table[:, 0].astype(int), table[:, 1]
+
+
+def parse_pdos_tot_file(handle):
+    """Parse a ``pdos_tot`` file, with the total DOS and the sum of the projected DOS.
+
+    The columns are the energy (eV), then the DOS and then the PDOS for each spin component, i.e. ``E dos(E) pdos(E)``
+    or ``E dosup(E) dosdw(E) pdosup(E) pdosdw(E)``. The whole table is loaded in one go with NumPy.
+
+    :param handle: text handle of the file.
+    :returns: tuple of the energies with shape ``(nE,)``, and of the DOS and PDOS with shape ``(nE, nspin)``.
+    """
+    table = np.loadtxt(handle, ndmin=2)
+    if table.shape[1] not in (3, 5):
+        raise ValueError(f'expected 3 or 5 columns, found {table.shape[1]}')
+
+    num_spin = (table.shape[1] - 1) // 2
+    return table[:, 0], table[:, 1:1 + num_spin], table[:, 1 + num_spin:]
+
+
+def gaussian_dos(energies, eigenvalues, degauss, weights=None):
+    """Return the DOS on an energy grid, broadening each eigenvalue with a normalised Gaussian of width ``degauss``.
+
+    The kernel is evaluated for the whole energy grid at once, in chunks of eigenvalues so that the intermediate array
+    stays of bounded size.
+
+    :param energies: the energy grid, with shape ``(nE,)``.
+    :param eigenvalues: the eigenvalues, with shape ``(nk, nbands)``, in the units of the energy grid.
+    :param degauss: the standard deviation of the Gaussian, in the units of the energy grid.
+    :param weights: the weights of the k-points with shape ``(nk,)``, by default uniform and summing to one.
+    :returns: the DOS, with shape ``(nE,)``.
+    """
+    energies = np.asarray(energies, dtype=float)
+    eigenvalues = np.atleast_2d(np.asarray(eigenvalues, dtype=float))
+    if weights is None:
+        weights = np.full(eigenvalues.shape[0], 1 / eigenvalues.shape[0])
+
+    values = eigenvalues.ravel()
+    value_weights = np.repeat(np.asarray(weights, dtype=float), eigenvalues.shape[1])
+
+    dos = np.zeros_like(energies)
+    chunk_size = max(1, MAX_VALUES // max(1, len(energies)))
+    for start in range(0, len(values), chunk_size):
+        delta = (energies[:, None] - values[None, start:start + chunk_size]) / degauss
+        dos += np.exp(-0.5 * delta**2) @ value_weights[start:start + chunk_size]
+
+    return dos / (degauss * np.sqrt(2 * np.pi))
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Targeted extraction of the few quantities needed by the ``KcwParser`` from the XML file of pw.x.
+
+The ``parse_xml`` of ``aiida-quantumespresso`` validates and converts the whole document against its schema, while the
+``KcwParser`` only needs the structure, the k-points and the spin settings. Here the document is read incrementally,
+keeping in memory only these fields, and the reading stops at the end of the band structure.
+"""
+from xml.etree.ElementTree import ParseError, iterparse
+
+import numpy as np
+from qe_tools import CONSTANTS
+
+
+class UnexpectedXMLError(Exception):
+    """Raised when the XML does not have the expected (post QE v6.2) format, and the full parser should be used."""
+
+
+def _local_name(tag):
+    """Return the tag without namespace."""
+    return tag.rpartition('}')[2]
+
+
+def _to_bool(text):
+    return text.strip().lower() in ('true', '1', '.true.')
+
+
+def _to_floats(text):
+    return [float(value) for value in text.split()]
+
+
+def parse_xml_fast(handle):
+    """Extract the structure, k-points and spin settings from the XML file written by pw.x (QE v6.2 and later).
+
+    The returned dictionary has the same keys and units as the corresponding ones returned by the ``parse_xml`` of
+    ``aiida-quantumespresso``, so it can be passed to ``convert_qe_to_aiida_structure`` (``structure`` key) and to
+    ``convert_qe_to_kpoints``.
+
+    :param handle: binary handle of the XML file.
+    :returns: the dictionary with the keys ``structure``, ``k_points``, ``k_points_weights``, ``k_points_units``,
+        ``lsda``, ``non_colinear_calculation``, ``spin_orbit_calculation`` and ``number_of_spin_components``.
+    :raises UnexpectedXMLError: if the file cannot be parsed or a required field is missing.
+    """
+    path = []
+    alat = None
+    atoms, cell = [], {}
+    spin = {}
+    noncolin = None
+    k_points, k_points_weights = [], []
+    band_structure_done = False
+
+    try:
+        for event, element in iterparse(handle, events=('start', 'end')):
+            name = _local_name(element.tag)
+
+            if event == 'start':
+                if not path and name != 'espresso':
+                    raise UnexpectedXMLError(f'unexpected root element `{name}`')
+                path.append(name)
+                continue
+
+            parent = path[-2] if len(path) > 1 else None
+            section = path[1] if len(path) > 1 else None
+
+            if section == 'input' and parent == 'spin' and name in ('lsda', 'spinorbit'):
+                spin[name] = _to_bool(element.text)
+            elif section == 'output':
+                if name == 'atomic_structure' and parent == 'output':
+                    alat = float(element.get('alat'))
+                elif name == 'atom' and parent == 'atomic_positions':
+                    atoms.append([element.get('name'), _to_floats(element.text)])
+                elif name in ('a1', 'a2', 'a3') and parent == 'cell':
+                    cell[name] = _to_floats(element.text)
+                elif name == 'noncolin' and parent == 'magnetization':
+                    noncolin = _to_bool(element.text)
+                elif name == 'k_point' and parent == 'ks_energies':
+                    k_points.append(_to_floats(element.text))
+                    k_points_weights.append(float(element.get('weight')))
+                elif name == 'band_structure':
+                    band_structure_done = True
+
+            path.pop()
+            element.clear()
+
+            if band_structure_done:
+                break
+    except ParseError as exception:
+        raise UnexpectedXMLError('error while parsing XML file') from exception
+    except (TypeError, ValueError) as exception:
+        raise UnexpectedXMLError(f'unexpected content in the XML file: {exception}') from exception
+
+    if alat is None or not atoms or len(cell) != 3 or not k_points or not band_structure_done:
+        raise UnexpectedXMLError('the XML file does not contain the structure and the band structure.')
+
+    lsda = spin.get('lsda', False)
+    spin_orbit_calculation = spin.get('spinorbit', False)
+    non_colinear_calculation = bool(noncolin)
+
+    if non_colinear_calculation or spin_orbit_calculation:
+        nspin = 4
+    elif lsda:
+        nspin = 2
+    else:
+        nspin = 1
+
+    alat_angstrom = alat * CONSTANTS.bohr_to_ang
+    lattice_vectors = (np.array([cell['a1'], cell['a2'], cell['a3']]) * CONSTANTS.bohr_to_ang).tolist()
+    atoms = [[name, (np.array(position) * CONSTANTS.bohr_to_ang).tolist()] for name, position in atoms]
+
+    return {
+        'structure': {
+            'atomic_positions_units': 'Angstrom',
+            'direct_lattice_vectors_units': 'Angstrom',
+            'number_of_atoms': len(atoms),
+            'lattice_parameter': alat_angstrom,
+            'lattice_parameter_xml': alat,
+            'atoms': atoms,
+            'cell': {
+                'lattice_vectors': lattice_vectors,
+                'atoms': atoms,
+            },
+        },
+        'k_points': (np.array(k_points) * 2 * np.pi / alat_angstrom).tolist(),
+        'k_points_weights': k_points_weights,
+        'k_points_units': '1 / angstrom',
+        'lsda': lsda,
+        'non_colinear_calculation': non_colinear_calculation,
+        'spin_orbit_calculation': spin_orbit_calculation,
+        'number_of_spin_components': nspin,
+    }
@@ -0,0 +1,7 @@
+"""
+aiida_koopmans
+
+AiiDA  plugin that wraps the `kcw' executable.
+"""
+
+__version__ = "0.1.0a0"
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""Workchain to run a kcw.x calculation with automated error handling and restarts."""
+import numpy as np
+
+from aiida import orm
+from aiida.common import AttributeDict
+from aiida.engine import BaseRestartWorkChain, ProcessHandlerReport, calcfunction, process_handler, while_
+from aiida_quantumespresso.calculations import _lowercase_dict, _uppercase_dict
+
+from aiida_koopmans.calculations.kcw import KcwCalculation
+from aiida_koopmans.data.utils import generate_singlefiledata
+
+# The command line flags of Quantum ESPRESSO that set the number of pools
+POOL_FLAGS = ('-nk', '-npool', '-npools')
+
+
+@calcfunction
+def merge_alphas(parameters, **output_parameters):
+    """Return the ``alphas`` of a screening computed in several runs of a ``screen`` calculation.
+
+    :param parameters: the parameters of the ``screen`` calculation, with the ``num_wann_occ`` of the ``WANNIER``
+        namelist.
+    :param output_parameters: the ``output_parameters`` of the runs, with the screening parameters ``alphas`` of the
+        orbitals ``orbital_indices``. The values of the later runs, by sorted keyword, take precedence.
+    :return: an ``ArrayData`` with the same arrays as the ``alphas`` output of the ``KcwCalculation``.
+    """
+    alphas = {}
+    for key in sorted(output_parameters):
+        run = output_parameters[key].get_dict()
+        alphas.update(zip(run.get('orbital_indices', []), run.get('alphas', [])))
+
+    num_wann_occ = KcwBaseWorkChain.get_namelist(parameters.get_dict(), 'WANNIER')['num_wann_occ']
+    indices = np.array(sorted(alphas), dtype=int)
+    occupied = indices <= num_wann_occ
+
+    output = orm.ArrayData()
+    output.set_array('alphas', np.array([alphas[index] for index in indices], dtype=float))
+    output.set_array('orbital_indices', np.where(occupied, indices, indices - num_wann_occ))
+    output.set_array('occupied', occupied)
+    return output
+
+
+@calcfunction
+def merge_alpha_files(**retrieved):
+    """Return the files with the screening parameters of a screening computed in one or more runs of kcw.x.
+
+    :param retrieved: the ``retrieved`` folders of the runs of the ``screen`` calculation. The lines of the orbitals
+        screened by the later runs, by sorted keyword, take precedence.
+    :return: the ``SingleFileData`` of the manifolds ``occ`` and ``emp`` whose file was written by any run.
+    """
+    files = {}
+    for manifold, filename in KcwCalculation._alpha_files.items():
+        lines = {}
+        for key in sorted(retrieved):
+            if filename not in retrieved[key].base.repository.list_object_names():
+                continue
+            content = retrieved[key].base.repository.get_object_content(filename).splitlines()
+            num_orbitals = int(content[0].split()[0])
+            lines.update({int(line.split()[0]): line for line in content[1:num_orbitals + 1]})
+        if lines:
+            content = [f'{len(lines)}'] + [lines[index] for index in sorted(lines)]
+            files[manifold] = generate_singlefiledata(filename, '\n'.join(content) + '\n')
+    return files
+
+
+class KcwBaseWorkChain(BaseRestartWorkChain):
+    """Workchain to run a kcw.x calculation with automated error handling and restarts.
+
+    A ``screen`` calculation that runs out of walltime is restarted for the orbitals whose screening parameters were not
+    printed yet, one orbital at a time with the ``i_orb`` of the ``SCREEN`` namelist, and the screening parameters of
+    all the runs are merged into the ``alphas`` output. This requires the ``num_wann_occ`` of the ``WANNIER`` namelist.
+    The restarts for the next orbital are not counted against the ``max_iterations``, which limits the restarts of the
+    screening of each orbital. Other calculations that run out of walltime are restarted with a longer walltime.
+    Calculations that run out of memory are restarted with fewer pools, or on more machines.
+    """
+
+    _process_class = KcwCalculation
+
+    defaults = AttributeDict({
+        'delta_factor_max_seconds': 1.5,
+        'delta_factor_num_machines': 2,
+        'delta_factor_pools': 0.5,
+    })
+
+    @classmethod
+    def define(cls, spec):
+        """Define the process specification."""
+        # yapf: disable
+        super().define(spec)
+        spec.expose_inputs(KcwCalculation, namespace='kcw')
+        spec.input('max_num_machines', valid_type=orm.Int, required=False,
+            help='The maximum number of machines on which a calculation that ran out of memory is restarted.')
+        spec.outline(
+            cls.setup,
+            while_(cls.should_run_process)(
+                cls.run_process,
+                cls.inspect_process,
+            ),
+            cls.results,
+        )
+        spec.expose_outputs(KcwCalculation)
+        spec.exit_code(300, 'ERROR_UNRECOVERABLE_FAILURE',
+            message='The calculation failed with an unrecoverable error.')
+        spec.exit_code(310, 'ERROR_SCREENING_ORBITAL_MISSING',
+            message='The screening parameter of the orbital {orbital} was not computed by the screen calculation.')
+        # yapf: enable
+
+    @staticmethod
+    def get_namelist(parameters, name):
+        """Return a namelist of the ``parameters`` of kcw.x, with lowercase keys, whatever the case of the input."""
+        parameters = _uppercase_dict(parameters, dict_name='parameters')
+        return _lowercase_dict(parameters.get(name, {}), dict_name=name)
+
+    def setup(self):
+        """Call the ``setup`` of the ``BaseRestartWorkChain`` and create the inputs dictionary in ``self.ctx.inputs``.
+
+        The orbitals to screen are stored in ``self.ctx.orbitals`` for a ``screen`` calculation of all the orbitals
+        with the ``num_wann_occ`` of the ``WANNIER`` namelist, such that it can be restarted orbital by orbital.
+        """
+        super().setup()
+        self.ctx.inputs = AttributeDict(self.exposed_inputs(KcwCalculation, 'kcw'))
+        self.ctx.orbitals = []
+        self.ctx.alphas = {}
+        self.ctx.screening_runs = []
+
+        calculation = KcwCalculation.get_calculation(self.ctx.inputs.parameters)
+        parameters = self.ctx.inputs.parameters.get_dict()
+        wannier = self.get_namelist(parameters, 'WANNIER')
+        i_orb = self.get_namelist(parameters, 'SCREEN').get('i_orb', -1)
+
+        if calculation == 'screen' and 'num_wann_occ' in wannier and i_orb <= 0:
+            self.ctx.orbitals = list(range(1, wannier['num_wann_occ'] + wannier.get('num_wann_emp', 0) + 1))
+
+    def report_error_handled(self, calculation, action):
+        """Report an action taken for a calculation that has failed.
+
+        :param calculation: the failed calculation node
+        :param action: a string message with the action taken
+        """
+        arguments = [calculation.process_label, calculation.pk, calculation.exit_status, calculation.exit_message]
+        self.report('{}<{}> failed with exit status {}: {}'.format(*arguments))
+        self.report(f'Action taken: {action}')
+
+    def inspect_process(self):
+        """Collect the screening parameters printed by the last calculation, and call the process handlers."""
+        node = self.ctx.children[self.ctx.iteration - 1]
+
+        if self.ctx.orbitals and 'output_parameters' in node.outputs:
+            output_parameters = node.outputs.output_parameters.get_dict()
+            alphas = zip(output_parameters.get('orbital_indices', []), output_parameters.get('alphas', []))
+            self.ctx.alphas.update({str(index): alpha for index, alpha in alphas})
+
+        return super().inspect_process()
+
+    def get_remaining_orbitals(self):
+        """Return the orbitals to screen whose screening parameter was not computed yet."""
+        return [orbital for orbital in self.ctx.orbitals if str(orbital) not in self.ctx.alphas]
+
+    def set_screening_orbital(self, orbital):
+        """Set the ``i_orb`` of the ``SCREEN`` namelist, to screen only the given orbital.
+
+        The last calculation is moved from ``self.ctx.children`` to ``self.ctx.screening_runs``, such that the restart
+        for the next orbital is not counted in ``self.ctx.iteration`` against the ``max_iterations``.
+        """
+        parameters = _uppercase_dict(self.ctx.inputs.parameters.get_dict(), dict_name='parameters')
+        parameters['SCREEN'] = {**_lowercase_dict(parameters.get('SCREEN', {}), dict_name='SCREEN'), 'i_orb': orbital}
+        self.ctx.inputs.parameters = orm.Dict(parameters)
+        self.ctx.screening_runs.append(self.ctx.children.pop(self.ctx.iteration - 1))
+        self.ctx.iteration -= 1
+
+    def results(self):
+        """Attach the outputs of the last calculation, with the ``alphas`` of all the runs of a restarted screening."""
+        if not self.ctx.orbitals or (not self.ctx.screening_runs and self.ctx.iteration == 1):
+            return super().results()
+
+        node = self.ctx.children[self.ctx.iteration - 1]
+        runs = sorted(self.ctx.screening_runs + self.ctx.children, key=lambda child: child.pk)
+        self.report(f'work chain completed after {len(runs)} calculations')
+
+        output_parameters = {
+            f'run_{index:04d}': child.outputs.output_parameters
+            for index, child in enumerate(runs)
+            if 'output_parameters' in child.outputs
+        }
+        outputs = self.exposed_outputs(node, KcwCalculation)
+        outputs['alphas'] = merge_alphas(self.inputs.kcw.parameters, **output_parameters)
+        self.out_many(outputs)
+        return None
+
+    @process_handler(priority=600, exit_codes=[KcwCalculation.exit_codes.ERROR_SCHEDULER_OUT_OF_MEMORY])
+    def handle_out_of_memory(self, calculation):
+        """Handle calculations that ran out of memory.
+
+        The number of pools, which replicate the wavefunctions, is reduced first, whether given as ``-nk 4`` or as
+        ``-nk=4`` in the ``CMDLINE`` of the ``settings``, and the work chain aborts if it cannot be read. With a single
+        pool, the calculation is restarted on more machines with the same number of MPI processes per machine, up to
+        ``max_num_machines``.
+        """
+        settings = _uppercase_dict(self.ctx.inputs.settings.get_dict(), dict_name='settings')
+        cmdline = list(settings.get('CMDLINE', []))
+
+        for index, param in enumerate(cmdline):
+            flag, separator, value = str(param).partition('=')
+            if flag not in POOL_FLAGS:
+                continue
+            if not separator:
+                value = cmdline[index + 1] if index + 1 < len(cmdline) else ''
+            try:
+                num_pools = int(value)
+            except (TypeError, ValueError):
+                action = f'the number of pools `{value}` of `{flag}` is invalid, aborting'
+                self.report_error_handled(calculation, action)
+                return ProcessHandlerReport(True, self.exit_codes.ERROR_UNRECOVERABLE_FAILURE)
+            if num_pools > 1:
+                num_pools = max(1, int(num_pools * self.defaults.delta_factor_pools))
+                if separator:
+                    cmdline[index] = f'{flag}={num_pools}'
+                else:
+                    cmdline[index + 1] = str(num_pools)
+                self.ctx.inputs.settings = orm.Dict({**settings, 'CMDLINE': cmdline})
+                self.report_error_handled(calculation, f'reducing the number of pools to {num_pools} and restarting')
+                return ProcessHandlerReport(True)
+
+        resources = dict(self.ctx.inputs.metadata['options']['resources'])
+        num_machines = resources.get('num_machines', 1) * self.defaults.delta_factor_num_machines
+
+        if 'max_num_machines' in self.inputs and num_machines > self.inputs.max_num_machines.value:
+            self.report_error_handled(calculation, 'the maximum number of machines is reached, aborting')
+            return ProcessHandlerReport(True, self.exit_codes.ERROR_UNRECOVERABLE_FAILURE)
+
+        if 'tot_num_mpiprocs' in resources:
+            resources['tot_num_mpiprocs'] *= num_machines // resources.get('num_machines', 1)
+        resources['num_machines'] = num_machines
+        self.ctx.inputs.metadata['options']['resources'] = resources
+        self.report_error_handled(calculation, f'restarting on {num_machines} machines')
+        return ProcessHandlerReport(True)
+
+    @process_handler(
+        priority=500,
+        exit_codes=[
+            KcwCalculation.exit_codes.ERROR_SCHEDULER_OUT_OF_WALLTIME,
+            KcwCalculation.exit_codes.ERROR_OUT_OF_WALLTIME,
+        ]
+    )
+    def handle_out_of_walltime(self, calculation):
+        """Handle calculations that ran out of walltime.
+
+        If the calculation is a screening that computed the screening parameters of some orbitals, the remaining ones
+        are screened one at a time. Otherwise the calculation is restarted from scratch with a longer walltime, e.g. if
+        the screening of a single orbital ran out of walltime.
+        """
+        remaining = self.get_remaining_orbitals()
+        i_orb = self.get_namelist(calculation.inputs.parameters.get_dict(), 'SCREEN').get('i_orb', -1)
+
+        if remaining and i_orb not in remaining:
+            self.set_screening_orbital(remaining[0])
+            action = f'{len(remaining)} orbitals left to screen, restarting with the orbital {remaining[0]}'
+            self.report_error_handled(calculation, action)
+            return ProcessHandlerReport(True)
+
+        max_seconds = calculation.get_option('max_wallclock_seconds')
+        if max_seconds is None:
+            self.report_error_handled(calculation, 'the walltime is set by the scheduler and cannot be increased')
+            return ProcessHandlerReport(True, self.exit_codes.ERROR_UNRECOVERABLE_FAILURE)
+
+        max_seconds = int(max_seconds * self.defaults.delta_factor_max_seconds)
+        self.ctx.inputs.metadata['options']['max_wallclock_seconds'] = max_seconds
+        self.report_error_handled(calculation, f'restarting with a walltime of {max_seconds} seconds')
+        return ProcessHandlerReport(True)
+
+    @process_handler(priority=400)
+    def handle_remaining_orbitals(self, calculation):
+        """Screen the next remaining orbital after a successful screening of a single orbital."""
+        if not calculation.is_finished_ok or not self.ctx.orbitals:
+            return None
+
+        remaining = self.get_remaining_orbitals()
+        if not remaining:
+            return None
+
+        i_orb = self.get_namelist(calculation.inputs.parameters.get_dict(), 'SCREEN').get('i_orb', -1)
+        if remaining[0] == i_orb:
+            self.report(f'{calculation.process_label}<{calculation.pk}> did not print the screening parameter.')
+            return ProcessHandlerReport(True, self.exit_codes.ERROR_SCREENING_ORBITAL_MISSING.format(orbital=i_orb))
+
+        self.set_screening_orbital(remaining[0])
+        self.report(f'{len(remaining)} orbitals left to screen, restarting with the orbital {remaining[0]}')
+        return ProcessHandlerReport(True)
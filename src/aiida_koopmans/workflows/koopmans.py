@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""Workchain to run the Koopmans functional calculations with DFPT, from the DFT ground state to the Hamiltonian."""
+from aiida import orm
+from aiida.common import AttributeDict
+from aiida.engine import ToContext, WorkChain, calcfunction
+from aiida_quantumespresso.workflows.pw.base import PwBaseWorkChain
+
+from aiida_koopmans.calculations.kcw import KcwCalculation
+from aiida_koopmans.data.utils import extract_wannier90_files
+from aiida_koopmans.helpers import KCW_WANNIER90_INPUTS, get_kcw_wannier90_inputs
+from aiida_koopmans.workflows.base import KcwBaseWorkChain, merge_alpha_files
+
+# The manifolds that are wannierized, with the namespace of the inputs of their `Wannier90BandsWorkChain`
+WANNIER_NAMESPACES = {
+    'occ': 'wannier_occ',
+    'emp': 'wannier_emp',
+}
+
+
+def get_wannier90_bands_workchain():
+    """Return the ``Wannier90BandsWorkChain``, imported only when needed.
+
+    ``aiida-wannier90-workflows`` is an optional dependency, installed with the ``wannier90`` extra, such that this
+    module can be imported without it.
+    """
+    from aiida_wannier90_workflows.workflows import Wannier90BandsWorkChain  # pylint: disable=import-outside-toplevel
+    return Wannier90BandsWorkChain
+
+
+@calcfunction
+def get_wannier90_inputs_from_nscf(structure, output_band, output_parameters, parameters):
+    """Return the inputs of the Wannier90 calculation that are taken from the outputs of the nscf calculation.
+
+    :param structure: the structure of the nscf calculation.
+    :param output_band: the ``output_band`` of the nscf, with its explicit k-points.
+    :param output_parameters: the ``output_parameters`` of the nscf, with its Fermi energy.
+    :param parameters: the Wannier90 parameters, to which the Fermi energy is added.
+    :return: the explicit ``kpoints`` of the nscf, and the Wannier90 ``parameters`` with the ``fermi_energy``.
+    """
+    kpoints = orm.KpointsData()
+    kpoints.set_cell_from_structure(structure)
+    kpoints.set_kpoints(output_band.get_array('kpoints'), cartesian=False)
+
+    output_parameters = output_parameters.get_dict()
+    fermi_energy = output_parameters.get('fermi_energy_up', output_parameters.get('fermi_energy'))
+    return {'kpoints': kpoints, 'parameters': orm.Dict({**parameters.get_dict(), 'fermi_energy': fermi_energy})}
+
+
+def get_manifold_wannier90_files(workchain):
+    """Return the Wannier90 files of a manifold wannierized by a ``Wannier90BandsWorkChain``.
+
+    The files are extracted from the retrieved folder of its Wannier90 calculation by the ``extract_wannier90_files``
+    calcfunction, with the ``_u_dis.mat`` file if the manifold was disentangled.
+
+    :param workchain: the finished ``Wannier90BandsWorkChain`` of the manifold.
+    """
+    return extract_wannier90_files(workchain.outputs.wannier90.retrieved)
+
+
+def get_kcw_step_inputs(inputs, calculation, parent_folder, wannier90_files):
+    """Return the inputs of the ``KcwBaseWorkChain`` of a kcw.x step, completed with the outputs of the previous steps.
+
+    :param inputs: the inputs of the ``KcwBaseWorkChain`` given for the step.
+    :param calculation: the kcw.x ``calculation`` type, i.e. one of ``wann2kcw``, ``screen`` or ``ham``.
+    :param parent_folder: the output folder of the previous step.
+    :param wannier90_files: the Wannier90 files of the ``occ`` and ``emp`` manifolds, see ``get_kcw_wannier90_inputs``.
+    """
+    inputs = AttributeDict(inputs)
+    inputs.kcw = AttributeDict(inputs.kcw)
+    inputs.kcw.parent_folder = parent_folder
+    control = KcwBaseWorkChain.get_namelist(inputs.kcw.parameters.get_dict(), 'CONTROL')
+    inputs.kcw.update(get_kcw_wannier90_inputs(wannier90_files, calculation, control))
+    return inputs
+
+
+def get_screening_alpha_files(workchain):
+    """Return the inputs of a ``KcwCalculation`` with the files of the screening parameters of a screen calculation.
+
+    The files are merged from all the runs of the calculation, see ``merge_alpha_files``, since a screening restarted
+    after running out of walltime is split in several runs.
+
+    :param workchain: the finished ``KcwBaseWorkChain`` of the screen calculation.
+    :return: dictionary of the ``alpha_*`` inputs, for the manifolds whose file was written.
+    """
+    calculations = [node for node in workchain.called if isinstance(node, orm.CalcJobNode)]
+    retrieved = {
+        f'run_{index:04d}': node.outputs.retrieved
+        for index, node in enumerate(sorted(calculations, key=lambda node: node.ctime))
+        if 'retrieved' in node.outputs
+    }
+    alpha_files = merge_alpha_files(**retrieved)
+    return {
+        name: alpha_files[manifold]
+        for name, manifold in KcwCalculation._alpha_file_inputs.items()  # pylint: disable=protected-access
+        if manifold in alpha_files
+    }
+
+
+class KoopmansDFPTWorkChain(WorkChain):
+    """Workchain to run the Koopmans functional calculations with DFPT, from the DFT ground state to the Hamiltonian.
+
+    The steps are the scf and nscf pw.x calculations, the Wannierization of the occupied and (optionally) empty
+    manifolds, and the wann2kcw, screen and ham kcw.x calculations, each one run by its restarting workchain. Every step
+    is submitted and awaited with ``ToContext``, such that the workchain only occupies the daemon while launching the
+    steps, and the Wannierizations of the two manifolds run concurrently.
+
+    The ``structure`` of the scf is used by all the steps, each one using the remote folder of the previous one as
+    ``parent_folder``. The Wannier90 files are passed to wann2kcw, and to screen and ham if they read the unitary
+    matrices, and the screening parameters of the screen calculation are passed to ham. The Wannierization requires
+    the optional ``aiida-wannier90-workflows``, see ``get_wannier90_bands_workchain``.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        """Define the process specification."""
+        # yapf: disable
+        super().define(spec)
+        Wannier90BandsWorkChain = get_wannier90_bands_workchain()
+        spec.expose_inputs(PwBaseWorkChain, namespace='scf', exclude=('clean_workdir', 'pw.parent_folder'),
+            namespace_options={'help': 'Inputs for the `PwBaseWorkChain` of the scf calculation.'})
+        spec.expose_inputs(PwBaseWorkChain, namespace='nscf',
+            exclude=('clean_workdir', 'pw.structure', 'pw.parent_folder'),
+            namespace_options={'help': 'Inputs for the `PwBaseWorkChain` of the nscf calculation.'})
+        for manifold, namespace in WANNIER_NAMESPACES.items():
+            spec.expose_inputs(Wannier90BandsWorkChain, namespace=namespace,
+                exclude=(
+                    'structure', 'scf', 'nscf', 'projwfc', 'wannier90.wannier90.kpoints',
+                    'pw2wannier90.pw2wannier90.parent_folder',
+                ),
+                namespace_options={'required': manifold == 'occ', 'populate_defaults': manifold == 'occ',
+                    'help': f'Inputs for the `Wannier90BandsWorkChain` of the {manifold} manifold.'})
+        excluded = ('kcw.parent_folder', *[f'kcw.{name}' for name in KCW_WANNIER90_INPUTS])
+        excluded += tuple(f'kcw.{name}' for name in KcwCalculation._alpha_file_inputs)
+        for calculation in ('wann2kcw', 'screen', 'ham'):
+            spec.expose_inputs(KcwBaseWorkChain, namespace=calculation, exclude=excluded,
+                namespace_options={'help': f'Inputs for the `KcwBaseWorkChain` of the {calculation} calculation.'})
+        spec.outline(
+            cls.run_scf,
+            cls.inspect_scf,
+            cls.run_nscf,
+            cls.inspect_nscf,
+            cls.run_wannier,
+            cls.inspect_wannier,
+            cls.run_wann2kcw,
+            cls.inspect_wann2kcw,
+            cls.run_screen,
+            cls.inspect_screen,
+            cls.run_ham,
+            cls.inspect_ham,
+            cls.results,
+        )
+        spec.expose_outputs(KcwBaseWorkChain, namespace='screen',
+            namespace_options={'help': 'Outputs of the `KcwBaseWorkChain` of the screen calculation.'})
+        spec.expose_outputs(KcwBaseWorkChain, namespace='ham',
+            namespace_options={'help': 'Outputs of the `KcwBaseWorkChain` of the ham calculation.'})
+        spec.exit_code(401, 'ERROR_SUB_PROCESS_FAILED_SCF',
+            message='The scf PwBaseWorkChain sub process failed.')
+        spec.exit_code(402, 'ERROR_SUB_PROCESS_FAILED_NSCF',
+            message='The nscf PwBaseWorkChain sub process failed.')
+        spec.exit_code(403, 'ERROR_SUB_PROCESS_FAILED_WANNIER',
+            message='The Wannier90BandsWorkChain sub process of the {manifold} manifold failed.')
+        spec.exit_code(404, 'ERROR_SUB_PROCESS_FAILED_WANN2KCW',
+            message='The wann2kcw KcwBaseWorkChain sub process failed.')
+        spec.exit_code(405, 'ERROR_SUB_PROCESS_FAILED_SCREEN',
+            message='The screen KcwBaseWorkChain sub process failed.')
+        spec.exit_code(406, 'ERROR_SUB_PROCESS_FAILED_HAM',
+            message='The ham KcwBaseWorkChain sub process failed.')
+        # yapf: enable
+
+    def submit_step(self, process_class, inputs, name):
+        """Submit the process of a step, with the step name as call link label, and report it.
+
+        :param process_class: the class of the process.
+        :param inputs: the mapping of the inputs of the process.
+        :param name: the name of the step.
+        :return: the node of the submitted process.
+        """
+        inputs = {**inputs, 'metadata': {**inputs.get('metadata', {}), 'call_link_label': name}}
+        running = self.submit(process_class, **inputs)
+        self.report(f'launching {running.process_label}<{running.pk}> for the {name} step')
+        return running
+
+    def inspect_step(self, name, exit_code):
+        """Return the exit code of a failed step, or None if its workchain finished successfully.
+
+        :param name: the name of the step, whose workchain is stored in ``self.ctx.workchain_{name}``.
+        :param exit_code: the exit code returned if the workchain failed.
+        """
+        workchain = self.ctx[f'workchain_{name}']
+        if not workchain.is_finished_ok:
+            self.report(f'{workchain.process_label}<{workchain.pk}> of the {name} step failed with exit status '
+                        f'{workchain.exit_status}')
+            return exit_code
+        return None
+
+    def run_scf(self):
+        """Run the ``PwBaseWorkChain`` of the scf calculation."""
+        inputs = AttributeDict(self.exposed_inputs(PwBaseWorkChain, namespace='scf'))
+        return ToContext(workchain_scf=self.submit_step(PwBaseWorkChain, inputs, 'scf'))
+
+    def inspect_scf(self):
+        """Verify that the scf ``PwBaseWorkChain`` finished successfully."""
+        return self.inspect_step('scf', self.exit_codes.ERROR_SUB_PROCESS_FAILED_SCF)
+
+    def run_nscf(self):
+        """Run the ``PwBaseWorkChain`` of the nscf calculation, from the output folder of the scf."""
+        inputs = AttributeDict(self.exposed_inputs(PwBaseWorkChain, namespace='nscf'))
+        inputs.pw = AttributeDict(inputs.pw)
+        inputs.pw.structure = self.inputs.scf.pw.structure
+        inputs.pw.parent_folder = self.ctx.workchain_scf.outputs.remote_folder
+        return ToContext(workchain_nscf=self.submit_step(PwBaseWorkChain, inputs, 'nscf'))
+
+    def inspect_nscf(self):
+        """Verify that the nscf ``PwBaseWorkChain`` finished successfully."""
+        return self.inspect_step('nscf', self.exit_codes.ERROR_SUB_PROCESS_FAILED_NSCF)
+
+    def run_wannier(self):
+        """Run concurrently the ``Wannier90BandsWorkChain`` of each manifold, from the output folder of the nscf.
+
+        The k-points and the Fermi energy of Wannier90 are taken from the outputs of the nscf, see
+        ``get_wannier90_inputs_from_nscf``, and its output folder is the parent folder of pw2wannier90.
+        """
+        Wannier90BandsWorkChain = get_wannier90_bands_workchain()
+        nscf = self.ctx.workchain_nscf
+        structure = self.inputs.scf.pw.structure
+
+        workchains = {}
+        for namespace in WANNIER_NAMESPACES.values():
+            if namespace not in self.inputs:
+                continue
+            builder = Wannier90BandsWorkChain.get_builder()
+            builder._update(self.exposed_inputs(Wannier90BandsWorkChain, namespace=namespace))
+            builder.structure = structure
+            nscf_inputs = get_wannier90_inputs_from_nscf(
+                structure, nscf.outputs.output_band, nscf.outputs.output_parameters,
+                builder.wannier90.wannier90.parameters
+            )
+            builder.wannier90.wannier90.kpoints = nscf_inputs['kpoints']
+            builder.wannier90.wannier90.parameters = nscf_inputs['parameters']
+            builder.pw2wannier90.pw2wannier90.parent_folder = nscf.outputs.remote_folder
+            inputs = builder._inputs(prune=True)  # pylint: disable=protected-access
+            workchains[f'workchain_{namespace}'] = self.submit_step(Wannier90BandsWorkChain, inputs, namespace)
+        return ToContext(**workchains)
+
+    def inspect_wannier(self):
+        """Verify that the ``Wannier90BandsWorkChain`` of each manifold finished successfully, and get their files.
+
+        The Wannier90 files of each manifold are stored in ``self.ctx.wannier90_files``, see
+        ``get_manifold_wannier90_files``.
+        """
+        self.ctx.wannier90_files = {}
+        for manifold, namespace in WANNIER_NAMESPACES.items():
+            if namespace not in self.inputs:
+                continue
+            exit_code = self.inspect_step(namespace, self.exit_codes.ERROR_SUB_PROCESS_FAILED_WANNIER)
+            if exit_code is not None:
+                return exit_code.format(manifold=manifold)
+            self.ctx.wannier90_files[manifold] = get_manifold_wannier90_files(self.ctx[f'workchain_{namespace}'])
+        return None
+
+    def get_kcw_inputs(self, calculation, parent_folder):
+        """Return the inputs of the ``KcwBaseWorkChain`` of a kcw.x step, see ``get_kcw_step_inputs``.
+
+        :param calculation: the kcw.x ``calculation`` type, i.e. one of ``wann2kcw``, ``screen`` or ``ham``.
+        :param parent_folder: the output folder of the previous step.
+        """
+        inputs = self.exposed_inputs(KcwBaseWorkChain, namespace=calculation)
+        return get_kcw_step_inputs(inputs, calculation, parent_folder, self.ctx.wannier90_files)
+
+    def run_wann2kcw(self):
+        """Run the ``KcwBaseWorkChain`` of the wann2kcw calculation, from the output folder of the nscf."""
+        inputs = self.get_kcw_inputs('wann2kcw', self.ctx.workchain_nscf.outputs.remote_folder)
+        return ToContext(workchain_wann2kcw=self.submit_step(KcwBaseWorkChain, inputs, 'wann2kcw'))
+
+    def inspect_wann2kcw(self):
+        """Verify that the wann2kcw ``KcwBaseWorkChain`` finished successfully."""
+        return self.inspect_step('wann2kcw', self.exit_codes.ERROR_SUB_PROCESS_FAILED_WANN2KCW)
+
+    def run_screen(self):
+        """Run the ``KcwBaseWorkChain`` of the screen calculation, from the output folder of the wann2kcw."""
+        inputs = self.get_kcw_inputs('screen', self.ctx.workchain_wann2kcw.outputs.remote_folder)
+        return ToContext(workchain_screen=self.submit_step(KcwBaseWorkChain, inputs, 'screen'))
+
+    def inspect_screen(self):
+        """Verify that the screen ``KcwBaseWorkChain`` finished successfully."""
+        return self.inspect_step('screen', self.exit_codes.ERROR_SUB_PROCESS_FAILED_SCREEN)
+
+    def run_ham(self):
+        """Run the ``KcwBaseWorkChain`` of the ham calculation, from the output folder of the screen.
+
+        The files with the screening parameters are merged from all the runs of the screen calculation, see
+        ``get_screening_alpha_files``.
+        """
+        workchain = self.ctx.workchain_screen
+        inputs = self.get_kcw_inputs('ham', workchain.outputs.remote_folder)
+        inputs.kcw.update(get_screening_alpha_files(workchain))
+        return ToContext(workchain_ham=self.submit_step(KcwBaseWorkChain, inputs, 'ham'))
+
+    def inspect_ham(self):
+        """Verify that the ham ``KcwBaseWorkChain`` finished successfully."""
+        return self.inspect_step('ham', self.exit_codes.ERROR_SUB_PROCESS_FAILED_HAM)
+
+    def results(self):
+        """Attach the outputs of the screen and ham calculations."""
+        for calculation in ('screen', 'ham'):
+            workchain = self.ctx[f'workchain_{calculation}']
+            self.out_many(self.exposed_outputs(workchain, KcwBaseWorkChain, namespace=calculation))
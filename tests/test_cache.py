@@ -0,0 +1,85 @@
+""" Tests for the process-wide caches."""
+
+from aiida_koopmans import cache
+
+
+def test_load_code(koopmans_code):
+    """Test that codes are resolved once per process, until the caches are cleared."""
+    cache.clear_caches()
+
+    code = cache.load_code(koopmans_code.full_label)
+    assert code.uuid == koopmans_code.uuid
+    assert cache.load_code(koopmans_code.full_label) is code
+
+    cache.clear_caches()
+    assert cache.load_code(koopmans_code.full_label) is not code
+
+
+def test_load_computer(koopmans_code):
+    """Test that computers are resolved once per process, until the caches are cleared."""
+    cache.clear_caches()
+
+    label = koopmans_code.computer.label
+    computer = cache.load_computer(label)
+    assert computer.uuid == koopmans_code.computer.uuid
+    assert cache.load_computer(label) is computer
+
+    cache.clear_caches()
+    assert cache.load_computer(label) is not computer
+
+
+def test_get_builder_from_template(koopmans_code):
+    """Test that builder templates are generated once and copied, sharing only the stored nodes."""
+    from aiida.calculations.arithmetic.add import ArithmeticAddCalculation
+    from aiida.orm import Int
+
+    cache.clear_caches()
+    calls = []
+
+    def factory():
+        calls.append(None)
+        builder = ArithmeticAddCalculation.get_builder()
+        builder.code = koopmans_code
+        builder.x = Int(1)
+        builder.y = Int(2).store()
+        builder.metadata.options.resources = {"num_machines": 1}
+        return builder
+
+    builder_1 = cache.get_builder_from_template(ArithmeticAddCalculation, ("add",), factory)
+    builder_2 = cache.get_builder_from_template(ArithmeticAddCalculation, ("add",), factory)
+
+    assert len(calls) == 1
+    assert builder_1.x is not builder_2.x
+    assert builder_1.x.value == builder_2.x.value == 1
+    assert builder_1.y is builder_2.y
+    assert builder_2.code.uuid == koopmans_code.uuid
+
+    builder_1.metadata.options.resources["num_machines"] = 2
+    assert builder_2.metadata.options.resources == {"num_machines": 1}
+
+    cache.clear_caches()
+    cache.get_builder_from_template(ArithmeticAddCalculation, ("add",), factory)
+    assert len(calls) == 2
+
+
+def test_intern_node():
+    """Test that nodes with the same content are stored only once."""
+    from aiida.orm import Dict, KpointsData
+
+    cache.clear_caches()
+
+    parameters = cache.intern_node(Dict({"CONTROL": {"calculation": "screen"}}))
+    assert parameters.is_stored
+    assert cache.intern_node(Dict({"CONTROL": {"calculation": "screen"}})).uuid == parameters.uuid
+    assert cache.intern_node(Dict({"CONTROL": {"calculation": "ham"}})).uuid != parameters.uuid
+
+    # Nodes stored in a previous process are found through their hash
+    kpoints = KpointsData()
+    kpoints.set_kpoints_mesh([2, 2, 2])
+    kpoints.store()
+    cache.clear_caches()
+
+    other_kpoints = KpointsData()
+    other_kpoints.set_kpoints_mesh([2, 2, 2])
+    assert cache.intern_node(other_kpoints).uuid == kpoints.uuid
+    assert not other_kpoints.is_stored
@@ -2,6 +2,8 @@
 
 import os
 
+import pytest
+
 from aiida.engine import run
 from aiida.orm import SinglefileData
 from aiida.plugins import CalculationFactory, DataFactory
@@ -36,3 +38,514 @@ def test_process(koopmans_code):
 
     assert "content1" in computed_diff
     assert "content2" in computed_diff
+
+
+def test_kcw_wannier_u_matrix_data(fixture_sandbox, generate_calc_job, koopmans_code):
+    """Test that the ``WannierUMatrixData`` inputs are written in the sandbox in the Wannier90 format."""
+    import numpy as np
+
+    from aiida.orm import Dict, FolderData
+
+    from aiida_koopmans.data.wannier90 import WannierUMatrixData
+
+    u_matrix = WannierUMatrixData()
+    u_matrix.set_u_matrix(np.zeros((1, 3)), np.eye(2, dtype=complex)[None])
+
+    inputs = {
+        "code": koopmans_code,
+        "parameters": Dict({"CONTROL": {"calculation": "wann2kcw"}}),
+        "parent_folder": FolderData(),
+        "wann_u_mat": u_matrix,
+        "metadata": {"options": {"resources": {"num_machines": 1}}},
+    }
+    calc_info = generate_calc_job(fixture_sandbox, "koopmans", inputs)
+    with fixture_sandbox.open("aiida_u.mat") as handle:
+        lines = handle.read().splitlines()
+
+    assert not any(target == "aiida_u.mat" for _, _, target in calc_info.local_copy_list)
+
+    assert lines[1].split() == ["1", "2", "2"]
+    assert lines[3] == "   0.0000000000  +0.0000000000  +0.0000000000"
+    assert lines[4:] == ["   1.0000000000  +0.0000000000", "   0.0000000000  +0.0000000000",
+                         "   0.0000000000  +0.0000000000", "   1.0000000000  +0.0000000000"]
+
+
+def test_kcw_without_xml_requires_pw_parent(fixture_sandbox, generate_calc_job, koopmans_code):
+    """Test that the ``without_xml`` option is refused if the ``parent_folder`` was not created by a pw.x calculation."""
+    from aiida.common.exceptions import InputValidationError
+    from aiida.orm import Dict, FolderData
+
+    inputs = {
+        "code": koopmans_code,
+        "parameters": Dict({"CONTROL": {"calculation": "screen"}}),
+        "parent_folder": FolderData(),
+        "metadata": {"options": {"resources": {"num_machines": 1}, "without_xml": True}},
+    }
+
+    with pytest.raises(InputValidationError):
+        generate_calc_job(fixture_sandbox, "koopmans", inputs)
+
+
+def test_kcw_kpoints_card(fixture_sandbox, generate_calc_job, koopmans_code):
+    """Test that the ``kpoints`` input is written in the ``K_POINTS`` card after the namelists."""
+    from aiida.orm import Dict, FolderData, KpointsData
+
+    kpoints = KpointsData()
+    kpoints.set_kpoints([[0.0, 0.0, 0.0], [0.5, 0.0, 0.0]])
+
+    inputs = {
+        "code": koopmans_code,
+        "parameters": Dict({"CONTROL": {"calculation": "ham"}, "HAM": {"do_bands": True}}),
+        "parent_folder": FolderData(),
+        "kpoints": kpoints,
+        "metadata": {"options": {"resources": {"num_machines": 1}}},
+    }
+    generate_calc_job(fixture_sandbox, "koopmans", inputs)
+    with fixture_sandbox.open("aiida.in") as handle:
+        lines = handle.read().splitlines()
+
+    assert lines[-4:] == [
+        "K_POINTS crystal",
+        "2",
+        "  0.0000000000 0.0000000000 0.0000000000 1.0",
+        "  0.5000000000 0.0000000000 0.0000000000 1.0",
+    ]
+
+
+@pytest.mark.parametrize(
+    "parameters",
+    [{"CONTROL": {"calculation": "ham"}}, {"CONTROL": {"calculation": "screen"}, "HAM": {"do_bands": True}}],
+)
+def test_kcw_kpoints_require_do_bands(fixture_sandbox, generate_calc_job, koopmans_code, parameters):
+    """Test that the ``kpoints`` input is refused unless read by a ham calculation with ``do_bands``."""
+    from aiida.common.exceptions import InputValidationError
+    from aiida.orm import Dict, FolderData, KpointsData
+
+    kpoints = KpointsData()
+    kpoints.set_kpoints([[0.0, 0.0, 0.0]])
+
+    inputs = {
+        "code": koopmans_code,
+        "parameters": Dict(parameters),
+        "parent_folder": FolderData(),
+        "kpoints": kpoints,
+        "metadata": {"options": {"resources": {"num_machines": 1}}},
+    }
+    with pytest.raises(InputValidationError, match="do_bands"):
+        generate_calc_job(fixture_sandbox, "koopmans", inputs)
+
+
+@pytest.mark.parametrize(
+    "options, message",
+    [
+        ({"dos_degauss": "0.1"}, "should be a number"),
+        ({"dos_degauss": 0}, "should be positive"),
+        ({"dos_deltae": -0.01}, "should be positive"),
+        ({"dos_emin": 5, "dos_emax": -5}, "lower than `dos_emax`"),
+    ],
+)
+def test_kcw_settings_dos_options(options, message):
+    """Test that invalid ``dos_*`` parser options are refused at submission."""
+    from aiida.orm import Dict
+
+    from aiida_koopmans.calculations.kcw import validate_settings
+
+    assert message in validate_settings(Dict({"PARSER_OPTIONS": options}), None)
+    assert validate_settings(Dict({"parser_options": {"dos_degauss": 0.1, "dos_emin": -5, "dos_emax": 5}}), None) is None
+
+
+@pytest.mark.parametrize(
+    "cutoff, message",
+    [
+        ("0.01", "should be a number"),
+        (True, "should be a number"),
+        (-0.01, "should not be negative"),
+        (0.01, None),
+    ],
+)
+def test_kcw_settings_hamiltonian_cutoff(koopmans_code, cutoff, message):
+    """Test that an invalid ``hamiltonian_cutoff`` parser option is refused at submission."""
+    from aiida.orm import Dict, FolderData
+
+    from aiida_koopmans.calculations.kcw import KcwCalculation
+
+    inputs = {
+        "code": koopmans_code,
+        "parameters": Dict({"CONTROL": {"calculation": "ham"}}),
+        "parent_folder": FolderData(),
+        "settings": Dict({"parser_options": {"hamiltonian_cutoff": cutoff}}),
+        "metadata": {"options": {"resources": {"num_machines": 1}}},
+    }
+    error = KcwCalculation.spec().inputs.validate(inputs)
+    if message is None:
+        assert error is None
+    else:
+        assert message in error.message
+
+
+def test_kcw_alpha_files(fixture_sandbox, generate_calc_job, koopmans_code):
+    """Test that the ``alpha_file`` inputs are copied in the files of the screening parameters read by kcw.x."""
+    import io
+
+    from aiida.orm import Dict, FolderData
+
+    alpha_file = SinglefileData(io.BytesIO(b"1\n1 0.3 1.2\n"), filename="file_alpharef.txt").store()
+    alpha_emp_file = SinglefileData(io.BytesIO(b"1\n1 0.4 0.9\n"), filename="file_alpharef_empty.txt").store()
+
+    inputs = {
+        "code": koopmans_code,
+        "parameters": Dict({"CONTROL": {"calculation": "ham"}}),
+        "parent_folder": FolderData(),
+        "alpha_file": alpha_file,
+        "alpha_emp_file": alpha_emp_file,
+        "metadata": {"options": {"resources": {"num_machines": 1}}},
+    }
+    calc_info = generate_calc_job(fixture_sandbox, "koopmans", inputs)
+
+    assert (alpha_file.uuid, "file_alpharef.txt", "file_alpharef.txt") in calc_info.local_copy_list
+    assert (alpha_emp_file.uuid, "file_alpharef_empty.txt", "file_alpharef_empty.txt") in calc_info.local_copy_list
+
+
+def test_kcw_parent_folder_symlink(fixture_sandbox, generate_calc_job, koopmans_code):
+    """Test that with ``PARENT_FOLDER_SYMLINK`` the save folder is symlinked and the ``kcw`` folder is copied."""
+    from aiida.common.folders import SandboxFolder
+    from aiida.orm import Dict, RemoteData
+
+    parent_folder = RemoteData(computer=koopmans_code.computer, remote_path="/scratch/parent")
+    computer_uuid = koopmans_code.computer.uuid
+
+    inputs = {
+        "code": koopmans_code,
+        "parameters": Dict({"CONTROL": {"calculation": "screen"}}),
+        "parent_folder": parent_folder,
+        "settings": Dict({"CMDLINE": ["-in", "aiida.in"], "PARENT_FOLDER_SYMLINK": True}),
+        "metadata": {"options": {"resources": {"num_machines": 1}}},
+    }
+    calc_info = generate_calc_job(fixture_sandbox, "koopmans", inputs)
+    assert "out" in fixture_sandbox.get_content_list()
+
+    assert calc_info.remote_symlink_list == [(computer_uuid, "/scratch/parent/out/aiida.save", "out/aiida.save")]
+    assert calc_info.remote_copy_list == [(computer_uuid, "/scratch/parent/out/kcw", "out/kcw")]
+
+    inputs["settings"] = Dict({"CMDLINE": ["-in", "aiida.in"]})
+    with SandboxFolder() as folder:
+        calc_info = generate_calc_job(folder, "koopmans", inputs)
+
+    assert calc_info.remote_symlink_list == []
+    assert calc_info.remote_copy_list == [(computer_uuid, "/scratch/parent/out", "./out/")]
+
+
+def test_kcw_selective_parent_copy(fixture_sandbox, generate_calc_job, koopmans_code):
+    """Test that with the ``selective_parent_copy`` option only the files in the manifest of the step are copied."""
+    from aiida.common.folders import SandboxFolder
+    from aiida.orm import Dict, RemoteData
+
+    parent_folder = RemoteData(computer=koopmans_code.computer, remote_path="/scratch/parent")
+    computer_uuid = koopmans_code.computer.uuid
+
+    inputs = {
+        "code": koopmans_code,
+        "parameters": Dict({"control": {"calculation": "ham"}}),
+        "parent_folder": parent_folder,
+        "metadata": {"options": {"resources": {"num_machines": 1}, "selective_parent_copy": True}},
+    }
+    calc_info = generate_calc_job(fixture_sandbox, "koopmans", inputs)
+    assert os.path.isdir(fixture_sandbox.get_abs_path("out/aiida.save"))
+
+    assert calc_info.remote_copy_list == [
+        (computer_uuid, "/scratch/parent/out/aiida.save/data-file-schema.xml", "out/aiida.save/data-file-schema.xml"),
+        (computer_uuid, "/scratch/parent/out/aiida.save/charge-density*", "out/aiida.save"),
+        (computer_uuid, "/scratch/parent/out/aiida.save/*.[uU][pP][fF]", "out/aiida.save"),
+        (computer_uuid, "/scratch/parent/out/kcw", "out/kcw"),
+    ]
+
+    inputs["parameters"] = Dict({"CONTROL": {"calculation": "wann2kcw"}})
+    with SandboxFolder() as folder:
+        calc_info = generate_calc_job(folder, "koopmans", inputs)
+
+    assert calc_info.remote_copy_list == [(computer_uuid, "/scratch/parent/out/aiida.save/*", "out/aiida.save")]
+
+
+def test_kcw_chain(fixture_sandbox, generate_calc_job, koopmans_code):
+    """Test that the ``KcwChainCalculation`` writes the input of each step and runs them in sequence."""
+    from aiida.common.datastructures import CodeRunMode
+    from aiida.common.exceptions import InputValidationError
+    from aiida.common.folders import SandboxFolder
+    from aiida.orm import Dict, KpointsData, RemoteData
+
+    kpoints = KpointsData()
+    kpoints.set_kpoints([[0.0, 0.0, 0.0]])
+    parent_folder = RemoteData(computer=koopmans_code.computer, remote_path="/scratch/parent")
+    computer_uuid = koopmans_code.computer.uuid
+
+    inputs = {
+        "code": koopmans_code,
+        "screen": {"parameters": Dict({"SCREEN": {"tr2": 1e-18}})},
+        "ham": {"parameters": Dict({"control": {"calculation": "ham"}, "ham": {"do_bands": True}})},
+        "parent_folder": parent_folder,
+        "kpoints": kpoints,
+        "metadata": {"options": {"resources": {"num_machines": 1}, "selective_parent_copy": True}},
+    }
+    calc_info = generate_calc_job(fixture_sandbox, "koopmans.chain", inputs)
+    assert "aiida.in" not in fixture_sandbox.get_content_list()
+    with fixture_sandbox.open("aiida.screen.in") as handle:
+        screen_input = handle.read()
+    with fixture_sandbox.open("aiida.ham.in") as handle:
+        ham_input = handle.read()
+
+    assert "calculation = 'screen'" in screen_input
+    assert "tr2 =   1.0000000000d-18" in screen_input
+    assert "calculation = 'ham'" in ham_input
+    assert ham_input.endswith("  0.0000000000 0.0000000000 0.0000000000 1.0\n")
+
+    assert calc_info.codes_run_mode == CodeRunMode.SERIAL
+    assert [(info.cmdline_params, info.stdin_name, info.stdout_name) for info in calc_info.codes_info] == [
+        (["-in", "aiida.screen.in"], "aiida.screen.in", "aiida.screen.out"),
+        (["-in", "aiida.ham.in"], "aiida.ham.in", "aiida.ham.out"),
+    ]
+    assert "aiida.out" not in calc_info.retrieve_list
+    assert {"aiida.screen.out", "aiida.ham.out"}.issubset(calc_info.retrieve_list)
+    assert calc_info.remote_copy_list == [
+        (computer_uuid, "/scratch/parent/out/aiida.save/*", "out/aiida.save"),
+        (computer_uuid, "/scratch/parent/out/kcw", "out/kcw"),
+    ]
+
+    inputs["ham"] = {"parameters": Dict({"CONTROL": {"calculation": "screen"}})}
+    with pytest.raises(InputValidationError), SandboxFolder() as folder:
+        generate_calc_job(folder, "koopmans.chain", inputs)
+
+    inputs["ham"] = {"parameters": Dict({"CONTROL": {"calculation": "ham"}})}
+    with pytest.raises(InputValidationError, match="do_bands"), SandboxFolder() as folder:
+        generate_calc_job(folder, "koopmans.chain", inputs)
+
+
+def test_kcw_chain_validates_calc_job(fixture_sandbox, generate_calc_job, koopmans_code):
+    """Test that the ``KcwChainCalculation`` validates the inputs of the ``CalcJob`` besides the steps."""
+    from aiida.orm import Computer, Dict, RemoteData
+
+    other = Computer(label="other", hostname="other", transport_type="core.local", scheduler_type="core.direct")
+    other.set_workdir("/tmp")
+    inputs = {
+        "code": koopmans_code,
+        "screen": {"parameters": Dict({"CONTROL": {"calculation": "screen"}})},
+        "parent_folder": RemoteData(computer=koopmans_code.computer, remote_path="/scratch/parent"),
+        "metadata": {"computer": other.store(), "options": {"resources": {"num_machines": 1}}},
+    }
+    with pytest.raises(ValueError, match="computer"):
+        generate_calc_job(fixture_sandbox, "koopmans.chain", inputs)
+
+    inputs["metadata"].pop("computer")
+    inputs.pop("screen")
+    with pytest.raises(ValueError, match="at least one of the steps"):
+        generate_calc_job(fixture_sandbox, "koopmans.chain", inputs)
+
+
+def test_kcw_packed(fixture_sandbox, generate_calc_job, koopmans_code):
+    """Test that the ``KcwPackedCalculation`` writes each calculation in its subfolder and runs them concurrently."""
+    from aiida.orm import Dict, FolderData, RemoteData
+
+    parent_remote = RemoteData(computer=koopmans_code.computer, remote_path="/scratch/parent")
+    parent_folder = FolderData()
+
+    inputs = {
+        "code": koopmans_code,
+        "calculations": {
+            "b": {"parameters": Dict({"CONTROL": {"calculation": "screen"}}), "parent_folder": parent_remote},
+            "a": {"parameters": Dict({"CONTROL": {"calculation": "screen"}}), "parent_folder": parent_folder},
+        },
+        "metadata": {"options": {"resources": {"num_machines": 1, "num_mpiprocs_per_machine": 4}}},
+    }
+    calc_info = generate_calc_job(fixture_sandbox, "koopmans.packed", inputs)
+    assert sorted(fixture_sandbox.get_content_list()) == ["a", "b"]
+    with fixture_sandbox.open("a/aiida.in") as handle:
+        assert "calculation = 'screen'" in handle.read()
+
+    assert calc_info.codes_info == []
+    assert calc_info.remote_copy_list == [(koopmans_code.computer.uuid, "/scratch/parent/out", "b/out")]
+    assert calc_info.local_copy_list == [(parent_folder.uuid, "./out/", "a/out")]
+    assert ("a/aiida.out", ".", 2) in calc_info.retrieve_list
+    assert ("b/aiida.kcw_hr.dat", ".", 2) in calc_info.retrieve_temporary_list
+
+    run_lines = calc_info.append_text.splitlines()
+    assert run_lines[-1] == "wait"
+    assert run_lines[0] == (
+        "(cd 'a' && 'mpirun' '-np' '2' '/usr/bin/diff' '-in' 'aiida.in' < aiida.in > 'aiida.out' 2>&1) &"
+    )
+    assert run_lines[1].startswith("(cd 'b' && ")
+
+
+def test_kcw_packed_output_filename(fixture_sandbox, generate_calc_job, koopmans_code):
+    """Test that the packed calculations write and retrieve the ``output_filename`` read by the parser."""
+    from aiida.orm import Dict, FolderData
+
+    inputs = {
+        "code": koopmans_code,
+        "calculations": {
+            "a": {"parameters": Dict({"CONTROL": {"calculation": "screen"}}), "parent_folder": FolderData()},
+        },
+        "metadata": {"options": {"resources": {"num_machines": 1}, "output_filename": "kcw.out"}},
+    }
+    calc_info = generate_calc_job(fixture_sandbox, "koopmans.packed", inputs)
+
+    assert ("a/kcw.out", ".", 2) in calc_info.retrieve_list
+    assert ("a/aiida.out", ".", 2) not in calc_info.retrieve_list
+    assert calc_info.append_text.splitlines()[0].endswith("< aiida.in > 'kcw.out' 2>&1) &")
+
+
+def test_kcw_packed_portable_code(fixture_sandbox, generate_calc_job, koopmans_code, tmp_path):
+    """Test that the ``KcwPackedCalculation`` takes the MPI command from the computer of the job for a ``PortableCode``."""
+    from aiida.orm import Dict, FolderData, PortableCode
+
+    (tmp_path / "kcw.x").write_text("")
+    code = PortableCode(label="kcw-portable", filepath_executable="kcw.x", filepath_files=tmp_path)
+
+    inputs = {
+        "code": code,
+        "calculations": {
+            "a": {"parameters": Dict({"CONTROL": {"calculation": "screen"}}), "parent_folder": FolderData()},
+        },
+        "metadata": {
+            "computer": koopmans_code.computer,
+            "options": {"resources": {"num_machines": 1, "num_mpiprocs_per_machine": 4}},
+        },
+    }
+    calc_info = generate_calc_job(fixture_sandbox, "koopmans.packed", inputs)
+    assert calc_info.append_text.splitlines()[0].startswith("(cd 'a' && 'mpirun' '-np' '4' ")
+
+
+def test_kcw_packed_append_text(koopmans_code):
+    """Test that the ``append_text`` of the options is refused, since it would run before the packed calculations."""
+    from aiida.orm import Dict, FolderData
+
+    from aiida_koopmans.calculations.kcw_packed import KcwPackedCalculation
+
+    inputs = {
+        "code": koopmans_code,
+        "calculations": {
+            "a": {"parameters": Dict({"CONTROL": {"calculation": "screen"}}), "parent_folder": FolderData()},
+        },
+        "metadata": {"options": {"resources": {"num_machines": 1}, "append_text": "echo done"}},
+    }
+    error = KcwPackedCalculation.spec().inputs.validate(inputs)
+    assert error is not None
+    assert "append_text" in error.message
+
+
+def test_kcw_packed_num_machines(koopmans_code):
+    """Test that more than one machine is refused, since the packed calculations run on the first one only."""
+    from aiida.orm import Dict, FolderData
+
+    from aiida_koopmans.calculations.kcw_packed import KcwPackedCalculation
+
+    inputs = {
+        "code": koopmans_code,
+        "calculations": {
+            "a": {"parameters": Dict({"CONTROL": {"calculation": "screen"}}), "parent_folder": FolderData()},
+        },
+        "metadata": {"options": {"resources": {"num_machines": 2, "num_mpiprocs_per_machine": 4}}},
+    }
+    error = KcwPackedCalculation.spec().inputs.validate(inputs)
+    assert error is not None
+    assert "run on a single machine" in error.message
+
+    inputs["metadata"]["options"]["resources"]["num_machines"] = 1
+    assert KcwPackedCalculation.spec().inputs.validate(inputs) is None
+
+
+def test_kcw_packed_kpoints_require_do_bands():
+    """Test that the ``kpoints`` of a packed calculation are refused unless read by a ham step with ``do_bands``."""
+    from aiida.orm import Dict, FolderData, KpointsData
+
+    from aiida_koopmans.calculations.kcw_packed import validate_calculations
+
+    kpoints = KpointsData()
+    kpoints.set_kpoints([[0.0, 0.0, 0.0]])
+    inputs = {
+        "parameters": Dict({"CONTROL": {"calculation": "ham"}}),
+        "parent_folder": FolderData(),
+        "kpoints": kpoints,
+    }
+
+    assert "do_bands" in validate_calculations({"a": inputs}, None)
+
+    inputs["parameters"] = Dict({"CONTROL": {"calculation": "ham"}, "HAM": {"do_bands": True}})
+    assert validate_calculations({"a": inputs}, None) is None
+
+
+def generate_pw_remote_folder(koopmans_code, remote_path):
+    """Return the ``remote_folder`` of a finished (mock) ``PwCalculation`` with fixed inputs."""
+    from aiida.common import LinkType
+    from aiida.orm import CalcJobNode, Dict, RemoteData
+
+    pw_node = CalcJobNode(computer=koopmans_code.computer, process_type="aiida.calculations:quantumespresso.pw")
+    pw_node.set_option("resources", {"num_machines": 1})
+    pw_node.base.links.add_incoming(
+        Dict({"SYSTEM": {"ecutwfc": 30}}).store(), link_type=LinkType.INPUT_CALC, link_label="parameters"
+    )
+    pw_node.store()
+
+    remote_folder = RemoteData(computer=koopmans_code.computer, remote_path=remote_path)
+    remote_folder.base.links.add_incoming(pw_node, link_type=LinkType.CREATE, link_label="remote_folder")
+    return remote_folder.store()
+
+
+def generate_kcw_calculation_node(koopmans_code, calculation, parent_folder, wann_u_mat):
+    """Return an unstored ``KcwCalculationNode`` with the given inputs."""
+    from aiida.common import LinkType
+    from aiida.orm import Dict
+
+    from aiida_koopmans.calculations.kcw import KcwCalculationNode
+
+    node = KcwCalculationNode(computer=koopmans_code.computer, process_type="aiida.calculations:koopmans")
+    node.set_option("resources", {"num_machines": 1})
+    inputs = {
+        "code": koopmans_code,
+        "parameters": Dict({"CONTROL": {"calculation": calculation}}).store(),
+        "parent_folder": parent_folder,
+        "wann_u_mat": wann_u_mat.store(),
+    }
+    for label, input_node in inputs.items():
+        node.base.links.add_incoming(input_node, link_type=LinkType.INPUT_CALC, link_label=label)
+    return node
+
+
+@pytest.mark.parametrize("calculation", ["wann2kcw", "screen", "ham"])
+def test_kcw_caching(koopmans_code, calculation):
+    """Test that a ``KcwCalculation`` rerun on the outputs of an equivalent parent calculation is taken from the cache."""
+    import io
+
+    from aiida.engine import ProcessState
+    from aiida.manage.caching import enable_caching
+
+    node_1 = generate_kcw_calculation_node(
+        koopmans_code,
+        calculation,
+        generate_pw_remote_folder(koopmans_code, "/scratch/run_1"),
+        SinglefileData(io.StringIO("u matrix"), filename="run_1_u.mat"),
+    )
+    node_1.set_process_state(ProcessState.FINISHED)
+    node_1.set_exit_status(0)
+    node_1.store()
+    node_1.seal()
+
+    # The same calculation on a new run of the parent calculation, with the same Wannier matrices
+    node_2 = generate_kcw_calculation_node(
+        koopmans_code,
+        calculation,
+        generate_pw_remote_folder(koopmans_code, "/scratch/run_2"),
+        SinglefileData(io.StringIO("u matrix"), filename="run_2_u.mat"),
+    )
+    with enable_caching(identifier="aiida.calculations:koopmans"):
+        node_2.store()
+    assert node_2.base.caching.get_cache_source() == node_1.uuid
+    assert node_2.base.caching.get_hash() == node_1.base.caching.get_hash()
+
+    # Different Wannier matrices give a different hash
+    node_3 = generate_kcw_calculation_node(
+        koopmans_code,
+        calculation,
+        generate_pw_remote_folder(koopmans_code, "/scratch/run_3"),
+        SinglefileData(io.StringIO("other u matrix"), filename="run_1_u.mat"),
+    )
+    node_3.store()
+    assert node_3.base.caching.get_hash() != node_1.base.caching.get_hash()
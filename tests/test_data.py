@@ -0,0 +1,154 @@
+""" Tests for the data utilities."""
+
+import io
+
+from aiida.orm import FolderData
+
+from aiida_koopmans.data.utils import (
+    generate_singlefiledata,
+    generate_singlefiledata_from_retrieved,
+)
+
+
+def test_generate_singlefiledata():
+    """Test creating a ``SingleFileData`` from lines, strings and bytes."""
+    lines = ["header\n", "  1  2\n"]
+    for content in (lines, "".join(lines), "".join(lines).encode()):
+        node = generate_singlefiledata("aiida_u.mat", content)
+        assert node.filename == "aiida_u.mat"
+        assert node.get_content() == "header\n  1  2\n"
+
+
+def test_generate_singlefiledata_from_retrieved():
+    """Test streaming a file of a retrieved folder into a ``SingleFileData``."""
+    retrieved = FolderData()
+    retrieved.base.repository.put_object_from_filelike(io.BytesIO(b"centres\n"), "aiida_centres.xyz")
+    retrieved.store()
+
+    node = generate_singlefiledata_from_retrieved(retrieved, "aiida_centres.xyz")
+    assert node.filename == "aiida_centres.xyz"
+    assert node.get_content() == "centres\n"
+
+
+def test_get_or_create_singlefiledata_from_retrieved():
+    """Test that ``SingleFileData`` with the same filename and content are stored only once."""
+    from aiida_koopmans.data.utils import get_or_create_singlefiledata_from_retrieved
+
+    nodes = []
+    for content in (b"u matrix\n", b"u matrix\n", b"other u matrix\n"):
+        retrieved = FolderData()
+        retrieved.base.repository.put_object_from_filelike(io.BytesIO(content), "aiida_u.mat")
+        retrieved.base.repository.put_object_from_filelike(io.BytesIO(content), "aiida_u_dis.mat")
+        retrieved.store()
+        nodes.append(get_or_create_singlefiledata_from_retrieved(retrieved, "aiida_u.mat"))
+
+    assert all(node.is_stored for node in nodes)
+    assert nodes[0].uuid == nodes[1].uuid
+    assert nodes[0].uuid != nodes[2].uuid
+    assert nodes[2].get_content() == "other u matrix\n"
+
+    # The filename is part of the hash
+    u_dis = get_or_create_singlefiledata_from_retrieved(retrieved, "aiida_u_dis.mat")
+    assert u_dis.uuid != nodes[2].uuid
+
+
+def test_wannier_u_matrix_data():
+    """Test the conversion of Wannier90 U matrix files to ``WannierUMatrixData`` and back to the exact same text."""
+    import numpy as np
+
+    from aiida_koopmans.data.wannier90 import WannierUMatrixData, write_u_matrix
+
+    rng = np.random.default_rng(0)
+    kpoints = rng.random((4, 3)) - 0.5
+    matrices = rng.random((4, 5, 3)) - 0.5 + 1j * (rng.random((4, 5, 3)) - 0.5)
+
+    # Write a `_u_dis.mat` file with 5 bands and 3 Wannier functions, as Wannier90 does
+    handle = io.StringIO()
+    write_u_matrix(handle, [" written on 17Oct2026 at 10:00:00 ", "           4           3           5"], "", kpoints,
+                   matrices)
+    content = handle.getvalue()
+    assert content.splitlines()[4] == "%15.10f%+15.10f" % (matrices[0, 0, 0].real, matrices[0, 0, 0].imag)
+    assert content.splitlines()[5] == "%15.10f%+15.10f" % (matrices[0, 1, 0].real, matrices[0, 1, 0].imag)
+
+    node = WannierUMatrixData.from_singlefiledata(generate_singlefiledata("aiida_u_dis.mat", content))
+    node.store()
+
+    assert np.allclose(node.get_kpoints(), kpoints, atol=1e-10)
+    assert np.allclose(node.get_u_matrix(), matrices, atol=1e-10)
+
+    with node.open_u_matrix() as u_matrix:
+        assert isinstance(u_matrix, np.memmap)
+        assert np.array_equal(u_matrix[2], node.get_u_matrix()[2])
+
+    written = io.StringIO()
+    node.write_wannier90(written)
+    assert written.getvalue() == content
+
+
+def test_merge_wannier90_files():
+    """Test the merge of the Wannier90 files of two blocks."""
+    import numpy as np
+
+    from aiida_koopmans.data import wannier90
+    from aiida_koopmans.data.utils import merge_wannier90_files
+
+    rng = np.random.default_rng(0)
+    kpoints = rng.random((2, 3))
+    r_vectors = np.array([[0, 0, 0], [1, 0, 0], [-1, 0, 0]])
+    degeneracies = np.array([1, 2, 2])
+    atoms = ["Zn         0.00000000       0.00000000       0.00000000"]
+
+    files, u_blocks, hr_blocks = {}, [], []
+    for index, num_wann in enumerate([2, 3]):
+        u_matrix = rng.random((2, num_wann, num_wann)) + 1j * rng.random((2, num_wann, num_wann))
+        hamiltonian = rng.random((3, num_wann, num_wann)) + 1j * rng.random((3, num_wann, num_wann))
+        u_blocks.append(u_matrix)
+        hr_blocks.append(hamiltonian)
+
+        content = io.StringIO()
+        wannier90.write_u_matrix(content, [" header", wannier90.format_integers(2, num_wann, num_wann)], "", kpoints,
+                                 u_matrix)
+        files[f"u_mat_{index}"] = generate_singlefiledata("aiida_u.mat", content.getvalue())
+
+        content = io.StringIO()
+        wannier90.write_hr(content, " header", r_vectors, degeneracies, hamiltonian)
+        files[f"hr_dat_{index}"] = generate_singlefiledata("aiida_hr.dat", content.getvalue())
+
+        content = io.StringIO()
+        centres = [f"X {index:16.8f} {num_wann:16.8f} {0:16.8f}"] * num_wann
+        wannier90.write_centres(content, " centres", centres, atoms)
+        files[f"centres_xyz_{index}"] = generate_singlefiledata("aiida_centres.xyz", content.getvalue())
+
+    # Only the second block is disentangled, with 4 bands
+    u_dis_matrix = rng.random((2, 4, 3)) + 0j
+    content = io.StringIO()
+    wannier90.write_u_matrix(content, [" header", wannier90.format_integers(2, 3, 4)], "", kpoints, u_dis_matrix)
+    files["u_dis_mat_1"] = generate_singlefiledata("aiida_u_dis.mat", content.getvalue())
+
+    merged = merge_wannier90_files(**files)
+
+    with merged["u_mat"].open(mode="rb") as handle:
+        _, _, merged_kpoints, u_matrix = wannier90.read_u_matrix(handle)
+    assert np.allclose(merged_kpoints, kpoints)
+    assert np.allclose(u_matrix[:, :2, :2], u_blocks[0], atol=1e-9)
+    assert np.allclose(u_matrix[:, 2:, 2:], u_blocks[1], atol=1e-9)
+    assert not u_matrix[:, :2, 2:].any() and not u_matrix[:, 2:, :2].any()
+
+    with merged["u_dis_mat"].open(mode="rb") as handle:
+        header_lines, _, _, u_dis = wannier90.read_u_matrix(handle)
+    assert header_lines[1].split() == ["2", "5", "6"]
+    assert np.allclose(u_dis[:, :2, :2], np.eye(2))
+    assert np.allclose(u_dis[:, 2:, 2:], u_dis_matrix, atol=1e-9)
+
+    with merged["hr_dat"].open(mode="rb") as handle:
+        header, merged_r_vectors, merged_degeneracies, hamiltonian = wannier90.read_hr(handle)
+    assert header == " header"
+    assert np.array_equal(merged_r_vectors, r_vectors)
+    assert np.array_equal(merged_degeneracies, degeneracies)
+    assert np.allclose(hamiltonian[:, 2:, 2:], hr_blocks[1], atol=1e-5)
+
+    with merged["centres_xyz"].open(mode="rb") as handle:
+        _, centres, merged_atoms = wannier90.read_centres(handle)
+    assert [float(line.split()[1]) for line in centres] == [0, 0, 1, 1, 1]
+    assert merged_atoms == atoms
+    assert merged["centres_xyz"].get_content().startswith("     6\n")
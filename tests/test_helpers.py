@@ -0,0 +1,129 @@
+""" Tests for the helpers."""
+
+import subprocess
+import sys
+
+from aiida_koopmans import cache
+
+# Modules that the helpers only need when building builders, and which must not be loaded at import time.
+HEAVY_MODULES = (
+    "aiida_quantumespresso",
+    "aiida_wannier90",
+    "aiida_wannier90_workflows",
+    "ase.io.espresso",
+    "aiida_koopmans.calculations.kcw",
+)
+
+
+def test_helpers_import_is_lazy():
+    """Test that importing the helpers does not import the heavy plugin dependencies."""
+    script = (
+        "import sys; import aiida_koopmans.helpers; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == ""
+
+
+def test_get_kcw_wannier90_inputs():
+    """Test that the Wannier90 files are passed to wann2kcw, and to screen and ham only if they read them."""
+    from aiida_koopmans.helpers import get_kcw_wannier90_inputs
+
+    wannier90_files = {
+        "occ": {"hr_dat": "occ_hr", "u_mat": "occ_u", "centres_xyz": "occ_centres"},
+        "emp": {"hr_dat": "emp_hr", "u_mat": "emp_u", "u_dis_mat": "emp_u_dis", "centres_xyz": "emp_centres"},
+    }
+
+    assert get_kcw_wannier90_inputs(wannier90_files, "wann2kcw", {}) == {
+        "wann_u_mat": "occ_u",
+        "wann_centres_xyz": "occ_centres",
+        "wann_emp_u_mat": "emp_u",
+        "wann_emp_u_dis_mat": "emp_u_dis",
+        "wann_emp_centres_xyz": "emp_centres",
+    }
+    assert get_kcw_wannier90_inputs(wannier90_files, "screen", {}) == {}
+    assert get_kcw_wannier90_inputs({"occ": wannier90_files["occ"]}, "ham", {"read_unitary_matrix": True}) == {
+        "wann_u_mat": "occ_u",
+        "wann_centres_xyz": "occ_centres",
+    }
+
+
+def test_get_code_duplicate_labels(aiida_localhost):
+    """Test that ``get_code`` returns the first code on the computer when several codes share the label."""
+    from aiida.orm import Code
+
+    from aiida_koopmans.helpers import get_code
+
+    code = get_code("koopmans", aiida_localhost)
+    duplicate = Code(input_plugin_name="koopmans", remote_computer_exec=[aiida_localhost, "/usr/bin/diff"])
+    duplicate.label = code.label
+    duplicate.store()
+
+    cache.clear_caches()
+    assert get_code("koopmans", aiida_localhost).pk == code.pk
+
+
+def test_get_code_cached(aiida_localhost, monkeypatch):
+    """Test that ``get_code`` queries the database only the first time a code is requested on a computer."""
+    from aiida import orm
+
+    from aiida_koopmans.helpers import get_code
+
+    cache.clear_caches()
+    code = get_code("koopmans", aiida_localhost)
+
+    def query_builder(*args, **kwargs):
+        raise AssertionError("the database was queried")
+
+    monkeypatch.setattr(orm, "QueryBuilder", query_builder)
+    assert get_code("koopmans", aiida_localhost) is code
+
+
+def test_get_kpoints_from_bandpath():
+    """Test that the explicit k-points of an ASE band path are converted, with the labels of its special points."""
+    from ase.build import bulk
+
+    from aiida_koopmans.helpers import get_kpoints_from_bandpath
+
+    path = bulk("Si").cell.bandpath("GXL", npoints=7)
+    kpoints = get_kpoints_from_bandpath(path)
+
+    assert kpoints.get_kpoints().tolist() == path.kpts.tolist()
+    assert [label for _, label in kpoints.labels] == ["G", "X", "L"]
+    assert kpoints.labels[0][0] == 0 and kpoints.labels[-1][0] == 6
+
+
+def test_kcw_builder_band_kpoints(koopmans_code):
+    """Test that a ham calculation interpolates the bands only along the band path of the ``kpts`` of the calculator."""
+    import pytest
+
+    pytest.importorskip("aiida_wannier90")
+    espresso = pytest.importorskip("ase.io.espresso")
+    if not hasattr(espresso, "kch_keys"):
+        pytest.skip("the kcw.x keys of `ase.io.espresso` are not available")
+
+    from types import SimpleNamespace
+
+    from ase.build import bulk
+
+    from aiida_koopmans.helpers import get_kcwcalculation_builder_from_ase
+
+    atoms = bulk("Si")
+    path = atoms.cell.bandpath("GXL", npoints=7)
+    calculator = SimpleNamespace(
+        atoms=atoms,
+        parameters={"kpts": path, "do_bands": True},
+        mode={"kcw_code": koopmans_code.full_label, "metadata": {"options": {"resources": {"num_machines": 1}}}},
+        parent_folder=None,
+    )
+
+    builder = get_kcwcalculation_builder_from_ase(calculator, "ham")
+    assert builder.parameters.get_dict()["HAM"]["do_bands"] is True
+    assert builder.kpoints.get_kpoints().tolist() == path.kpts.tolist()
+
+    calculator.parameters["kpts"] = [2, 2, 2]
+    builder = get_kcwcalculation_builder_from_ase(calculator, "ham")
+    assert builder.parameters.get_dict()["HAM"]["do_bands"] is False
+    assert "kpoints" not in builder
@@ -0,0 +1,63 @@
+""" Tests for the Wannier interpolation of the Koopmans bands."""
+
+import numpy as np
+import pytest
+
+from aiida.orm import ArrayData, KpointsData
+
+from aiida_koopmans import interpolation
+
+
+def generate_hamiltonian(sparse=False):
+    """Return the ``hamiltonian`` output of a two-band chain, with on-site energies -1 and 1 and hoppings -0.5 and 0.2.
+
+    The bands are ``-1 - cos(2 pi k)`` and ``1 + 0.4 cos(2 pi k)``.
+    """
+    r_vectors = np.array([[-1, 0, 0], [0, 0, 0], [1, 0, 0]])
+    hamiltonian = np.zeros((3, 2, 2), dtype=complex)
+    hamiltonian[1] = np.diag([-1.0, 1.0])
+    hamiltonian[0] = hamiltonian[2] = np.diag([-0.5, 0.2])
+
+    node = ArrayData()
+    node.set_array("r_vectors", r_vectors)
+    node.set_array("degeneracies", np.ones(3, dtype=int))
+    if sparse:
+        indices = np.argwhere(hamiltonian != 0)
+        node.set_array("indices", indices)
+        node.set_array("values", hamiltonian[tuple(indices.T)])
+        node.base.attributes.set("shape", [3, 2, 2])
+    else:
+        node.set_array("hamiltonian", hamiltonian)
+    return node
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_get_interpolated_bands(sparse):
+    """Test the interpolation of the bands along a k-path."""
+    interpolation.clear_phases_cache()
+
+    kpoints = KpointsData()
+    kpoints.set_cell([[1, 0, 0], [0, 1, 0], [0, 0, 1]])
+    kpoints.set_kpoints(np.linspace([0, 0, 0], [0.5, 0, 0], 11), labels=[(0, "G"), (10, "X")])
+
+    bands = interpolation.get_interpolated_bands(generate_hamiltonian(sparse), kpoints)
+
+    k = np.linspace(0, 0.5, 11)
+    assert np.allclose(bands.get_bands(), np.stack([-1 - np.cos(2 * np.pi * k), 1 + 0.4 * np.cos(2 * np.pi * k)], 1))
+    assert bands.labels == [(0, "G"), (10, "X")]
+
+
+def test_get_phases_cache():
+    """Test that the phase factors are computed once per set of R-vectors and k-points."""
+    interpolation.clear_phases_cache()
+    r_vectors, degeneracies = np.array([[0, 0, 0], [1, 0, 0]]), np.array([1, 2])
+    kpoints = np.array([[0, 0, 0], [0.25, 0, 0]])
+
+    phases = interpolation.get_phases(r_vectors, degeneracies, kpoints)
+    assert np.allclose(phases, [[1, 0.5], [1, 0.5j]])
+    assert interpolation.get_phases(r_vectors, degeneracies, kpoints.copy()) is phases
+    assert interpolation.get_phases(r_vectors, degeneracies, kpoints[:1]) is not phases
+
+    for shift in range(interpolation.PHASES_CACHE_SIZE):
+        interpolation.get_phases(r_vectors, degeneracies, kpoints + shift + 1)
+    assert interpolation.get_phases(r_vectors, degeneracies, kpoints) is not phases
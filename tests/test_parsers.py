@@ -0,0 +1,697 @@
+""" Tests for the parsers."""
+
+import io
+import time
+import warnings
+
+from aiida.common.extendeddicts import AttributeDict
+import pytest
+
+from aiida_koopmans.parsers.kcw import KcwParser
+from aiida_koopmans.parsers.parse_raw import iter_lines, parse_stdout
+from aiida_koopmans.parsers.parse_xml import UnexpectedXMLError, parse_xml_fast
+
+STDOUT_SCREEN = """
+     Program KCW v.7.2 starts on 17Oct2026 at 10: 0: 0
+
+     Warning: the screening is computed with a coarse grid
+
+        iwann =     1   relaxed =  -0.50000000   unrelaxed =  -1.00000000   alpha =  0.50000000   self Hxc =  1.0
+        iwann =     2   relaxed =  -0.25000000   unrelaxed =  -1.00000000   alpha =  0.25000000   self Hxc =  1.0
+
+     KCW          :      1.50s CPU      2.00s WALL
+
+   JOB DONE.
+"""
+
+STDOUT_HAM = """
+     Program KCW v.7.2 starts on 17Oct2026 at 10: 0: 0
+
+          k = 0.0000 0.0000 0.0000     band energies (ev):
+
+          KS      -5.6000   6.2000   6.2000
+          KI      -8.1000   9.3000
+                   9.3000
+
+          k = 0.5000 0.0000 0.0000     band energies (ev):
+
+          KS      -4.6000   5.2000   5.2000
+          KI      -7.1000   8.3000   8.3000
+
+          KS       highest occupied, lowest unoccupied level (ev):     -4.6000    5.2000
+          KI       highest occupied, lowest unoccupied level (ev):     -7.1000    8.3000
+
+     KCW          :   1m 2.00s CPU   1m 3.00s WALL
+"""
+
+
+def generate_pw_xml(num_kpoints=2, num_bands=4, lsda=False):
+    """Return the content of a minimal ``data-file-schema.xml`` of pw.x (silicon), with the fields of the schema."""
+    kpoints = "\n".join(
+        f"""      <ks_energies>
+        <k_point weight="{2 / num_kpoints}">{i / num_kpoints:.10e} 0.0 0.0</k_point>
+        <npw>100</npw>
+        <eigenvalues size="{num_bands}">{" ".join(f"{-0.2 + 0.01 * j:.12e}" for j in range(num_bands))}</eigenvalues>
+        <occupations size="{num_bands}">{" ".join("1.0" for _ in range(num_bands))}</occupations>
+      </ks_energies>"""
+        for i in range(num_kpoints)
+    )
+    structure = """<atomic_structure nat="2" alat="10.2">
+      <atomic_positions>
+        <atom name="Si" index="1">0.0 0.0 0.0</atom>
+        <atom name="Si" index="2">2.55 2.55 2.55</atom>
+      </atomic_positions>
+      <cell>
+        <a1>-5.1 0.0 5.1</a1>
+        <a2>0.0 5.1 5.1</a2>
+        <a3>-5.1 5.1 0.0</a3>
+      </cell>
+    </atomic_structure>"""
+    species = """<atomic_species ntyp="1">
+      <species name="Si">
+        <mass>28.085</mass>
+        <pseudo_file>Si.upf</pseudo_file>
+      </species>
+    </atomic_species>"""
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<qes:espresso xsi:schemaLocation="http://www.quantum-espresso.org/ns/qes/qes-1.0 http://www.quantum-espresso.org/ns/qes/qes_230310.xsd" Units="Hartree atomic units" xmlns:qes="http://www.quantum-espresso.org/ns/qes/qes-1.0" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <general_info>
+    <xml_format NAME="QEXSD" VERSION="23.03.10">QEXSD_23.03.10</xml_format>
+    <creator NAME="PWSCF" VERSION="7.2">XML file generated by PWSCF</creator>
+    <created DATE="17Oct2026" TIME="10: 0: 0">This run was terminated on:  10: 0: 0  17 Oct 2026</created>
+    <job></job>
+  </general_info>
+  <input>
+    <control_variables>
+      <title></title>
+      <calculation>nscf</calculation>
+      <restart_mode>from_scratch</restart_mode>
+      <prefix>aiida</prefix>
+      <pseudo_dir>./pseudo/</pseudo_dir>
+      <outdir>./out/</outdir>
+      <stress>false</stress>
+      <forces>false</forces>
+      <wf_collect>true</wf_collect>
+      <disk_io>low</disk_io>
+      <max_seconds>10000</max_seconds>
+      <nstep>1</nstep>
+      <etot_conv_thr>1.0e-5</etot_conv_thr>
+      <forc_conv_thr>1.0e-3</forc_conv_thr>
+      <press_conv_thr>0.5</press_conv_thr>
+      <verbosity>low</verbosity>
+      <print_every>0</print_every>
+    </control_variables>
+    {species}
+    {structure}
+    <dft>
+      <functional>PBE</functional>
+    </dft>
+    <spin>
+      <lsda>{str(lsda).lower()}</lsda>
+      <noncolin>false</noncolin>
+      <spinorbit>false</spinorbit>
+    </spin>
+    <bands>
+      <nbnd>{num_bands}</nbnd>
+      <occupations>fixed</occupations>
+    </bands>
+    <basis>
+      <gamma_only>false</gamma_only>
+      <ecutwfc>15.0</ecutwfc>
+    </basis>
+  </input>
+  <output>
+    <convergence_info>
+      <scf_conv>
+        <convergence_achieved>true</convergence_achieved>
+        <n_scf_steps>1</n_scf_steps>
+        <scf_error>1.0e-10</scf_error>
+      </scf_conv>
+    </convergence_info>
+    <algorithmic_info>
+      <real_space_q>false</real_space_q>
+      <real_space_beta>false</real_space_beta>
+      <uspp>false</uspp>
+      <paw>false</paw>
+    </algorithmic_info>
+    {species}
+    {structure}
+    <symmetries>
+      <nsym>0</nsym>
+      <nrot>0</nrot>
+      <space_group>0</space_group>
+    </symmetries>
+    <basis_set>
+      <gamma_only>false</gamma_only>
+      <ecutwfc>15.0</ecutwfc>
+      <ecutrho>60.0</ecutrho>
+      <fft_grid nr1="20" nr2="20" nr3="20"></fft_grid>
+      <fft_smooth nr1="20" nr2="20" nr3="20"></fft_smooth>
+      <fft_box nr1="20" nr2="20" nr3="20"></fft_box>
+      <ngm>1000</ngm>
+      <ngms>1000</ngms>
+      <npwx>120</npwx>
+      <reciprocal_lattice>
+        <b1>-1.0 -1.0 1.0</b1>
+        <b2>1.0 1.0 1.0</b2>
+        <b3>-1.0 1.0 -1.0</b3>
+      </reciprocal_lattice>
+    </basis_set>
+    <dft>
+      <functional>PBE</functional>
+    </dft>
+    <magnetization>
+      <lsda>{str(lsda).lower()}</lsda>
+      <noncolin>false</noncolin>
+      <spinorbit>false</spinorbit>
+      <total>0.0</total>
+      <absolute>0.0</absolute>
+      <do_magnetization>{str(lsda).lower()}</do_magnetization>
+    </magnetization>
+    <total_energy>
+      <etot>-15.8</etot>
+    </total_energy>
+    <band_structure>
+      <lsda>{str(lsda).lower()}</lsda>
+      <noncolin>false</noncolin>
+      <spinorbit>false</spinorbit>
+      <nbnd>{num_bands}</nbnd>
+      <nelec>8.0</nelec>
+      <num_of_atomic_wfc>8</num_of_atomic_wfc>
+      <wf_collected>true</wf_collected>
+      <fermi_energy>0.2</fermi_energy>
+      <starting_k_points>
+        <nk>{num_kpoints}</nk>
+        <k_point weight="1.0">0.0 0.0 0.0</k_point>
+      </starting_k_points>
+      <nks>{num_kpoints}</nks>
+      <occupations_kind>fixed</occupations_kind>
+{kpoints}
+    </band_structure>
+  </output>
+  <status>0</status>
+  <timing_info>
+    <total label="PWSCF">
+      <cpu>1.0</cpu>
+      <wall>1.0</wall>
+    </total>
+  </timing_info>
+  <closed DATE="17 Oct 2026" TIME="10: 0: 0"></closed>
+</qes:espresso>
+"""
+
+
+def get_logs():
+    return AttributeDict({"error": [], "warning": []})
+
+
+def test_parse_stdout_screen():
+    """Test the parsing of the ``stdout`` of a screen calculation."""
+    parsed_data, logs = parse_stdout(
+        io.StringIO(STDOUT_SCREEN), get_logs(), KcwParser.get_error_map(), KcwParser.get_warning_map()
+    )
+
+    assert logs.error == []
+    assert parsed_data["code_version"] == "7.2"
+    assert parsed_data["wall_time_seconds"] == 2.0
+    assert parsed_data["alphas"] == [0.5, 0.25]
+    assert parsed_data["warnings"] == ["Warning: the screening is computed with a coarse grid"]
+
+
+def test_parse_stdout_ham():
+    """Test the parsing of the eigenvalues in the ``stdout`` of an (incomplete) ham calculation."""
+    parsed_data, logs = parse_stdout(
+        io.StringIO(STDOUT_HAM), get_logs(), KcwParser.get_error_map(), KcwParser.get_warning_map()
+    )
+
+    assert logs.error == ["ERROR_OUTPUT_STDOUT_INCOMPLETE"]
+    assert parsed_data["wall_time_seconds"] == 63.0
+    assert parsed_data["kpoints_eigenvalues"] == [[0, 0, 0], [0.5, 0, 0]]
+    assert parsed_data["eigenvalues_ks"] == [[-5.6, 6.2, 6.2], [-4.6, 5.2, 5.2]]
+    assert parsed_data["eigenvalues_ki"] == [[-8.1, 9.3, 9.3], [-7.1, 8.3, 8.3]]
+    assert (parsed_data["homo_ki"], parsed_data["lumo_ki"]) == (-7.1, 8.3)
+    assert (parsed_data["homo_ks"], parsed_data["lumo_ks"]) == (-4.6, 5.2)
+
+
+def test_parse_stdout_errors():
+    """Test the parsing of the error messages between ``%%%%%`` lines, with overlong lines."""
+    stdout = "\n".join([
+        "     Program KCW v.7.2 starts on 17Oct2026 at 10: 0: 0",
+        " " + "x" * 10_000,
+        " %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%",
+        "     Error in routine kcw_readin (1):",
+        "     reading input namelist",
+        " %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%",
+        "     Maximum CPU time exceeded",
+    ])
+    parsed_data, logs = parse_stdout(
+        io.StringIO(stdout), get_logs(), KcwParser.get_error_map(), KcwParser.get_warning_map()
+    )
+
+    assert parsed_data == {"code_version": "7.2"}
+    assert logs.error == [
+        "ERROR_OUTPUT_STDOUT_INCOMPLETE",
+        "     Error in routine kcw_readin (1):\n     reading input namelist",
+        "ERROR_OUT_OF_WALLTIME",
+    ]
+    assert [len(line) for line in iter_lines(io.StringIO(stdout), max_line_length=100)][:3] == [54, 100, 97]
+
+
+def test_parse_stdout_mapped_error_message():
+    """Test that an error marker in a message between ``%%%%%`` lines is mapped, and the message dropped."""
+    stdout = "\n".join([
+        "     Program KCW v.7.2 starts on 17Oct2026 at 10: 0: 0",
+        " %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%",
+        "     Error in routine cdiaghg (12):",
+        "     S matrix not positive definite",
+        " %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%",
+    ])
+    error_map = {"S matrix not positive definite": "ERROR_S_MATRIX"}
+    _, logs = parse_stdout(io.StringIO(stdout), get_logs(), error_map, {})
+
+    assert logs.error == ["ERROR_OUTPUT_STDOUT_INCOMPLETE", "ERROR_S_MATRIX"]
+
+    _, logs = parse_stdout(io.StringIO(stdout), get_logs(), {"S matrix not (positive|negative)": "ERROR_S_MATRIX"}, {})
+    assert logs.error == ["ERROR_OUTPUT_STDOUT_INCOMPLETE", "ERROR_S_MATRIX"]
+
+
+def test_parse_stdout_performance():
+    """Test the parsing of the timing, parallelisation and memory report of the ``stdout``."""
+    stdout = "\n".join([
+        "     Program KCW v.7.2 starts on 17Oct2026 at 10: 0: 0",
+        "     Parallel version (MPI & OpenMP), running on       8 processor cores",
+        "     Number of MPI processes:                 4",
+        "     Threads/MPI process:                     2",
+        "     MPI processes distributed on     1 nodes",
+        "     K-points division:     npool     =       2",
+        "     Estimated max dynamical RAM per process >     512.00 MB",
+        "     Estimated total dynamical RAM >       2.00 GB",
+        "     kcw_setup    :      0.50s CPU      0.60s WALL (       1 calls)",
+        "     fft          :   1m 2.00s CPU   1m 3.00s WALL (    1200 calls)",
+        "     KCW          :   1m 4.00s CPU   1m 5.00s WALL",
+        "   JOB DONE.",
+    ])
+    parsed_data, logs = parse_stdout(
+        io.StringIO(stdout), get_logs(), KcwParser.get_error_map(), KcwParser.get_warning_map()
+    )
+
+    assert logs.error == []
+    assert parsed_data["wall_time_seconds"] == 65.0
+    assert parsed_data["performance"] == {
+        "mpi_processes": 4,
+        "threads_per_mpi_process": 2,
+        "nodes": 1,
+        "npool": 2,
+        "ram_per_process_mb": 512.0,
+        "ram_total_mb": 2048.0,
+        "cpu_time_seconds": 64.0,
+        "wall_time_seconds": 65.0,
+        "clocks": {
+            "kcw_setup": {"cpu_seconds": 0.5, "wall_seconds": 0.6, "calls": 1},
+            "fft": {"cpu_seconds": 62.0, "wall_seconds": 63.0, "calls": 1200},
+        },
+    }
+
+
+def parse_xml_full(content):
+    """Parse the XML with the full parser of ``aiida-quantumespresso``."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        from aiida_quantumespresso.parsers.parse_xml.pw.parse import parse_xml
+
+    return parse_xml(io.StringIO(content))[0]
+
+
+@pytest.mark.parametrize("lsda", [False, True])
+def test_parse_xml_fast(lsda):
+    """Test that the fast XML extraction returns the same fields as the full parser."""
+    content = generate_pw_xml(num_kpoints=3, lsda=lsda)
+    parsed_full = parse_xml_full(content)
+    parsed_fast = parse_xml_fast(io.BytesIO(content.encode()))
+
+    for key in ["atoms", "lattice_parameter", "lattice_parameter_xml", "number_of_atoms"]:
+        assert parsed_fast["structure"][key] == parsed_full["structure"][key]
+    assert parsed_fast["structure"]["cell"]["lattice_vectors"] == parsed_full["structure"]["cell"]["lattice_vectors"]
+
+    for key in parsed_fast:
+        if key != "structure":
+            assert parsed_fast[key] == parsed_full[key], key
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "<root></root>",
+        generate_pw_xml().split("<band_structure>")[0],
+        generate_pw_xml().replace('alat="10.2"', 'alat="a"'),
+        generate_pw_xml().replace("band_structure>", "other_structure>"),
+    ],
+)
+def test_parse_xml_fast_unexpected(content):
+    """Test that the fast XML extraction raises for unexpected documents, for which the full parser must be used."""
+    with pytest.raises(UnexpectedXMLError):
+        parse_xml_fast(io.BytesIO(content.encode()))
+
+
+@pytest.mark.benchmark
+def test_parse_xml_fast_benchmark(record_property):
+    """Benchmark the fast XML extraction against the full parser, for a file with many k-points and bands.
+
+    The timings depend on the load of the machine, so only the ratio is reported, e.g. with ``pytest -m benchmark -s``.
+    """
+    content = generate_pw_xml(num_kpoints=200, num_bands=40)
+    parsers = {
+        "full": parse_xml_full,
+        "fast": lambda content: parse_xml_fast(io.BytesIO(content.encode())),
+    }
+    timings = {}
+    for name, parse in parsers.items():
+        times = []
+        for _ in range(3):
+            start = time.perf_counter()
+            parse(content)
+            times.append(time.perf_counter() - start)
+        timings[name] = min(times)
+
+    ratio = timings["full"] / timings["fast"]
+    record_property("parse_xml_speedup", ratio)
+    print(f"full parse_xml: {timings['full']:.4f} s, parse_xml_fast: {timings['fast']:.4f} s, speedup: {ratio:.1f}x")
+
+
+def generate_calc_job_node(koopmans_code, process_type, inputs=None, options=None):
+    """Return a stored ``CalcJobNode`` with the given process type, inputs and options."""
+    from aiida.common import LinkType
+    from aiida.orm import CalcJobNode
+
+    node = CalcJobNode(computer=koopmans_code.computer, process_type=process_type)
+    node.set_option("resources", {"num_machines": 1})
+    node.set_option("output_filename", "aiida.out")
+    for key, value in (options or {}).items():
+        node.set_option(key, value)
+    for label, input_node in (inputs or {}).items():
+        input_node.store()
+        node.base.links.add_incoming(input_node, link_type=LinkType.INPUT_CALC, link_label=label)
+    node.store()
+    return node
+
+
+def generate_pw_parent_folder(koopmans_code):
+    """Return a ``RemoteData`` created by a (mock) ``PwCalculation``, with its inputs and ``output_parameters``."""
+    from aiida.common import LinkType
+    from aiida.orm import Dict, KpointsData, RemoteData, StructureData
+
+    structure = StructureData(cell=[[5.0, 0, 0], [0, 5.0, 0], [0, 0, 5.0]])
+    structure.append_atom(position=[0, 0, 0], symbols="Si")
+    kpoints = KpointsData()
+    kpoints.set_kpoints_mesh([2, 2, 2])
+    pw_node = generate_calc_job_node(
+        koopmans_code, "aiida.calculations:quantumespresso.pw", {"structure": structure, "kpoints": kpoints}
+    )
+
+    parameters = Dict({"number_of_spin_components": 2, "non_colinear_calculation": False})
+    parameters.base.links.add_incoming(pw_node, link_type=LinkType.CREATE, link_label="output_parameters")
+    parameters.store()
+    remote_folder = RemoteData(computer=koopmans_code.computer, remote_path="/tmp")
+    remote_folder.base.links.add_incoming(pw_node, link_type=LinkType.CREATE, link_label="remote_folder")
+    remote_folder.store()
+
+    return remote_folder
+
+
+def generate_kcw_node(koopmans_code, retrieved_files, settings=None, kpoints=None):
+    """Return a stored ``KcwCalculation`` node with the ``without_xml`` option, and a retrieved folder."""
+    from aiida.common import LinkType
+    from aiida.orm import Dict, FolderData
+
+    inputs = {"parent_folder": generate_pw_parent_folder(koopmans_code)}
+    if settings is not None:
+        inputs["settings"] = Dict(settings)
+    if kpoints is not None:
+        inputs["kpoints"] = kpoints
+    node = generate_calc_job_node(koopmans_code, "aiida.calculations:koopmans", inputs, {"without_xml": True})
+
+    retrieved = FolderData()
+    for filename, content in retrieved_files.items():
+        retrieved.base.repository.put_object_from_filelike(io.StringIO(content), filename)
+    retrieved.base.links.add_incoming(node, link_type=LinkType.CREATE, link_label="retrieved")
+    retrieved.store()
+
+    return node
+
+
+def test_kcw_parser_without_xml(koopmans_code, monkeypatch):
+    """Test that with the ``without_xml`` option the structure and spin settings are taken from the parent outputs."""
+    from aiida_koopmans.calculations.kcw import get_parent_pw_calculation
+
+    node = generate_kcw_node(koopmans_code, {"aiida.out": STDOUT_SCREEN})
+    pw_node = get_parent_pw_calculation(node.inputs.parent_folder)
+    assert pw_node is not None
+
+    parse_info = {}
+    original_get_parent_info = KcwParser._get_parent_info
+
+    def get_parent_info(self):
+        parse_info.update(original_get_parent_info(self))
+        return parse_info
+
+    monkeypatch.setattr(KcwParser, "_get_parent_info", get_parent_info)
+    results, calcfunction = KcwParser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok
+    assert results["output_parameters"]["alphas"] == [0.5, 0.25]
+    assert results["performance"]["wall_time_seconds"] == 2.0
+    assert "performance" not in results["output_parameters"].get_dict()
+    assert parse_info["structure"].uuid == pw_node.inputs.structure.uuid
+    assert parse_info["kpoints"].uuid == pw_node.inputs.kpoints.uuid
+    assert parse_info["nspin"] == 2
+
+
+def test_parse_alpha_file():
+    """Test the parsing of the files with the screening parameters."""
+    from aiida_koopmans.parsers.parse_raw import parse_alpha_file
+
+    indices, alphas = parse_alpha_file(io.StringIO("2\n1 0.3 1.2\n2 0.25 1.1\n"))
+    assert indices.tolist() == [1, 2]
+    assert alphas.tolist() == [0.3, 0.25]
+
+    indices, alphas = parse_alpha_file(io.StringIO("0\n"))
+    assert indices.size == alphas.size == 0
+
+    with pytest.raises(ValueError):
+        parse_alpha_file(io.StringIO("3\n1 0.3 1.2\n2 0.25 1.1\n"))
+
+
+def test_kcw_parser_alphas(koopmans_code):
+    """Test the ``alphas`` output of the parser, after a screening calculation."""
+    node = generate_kcw_node(
+        koopmans_code,
+        {
+            "aiida.out": STDOUT_SCREEN,
+            "file_alpharef.txt": "2\n1 0.3 1.2\n2 0.25 1.1\n",
+            "file_alpharef_empty.txt": "1\n1 0.4 0.9\n",
+        },
+    )
+    results, calcfunction = KcwParser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok
+    assert results["alphas"].get_array("alphas").tolist() == [0.3, 0.25, 0.4]
+    assert results["alphas"].get_array("orbital_indices").tolist() == [1, 2, 1]
+    assert results["alphas"].get_array("occupied").tolist() == [True, True, False]
+
+    node = generate_kcw_node(koopmans_code, {"aiida.out": STDOUT_SCREEN, "file_alpharef.txt": "2\n1 0.3 1.2\n"})
+    _, calcfunction = KcwParser.parse_from_node(node, store_provenance=False)
+    assert calcfunction.exit_status == node.process_class.exit_codes.ERROR_READING_ALPHA_FILE.status
+
+
+@pytest.mark.parametrize("cutoff", [None, 0.5])
+def test_kcw_parser_hamiltonian(koopmans_code, tmp_path, cutoff):
+    """Test the ``hamiltonian`` output of the parser, after a ham calculation, with and without cutoff."""
+    import numpy as np
+
+    from aiida_koopmans.data.wannier90 import write_hr
+
+    rng = np.random.default_rng(0)
+    r_vectors = np.array([[0, 0, 0], [1, 0, 0], [-1, 0, 0]])
+    hamiltonian = np.round(rng.random((3, 4, 4)) + 1j * rng.random((3, 4, 4)), 6)
+    with (tmp_path / "aiida.kcw_hr.dat").open("w") as handle:
+        write_hr(handle, " written on 17Oct2026", r_vectors, np.array([1, 2, 2]), hamiltonian)
+
+    settings = None if cutoff is None else {"parser_options": {"hamiltonian_cutoff": cutoff}}
+    node = generate_kcw_node(koopmans_code, {"aiida.out": STDOUT_HAM + "\n   JOB DONE.\n"}, settings)
+    results, calcfunction = KcwParser.parse_from_node(
+        node, store_provenance=False, retrieved_temporary_folder=str(tmp_path)
+    )
+
+    assert calcfunction.is_finished_ok
+    output = results["hamiltonian"]
+    assert output.get_array("r_vectors").tolist() == r_vectors.tolist()
+    assert output.get_array("degeneracies").tolist() == [1, 2, 2]
+
+    if cutoff is None:
+        assert np.allclose(output.get_array("hamiltonian"), hamiltonian)
+    else:
+        significant = np.abs(hamiltonian) > cutoff
+        indices = output.get_array("indices")
+        assert output.base.attributes.get("shape") == [3, 4, 4]
+        assert len(indices) == significant.sum()
+        assert np.allclose(output.get_array("values"), hamiltonian[tuple(indices.T)])
+
+
+def test_kcw_parser_bands(koopmans_code):
+    """Test the ``bands`` output of the parser, after a ham calculation with the ``kpoints`` input."""
+    from aiida.orm import KpointsData
+
+    kpoints = KpointsData()
+    kpoints.set_kpoints([[0.0, 0.0, 0.0], [0.5, 0.0, 0.0]])
+    kpoints.labels = [(0, "G"), (1, "X")]
+
+    node = generate_kcw_node(koopmans_code, {"aiida.out": STDOUT_HAM + "\n   JOB DONE.\n"}, kpoints=kpoints)
+    results, calcfunction = KcwParser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok
+    assert results["bands"].get_bands().tolist() == [[-8.1, 9.3, 9.3], [-7.1, 8.3, 8.3]]
+    assert results["bands"].labels == [(0, "G"), (1, "X")]
+    assert "eigenvalues_ki" not in results["output_parameters"].get_dict()
+
+    kpoints = KpointsData()
+    kpoints.set_kpoints([[0.0, 0.0, 0.0]])
+    node = generate_kcw_node(koopmans_code, {"aiida.out": STDOUT_HAM + "\n   JOB DONE.\n"}, kpoints=kpoints)
+    _, calcfunction = KcwParser.parse_from_node(node, store_provenance=False)
+    assert calcfunction.exit_status == node.process_class.exit_codes.ERROR_PARSING_PROJECTIONS.status
+
+
+def test_gaussian_dos(monkeypatch):
+    """Test that the broadened DOS is normalised, and independent of the chunking of the eigenvalues."""
+    import numpy as np
+
+    from aiida_koopmans.parsers import parse_raw
+
+    energies = np.linspace(-10, 10, 2001)
+    eigenvalues = np.array([[-1.0, 0.5, 2.0], [-0.5, 1.0, 3.0]])
+    dos = parse_raw.gaussian_dos(energies, eigenvalues, 0.2)
+
+    assert np.isclose(dos.sum() * (energies[1] - energies[0]), 3.0)
+    assert np.isclose(dos[np.argmin(np.abs(energies - 3.0))], 0.5 / (0.2 * np.sqrt(2 * np.pi)), rtol=1e-3)
+
+    monkeypatch.setattr(parse_raw, "MAX_VALUES", len(energies) * 2)
+    assert np.allclose(parse_raw.gaussian_dos(energies, eigenvalues, 0.2), dos)
+
+
+def test_kcw_parser_pdos_dos(koopmans_code):
+    """Test the ``pdos`` output, and the ``dos`` output with the ``dos_degauss`` parser option."""
+    import numpy as np
+
+    pdos_tot = "#  E (eV)  dosup(E)  dosdw(E)  pdosup(E)  pdosdw(E)\n"
+    pdos_tot += "".join(f"{energy:8.3f} 0.1 0.2 0.3 0.4\n" for energy in (-1.0, 0.0, 1.0))
+    settings = {"parser_options": {"dos_degauss": 0.1, "dos_emin": -10, "dos_emax": 10, "dos_deltae": 0.005}}
+    node = generate_kcw_node(
+        koopmans_code, {"aiida.out": STDOUT_HAM + "\n   JOB DONE.\n", "aiida.pdos_tot": pdos_tot}, settings
+    )
+    results, calcfunction = KcwParser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok
+    assert results["pdos"].get_array("energy").tolist() == [-1.0, 0.0, 1.0]
+    assert results["pdos"].get_array("dos").tolist() == [[0.1, 0.2]] * 3
+    assert results["pdos"].get_array("pdos").tolist() == [[0.3, 0.4]] * 3
+
+    assert results["dos"].base.attributes.get("degauss") == 0.1
+    assert np.isclose(results["dos"].get_array("dos_ki").sum() * 0.005, 3.0)
+    assert np.isclose(results["dos"].get_array("dos_ks").sum() * 0.005, 3.0)
+
+    node = generate_kcw_node(koopmans_code, {"aiida.out": STDOUT_HAM + "\n   JOB DONE.\n", "aiida.pdos_tot": "1 2\n"})
+    _, calcfunction = KcwParser.parse_from_node(node, store_provenance=False)
+    assert calcfunction.exit_status == node.process_class.exit_codes.ERROR_READING_PDOSTOT_FILE.status
+
+    settings = {"parser_options": {"dos_degauss": 0.1, "dos_emin": 100}}
+    node = generate_kcw_node(koopmans_code, {"aiida.out": STDOUT_HAM + "\n   JOB DONE.\n"}, settings)
+    _, calcfunction = KcwParser.parse_from_node(node, store_provenance=False)
+    assert calcfunction.exit_status == node.process_class.exit_codes.ERROR_COMPUTING_DOS.status
+
+
+def test_kcw_chain_parser(koopmans_code):
+    """Test that the outputs of each step of a ``KcwChainCalculation`` are attached in the namespace of the step."""
+    from aiida.common import LinkType
+    from aiida.orm import Dict, FolderData
+
+    from aiida_koopmans.parsers.kcw_chain import KcwChainParser
+
+    inputs = {
+        "parent_folder": generate_pw_parent_folder(koopmans_code),
+        "screen__parameters": Dict({"CONTROL": {"calculation": "screen"}}),
+        "ham__parameters": Dict({"CONTROL": {"calculation": "ham"}}),
+    }
+    node = generate_calc_job_node(koopmans_code, "aiida.calculations:koopmans.chain", inputs, {"without_xml": True})
+
+    retrieved = FolderData()
+    for filename, content in {
+        "aiida.screen.out": STDOUT_SCREEN,
+        "aiida.ham.out": STDOUT_HAM + "\n   JOB DONE.\n",
+        "file_alpharef.txt": "2\n1 0.3 1.2\n2 0.25 1.1\n",
+    }.items():
+        retrieved.base.repository.put_object_from_filelike(io.StringIO(content), filename)
+    retrieved.base.links.add_incoming(node, link_type=LinkType.CREATE, link_label="retrieved")
+    retrieved.store()
+
+    results, calcfunction = KcwChainParser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.is_finished_ok
+    assert results["output_parameters"].get_dict() == {
+        "steps": ["screen", "ham"],
+        "wall_time_seconds": 65.0,
+        "code_version": "7.2",
+    }
+    assert results["screen"]["output_parameters"]["alphas"] == [0.5, 0.25]
+    assert results["screen"]["alphas"].get_array("alphas").tolist() == [0.3, 0.25]
+    assert results["ham"]["output_parameters"]["homo_ki"] == -7.1
+    assert results["ham"]["performance"]["calculation"] == "ham"
+    assert "alphas" not in results["ham"]
+
+
+def test_kcw_packed_parser(koopmans_code):
+    """Test that the outputs of each packed calculation are parsed from its subfolder and attached in its namespace."""
+    from aiida.common import LinkType
+    from aiida.orm import Dict, FolderData
+
+    from aiida_koopmans.parsers.kcw_packed import KcwPackedParser
+
+    inputs = {
+        "calculations__a__parameters": Dict({"CONTROL": {"calculation": "screen"}}),
+        "calculations__a__parent_folder": FolderData(),
+        "calculations__b__parameters": Dict({"CONTROL": {"calculation": "screen"}}),
+        "calculations__b__parent_folder": FolderData(),
+    }
+    node = generate_calc_job_node(koopmans_code, "aiida.calculations:koopmans.packed", inputs)
+
+    retrieved = FolderData()
+    for filename, content in {
+        "a/aiida.out": STDOUT_SCREEN,
+        "a/file_alpharef.txt": "2\n1 0.3 1.2\n2 0.25 1.1\n",
+        "b/aiida.out": STDOUT_SCREEN.replace("JOB DONE", ""),
+    }.items():
+        retrieved.base.repository.put_object_from_filelike(io.StringIO(content), filename)
+    retrieved.base.links.add_incoming(node, link_type=LinkType.CREATE, link_label="retrieved")
+    retrieved.store()
+
+    results, calcfunction = KcwPackedParser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.exit_status == node.process_class.exit_codes.ERROR_PACKED_CALCULATIONS_FAILED.status
+    assert results["output_parameters"]["calculations"] == ["a"]
+    assert list(results["output_parameters"]["failed"]) == ["b"]
+    assert results["calculations"]["a"]["alphas"].get_array("alphas").tolist() == [0.3, 0.25]
+    assert results["calculations"]["a"]["performance"]["calculation"] == "screen"
+    assert "alphas" not in results["calculations"]["b"]
+
+
+def test_kcw_parser_out_of_walltime(koopmans_code):
+    """Test that the out-of-walltime exit code of the scheduler is kept, with the screening parameters printed so far."""
+    from aiida_koopmans.calculations.kcw import KcwCalculation
+
+    stdout = STDOUT_SCREEN.split("        iwann =     2")[0]
+    node = generate_kcw_node(koopmans_code, {"aiida.out": stdout})
+    node.set_exit_status(KcwCalculation.exit_codes.ERROR_SCHEDULER_OUT_OF_WALLTIME.status)
+
+    results, calcfunction = KcwParser.parse_from_node(node, store_provenance=False)
+
+    assert calcfunction.exit_status == KcwCalculation.exit_codes.ERROR_SCHEDULER_OUT_OF_WALLTIME.status
+    assert results["output_parameters"]["orbital_indices"] == [1]
+    assert results["output_parameters"]["alphas"] == [0.5]
@@ -0,0 +1,313 @@
+""" Tests for workflows."""
+
+import io
+
+import pytest
+
+from aiida.common import LinkType
+from aiida.engine import ProcessState
+from aiida.engine.utils import instantiate_process
+from aiida.manage import get_manager
+from aiida.orm import (
+    BandsData,
+    CalcJobNode,
+    Dict,
+    FolderData,
+    Int,
+    RemoteData,
+    SinglefileData,
+    StructureData,
+    WorkflowNode,
+)
+
+from aiida_koopmans.calculations.kcw import KcwCalculation
+from aiida_koopmans.workflows.base import KcwBaseWorkChain, merge_alpha_files
+from aiida_koopmans.workflows.koopmans import (
+    get_kcw_step_inputs,
+    get_manifold_wannier90_files,
+    get_screening_alpha_files,
+    get_wannier90_inputs_from_nscf,
+)
+
+SCREEN_PARAMETERS = {
+    "CONTROL": {"calculation": "screen"},
+    "WANNIER": {"num_wann_occ": 2, "num_wann_emp": 1},
+}
+
+
+def generate_workchain(koopmans_code, parameters, options=None, settings=None, **kwargs):
+    """Return a ``KcwBaseWorkChain`` instance after its ``setup`` step."""
+    inputs = {
+        "kcw": {
+            "code": koopmans_code,
+            "parameters": Dict(parameters),
+            "parent_folder": RemoteData(computer=koopmans_code.computer, remote_path="/scratch/parent"),
+            "metadata": {"options": {"resources": {"num_machines": 1}, **(options or {})}},
+        },
+        **kwargs,
+    }
+    if settings is not None:
+        inputs["kcw"]["settings"] = Dict(settings)
+
+    process = instantiate_process(get_manager().get_runner(), KcwBaseWorkChain, **inputs)
+    process.setup()
+    process.node.base.extras.set(process._considered_handlers_extra, [])
+    return process
+
+
+def run_child(process, exit_code=None, output_parameters=None):
+    """Add a finished ``KcwCalculation`` with the current inputs of the work chain, and inspect it."""
+    node = CalcJobNode(computer=process.ctx.inputs.code.computer, process_type="aiida.calculations:koopmans")
+    node.set_process_label("KcwCalculation")
+    node.set_option("resources", process.ctx.inputs.metadata["options"]["resources"])
+    node.set_option("max_wallclock_seconds", process.ctx.inputs.metadata["options"].get("max_wallclock_seconds", 100))
+    node.base.links.add_incoming(process.ctx.inputs.parameters.store(), LinkType.INPUT_CALC, "parameters")
+    node.set_process_state(ProcessState.FINISHED)
+    node.set_exit_status(exit_code.status if exit_code else 0)
+    node.store()
+    if output_parameters is not None:
+        output = Dict(output_parameters)
+        output.base.links.add_incoming(node, LinkType.CREATE, "output_parameters")
+        output.store()
+    node.seal()
+
+    process.ctx.children = process.ctx.get("children", []) + [node]
+    process.ctx.iteration += 1
+    process.node.base.extras.set(
+        process._considered_handlers_extra, process.node.base.extras.get(process._considered_handlers_extra) + [[]]
+    )
+    return process.inspect_process()
+
+
+def get_i_orb(process):
+    """Return the ``i_orb`` of the inputs of the next calculation of the work chain."""
+    return process.ctx.inputs.parameters.get_dict().get("SCREEN", {}).get("i_orb", None)
+
+
+def test_kcw_base_screening_restart(koopmans_code):
+    """Test that a screening that ran out of walltime is restarted for the remaining orbitals, one at a time."""
+    process = generate_workchain(koopmans_code, SCREEN_PARAMETERS)
+    assert process.ctx.orbitals == [1, 2, 3]
+
+    exit_code = KcwCalculation.exit_codes.ERROR_SCHEDULER_OUT_OF_WALLTIME
+    run_child(process, exit_code, {"orbital_indices": [1], "alphas": [0.3]})
+    assert not process.ctx.is_finished
+    assert get_i_orb(process) == 2
+
+    run_child(process, output_parameters={"orbital_indices": [2], "alphas": [0.25]})
+    assert not process.ctx.is_finished
+    assert get_i_orb(process) == 3
+
+    run_child(process, output_parameters={"orbital_indices": [3], "alphas": [0.4]})
+    assert process.ctx.is_finished
+
+    process.results()
+    alphas = process.outputs["alphas"]
+    assert alphas.get_array("alphas").tolist() == [0.3, 0.25, 0.4]
+    assert alphas.get_array("orbital_indices").tolist() == [1, 2, 1]
+    assert alphas.get_array("occupied").tolist() == [True, True, False]
+
+
+def test_kcw_base_screening_restart_max_iterations(koopmans_code):
+    """Test that the restarts for the next orbital are not counted against the ``max_iterations``."""
+    parameters = {"CONTROL": {"calculation": "screen"}, "WANNIER": {"num_wann_occ": 6, "num_wann_emp": 2}}
+    options = {"max_wallclock_seconds": 100}
+    exit_code = KcwCalculation.exit_codes.ERROR_OUT_OF_WALLTIME
+
+    process = generate_workchain(koopmans_code, parameters, options=options, max_iterations=Int(2))
+    assert len(process.ctx.orbitals) == 8
+
+    run_child(process, exit_code, {"orbital_indices": [1], "alphas": [0.1]})
+    for orbital in range(2, 9):
+        assert get_i_orb(process) == orbital
+        if orbital == 5:
+            assert not run_child(process, exit_code, {}).status
+            assert process.ctx.inputs.metadata["options"]["max_wallclock_seconds"] == 150
+        result = run_child(process, output_parameters={"orbital_indices": [orbital], "alphas": [orbital / 10]})
+        assert result is None or not result.status
+    assert process.ctx.is_finished
+
+    process.results()
+    assert process.outputs["alphas"].get_array("alphas").tolist() == [orbital / 10 for orbital in range(1, 9)]
+
+    process = generate_workchain(koopmans_code, parameters, options=options, max_iterations=Int(2))
+    run_child(process, exit_code, {"orbital_indices": [1], "alphas": [0.1]})
+    run_child(process, exit_code, {})
+    result = run_child(process, exit_code, {})
+    assert result.status == KcwBaseWorkChain.exit_codes.ERROR_MAXIMUM_ITERATIONS_EXCEEDED.status
+
+
+def test_kcw_base_screening_orbital_missing(koopmans_code):
+    """Test that the work chain aborts if the screening of a single orbital does not print its parameter."""
+    process = generate_workchain(koopmans_code, SCREEN_PARAMETERS)
+
+    exit_code = KcwCalculation.exit_codes.ERROR_OUT_OF_WALLTIME
+    run_child(process, exit_code, {"orbital_indices": [1, 2], "alphas": [0.3, 0.25]})
+    assert get_i_orb(process) == 3
+
+    result = run_child(process, output_parameters={})
+    assert result.status == KcwBaseWorkChain.exit_codes.ERROR_SCREENING_ORBITAL_MISSING.status
+
+
+def test_kcw_base_out_of_walltime(koopmans_code):
+    """Test that a calculation that ran out of walltime without screening progress is restarted with more time."""
+    process = generate_workchain(
+        koopmans_code, {"CONTROL": {"calculation": "ham"}}, options={"max_wallclock_seconds": 100}
+    )
+    assert process.ctx.orbitals == []
+
+    run_child(process, KcwCalculation.exit_codes.ERROR_SCHEDULER_OUT_OF_WALLTIME)
+    assert not process.ctx.is_finished
+    assert process.ctx.inputs.metadata["options"]["max_wallclock_seconds"] == 150
+
+
+def test_kcw_base_out_of_memory(koopmans_code):
+    """Test that a calculation that ran out of memory is restarted with fewer pools, then on more machines."""
+    process = generate_workchain(
+        koopmans_code, SCREEN_PARAMETERS, settings={"CMDLINE": ["-nk", "2"]}, max_num_machines=Int(2)
+    )
+    exit_code = KcwCalculation.exit_codes.ERROR_SCHEDULER_OUT_OF_MEMORY
+
+    run_child(process, exit_code)
+    assert process.ctx.inputs.settings.get_dict()["CMDLINE"] == ["-nk", "1"]
+
+    run_child(process, exit_code)
+    assert process.ctx.inputs.metadata["options"]["resources"]["num_machines"] == 2
+
+    result = run_child(process, exit_code)
+    assert result.status == KcwBaseWorkChain.exit_codes.ERROR_UNRECOVERABLE_FAILURE.status
+
+
+@pytest.mark.parametrize(
+    "cmdline, expected",
+    [
+        (["-nk=4"], ["-nk=2"]),
+        (["-npool", "4", "-nd", "1"], ["-npool", "2", "-nd", "1"]),
+        (["-nk", "four"], None),
+        (["-nk=four"], None),
+        (["-nk"], None),
+    ],
+)
+def test_kcw_base_out_of_memory_pools(koopmans_code, cmdline, expected):
+    """Test that the number of pools is read in both forms of the flag, and that an invalid one aborts."""
+    process = generate_workchain(koopmans_code, SCREEN_PARAMETERS, settings={"CMDLINE": cmdline})
+
+    result = run_child(process, KcwCalculation.exit_codes.ERROR_SCHEDULER_OUT_OF_MEMORY)
+    if expected is None:
+        assert result.status == KcwBaseWorkChain.exit_codes.ERROR_UNRECOVERABLE_FAILURE.status
+    else:
+        assert result.status == 0
+        assert process.ctx.inputs.settings.get_dict()["CMDLINE"] == expected
+
+
+def test_merge_alpha_files():
+    """Test that the files of the screening parameters of the runs of a restarted screening are merged."""
+    first = FolderData()
+    first.base.repository.put_object_from_filelike(io.BytesIO(b"2\n1 0.3 1.2\n2 0.1 1.0\n"), "file_alpharef.txt")
+    second = FolderData()
+    second.base.repository.put_object_from_filelike(io.BytesIO(b"1\n2 0.25 1.1\n"), "file_alpharef.txt")
+    second.base.repository.put_object_from_filelike(io.BytesIO(b"1\n1 0.4 0.9\n"), "file_alpharef_empty.txt")
+
+    files = merge_alpha_files(run_0000=first, run_0001=second)
+
+    assert files["occ"].get_content() == "2\n1 0.3 1.2\n2 0.25 1.1\n"
+    assert files["emp"].get_content() == "1\n1 0.4 0.9\n"
+    assert files["occ"].filename == "file_alpharef.txt"
+
+
+def generate_folder(files):
+    """Return a ``FolderData`` with the given files, a mapping of their names to their content."""
+    folder = FolderData()
+    for filename, content in files.items():
+        folder.base.repository.put_object_from_filelike(io.BytesIO(content.encode()), filename)
+    return folder
+
+
+def test_get_wannier90_inputs_from_nscf():
+    """Test that the k-points and the Fermi energy of Wannier90 are taken from the outputs of the nscf."""
+    structure = StructureData(cell=[[4.0, 0.0, 0.0], [0.0, 4.0, 0.0], [0.0, 0.0, 4.0]])
+    structure.append_atom(position=(0.0, 0.0, 0.0), symbols="Si")
+    output_band = BandsData()
+    output_band.set_kpoints([[0.0, 0.0, 0.0], [0.5, 0.0, 0.0]])
+
+    inputs = get_wannier90_inputs_from_nscf(structure, output_band, Dict({"fermi_energy": 5.2}), Dict({"num_wann": 4}))
+
+    assert inputs["kpoints"].get_kpoints().tolist() == [[0.0, 0.0, 0.0], [0.5, 0.0, 0.0]]
+    assert inputs["parameters"].get_dict() == {"num_wann": 4, "fermi_energy": 5.2}
+    assert inputs["kpoints"].base.links.get_incoming().first().node.process_label == "get_wannier90_inputs_from_nscf"
+
+
+@pytest.mark.parametrize("u_dis_mat", [False, True])
+def test_get_manifold_wannier90_files(u_dis_mat):
+    """Test that the Wannier90 files of a manifold are extracted from its workchain with a calcfunction."""
+    files = {"aiida_hr.dat": "hr\n", "aiida_u.mat": "u\n", "aiida_centres.xyz": "centres\n"}
+    if u_dis_mat:
+        files["aiida_u_dis.mat"] = "u_dis\n"
+    retrieved = generate_folder(files).store()
+
+    workchain = WorkflowNode().store()
+    retrieved.base.links.add_incoming(workchain, link_type=LinkType.RETURN, link_label="wannier90__retrieved")
+
+    wannier90_files = get_manifold_wannier90_files(workchain)
+
+    assert sorted(wannier90_files) == sorted(["hr_dat", "u_mat", "centres_xyz"] + ["u_dis_mat"] * u_dis_mat)
+    assert wannier90_files["u_mat"].get_content() == "u\n"
+    assert wannier90_files["u_mat"].creator.process_label == "extract_wannier90_files"
+    assert wannier90_files["u_mat"].creator.inputs.retrieved.uuid == retrieved.uuid
+
+
+def test_get_kcw_step_inputs(koopmans_code):
+    """Test that the inputs of a kcw.x step are completed with the parent folder and the Wannier90 files."""
+    parent_folder = RemoteData(computer=koopmans_code.computer, remote_path="/scratch/parent")
+    wannier90_files = {
+        "occ": {"u_mat": SinglefileData(io.BytesIO(b"u")), "centres_xyz": SinglefileData(io.BytesIO(b"c"))},
+        "emp": {"u_mat": SinglefileData(io.BytesIO(b"u"))},
+    }
+    inputs = {"kcw": {"code": koopmans_code, "parameters": Dict({"CONTROL": {"calculation": "wann2kcw"}})}}
+
+    step_inputs = get_kcw_step_inputs(inputs, "wann2kcw", parent_folder, wannier90_files)
+    assert step_inputs.kcw.parent_folder is parent_folder
+    assert step_inputs.kcw.wann_u_mat is wannier90_files["occ"]["u_mat"]
+    assert step_inputs.kcw.wann_emp_u_mat is wannier90_files["emp"]["u_mat"]
+    assert "parent_folder" not in inputs["kcw"]
+
+    inputs["kcw"]["parameters"] = Dict({"CONTROL": {"calculation": "screen"}})
+    step_inputs = get_kcw_step_inputs(inputs, "screen", parent_folder, wannier90_files)
+    assert sorted(step_inputs.kcw) == ["code", "parameters", "parent_folder"]
+
+
+def test_get_screening_alpha_files(koopmans_code):
+    """Test that the files of the screening parameters are merged from all the runs of the screen workchain."""
+    workchain = WorkflowNode().store()
+    runs = [
+        {"file_alpharef.txt": "2\n1 0.3 1.2\n2 0.1 1.0\n"},
+        {"file_alpharef.txt": "1\n2 0.25 1.1\n"},
+    ]
+    for files in runs:
+        node = CalcJobNode(computer=koopmans_code.computer, process_type="aiida.calculations:koopmans")
+        node.set_option("resources", {"num_machines": 1})
+        node.base.links.add_incoming(workchain, link_type=LinkType.CALL_CALC, link_label="iteration_01")
+        node.store()
+        retrieved = generate_folder(files)
+        retrieved.base.links.add_incoming(node, link_type=LinkType.CREATE, link_label="retrieved")
+        retrieved.store()
+
+    alpha_files = get_screening_alpha_files(workchain)
+
+    assert sorted(alpha_files) == ["alpha_file"]
+    assert alpha_files["alpha_file"].get_content() == "2\n1 0.3 1.2\n2 0.25 1.1\n"
+
+
+def test_koopmans_dfpt_spec():
+    """Test that the inputs set by the ``KoopmansDFPTWorkChain`` from the previous steps are not exposed."""
+    pytest.importorskip("aiida_wannier90_workflows")
+    from aiida_koopmans.workflows.koopmans import KoopmansDFPTWorkChain
+
+    inputs = KoopmansDFPTWorkChain.spec().inputs
+    assert "parent_folder" not in inputs["nscf"]["pw"]
+    assert "structure" not in inputs["wannier_occ"]
+    assert not inputs["wannier_emp"].required
+    for calculation in ("wann2kcw", "screen", "ham"):
+        assert "parent_folder" not in inputs[calculation]["kcw"]
+        assert "wann_u_mat" not in inputs[calculation]["kcw"]
+        assert "alpha_file" not in inputs[calculation]["kcw"]